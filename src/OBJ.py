@@ -2,8 +2,8 @@ import numpy as np
 
 ###############################################################################
 ## Lightweight Wavefront OBJ Parser
-############################################################################### 
-from triangle import Triangle
+###############################################################################
+from trianglemesh import TriangleMesh
 
 TOKEN_COMMENT = '#'
 TOKEN_VERTEX = 'v'
@@ -11,56 +11,139 @@ TOKEN_VERTEX_TEXTURE = 'vt'
 TOKEN_VERTEX_NORMAL = 'vn'
 TOKEN_FACE = 'f'
 
+# Number of bytes read and parsed at once
+CHUNK_SIZE = 1 << 22
+
 print_unsupported = False
 
-def parse(fname):
+_NEWLINE         = ord('\n')
+_CARRIAGE_RETURN = ord('\r')
+_SPACE           = ord(' ')
+_TAB             = ord('\t')
+_SLASH           = ord('/')
+_VERTEX          = ord(TOKEN_VERTEX)
+_FACE            = ord(TOKEN_FACE)
+
+def parse(fname, chunk_size=CHUNK_SIZE):
+    vertices, indices = parse_arrays(fname, chunk_size=chunk_size)
+    return TriangleMesh(vertices, indices)
+
+def parse_arrays(fname, chunk_size=CHUNK_SIZE):
+    # Returns the (N,3) vertex array and the (M,3) zero-based triangle index array
+    vertices = [np.zeros((0, 3))]
+    indices  = [np.zeros((0, 3), dtype=np.int64)]
+    for v, f in parse_chunks(fname, chunk_size=chunk_size):
+        vertices.append(v)
+        indices.append(f)
+    return np.concatenate(vertices), np.concatenate(indices)
+
+def parse_chunks(fname, chunk_size=CHUNK_SIZE):
+    # Yields the vertices and triangles (zero-based indices into all vertices read so far) per chunk of lines,
+    # so that arbitrarily large files can be processed with bounded memory
+    nb_vertices = 0
     line_nb = 0
-    vertices = []
-    faces = []
-    with open(fname, 'r') as infile:
-        for line in infile:
-            line_nb += 1
-            if line.startswith(TOKEN_COMMENT):
-                continue
-            parts = line.split()
-            if len(parts) == 0:
-                continue
-            if parts[0] == TOKEN_VERTEX:
-                vertices.append(parse_vertex(parts[1:], line_nb))
-            elif parts[0] == TOKEN_FACE:
-                indices = parse_face(parts[1:], line_nb)
-                faces.append(create_face(vertices, indices))  
-            elif print_unsupported:
-                print(get_line_msg(line_nb, 'Not supported'))
-    return faces
-                
+    with open(fname, 'rb') as infile:
+        rest = b''
+        while True:
+            block = infile.read(chunk_size)
+            if len(block) == 0:
+                if len(rest) == 0:
+                    break
+                block = rest + b'\n'
+                rest = b''
+            else:
+                block = rest + block
+                end = block.rfind(b'\n') + 1
+                block, rest = block[:end], block[end:]
+                if end == 0:
+                    continue
+            vertices, faces, nb_lines = parse_block(block, nb_vertices, line_nb)
+            nb_vertices += vertices.shape[0]
+            line_nb += nb_lines
+            yield vertices, faces
+
+def parse_block(block, nb_vertices=0, line_nb=0):
+    # Parses a block of complete lines (ending with a newline) at once on its bytes
+    buf = np.frombuffer(block, dtype=np.uint8).copy()
+    newline = (buf == _NEWLINE)
+    line = np.cumsum(newline, dtype=np.int32) - newline
+    starts = np.concatenate(([0], np.nonzero(newline)[0][:-1] + 1))
+    nb_lines = starts.shape[0]
+
+    # Classify the lines by their first token (after any leading spaces and tabs)
+    blank = (buf == _SPACE) | (buf == _TAB)
+    firsts = starts
+    if blank[starts].any():
+        firsts = np.minimum.reduceat(np.where(blank, buf.shape[0] - 1, np.arange(buf.shape[0])), starts)
+    c0 = buf[firsts]
+    c1 = buf[np.minimum(firsts + 1, buf.shape[0] - 1)]
+    separated = (c1 == _SPACE) | (c1 == _TAB)
+    is_vertex = (c0 == _VERTEX) & separated
+    is_face   = (c0 == _FACE) & separated
+    if print_unsupported:
+        for k in np.nonzero(~(is_vertex | is_face))[0]:
+            text = block[starts[k]:starts[k] + 64].split(b'\n')[0].strip()
+            if len(text) != 0 and not text.startswith(TOKEN_COMMENT.encode()):
+                print(get_line_msg(line_nb + k + 1, 'Not supported'))
+    buf[firsts[is_vertex | is_face]] = _SPACE
+    whitespace = newline | (buf == _SPACE) | (buf == _TAB) | (buf == _CARRIAGE_RETURN)
+
+    vertex_lines = np.nonzero(is_vertex)[0]
+    vertices = parse_vertices(buf[is_vertex[line]].tobytes(), line_nb + vertex_lines + 1)
+
+    # Number of vertices defined before every face line (for resolving negative indices)
+    face_lines = np.nonzero(is_face)[0]
+    nb_previous = nb_vertices + np.cumsum(is_vertex)[face_lines]
+    mask = is_face[line]
+    faces = parse_faces(buf[mask], whitespace[mask], line[mask], face_lines, nb_previous, line_nb + face_lines + 1)
+    return vertices, faces, nb_lines
+
+def parse_vertices(text, line_nbs):
+    tokens = text.split()
+    if len(tokens) == 3 * line_nbs.shape[0]:
+        return np.array(tokens, dtype=np.float64).reshape((-1, 3))
+    # Lines with a 4th coordinate value (or invalid lines)
+    lines = text.split(b'\n')
+    return np.array([parse_vertex(line.split(), line_nb) for line, line_nb in zip(lines, line_nbs)], dtype=np.float64).reshape((-1, 3))
+
 def parse_vertex(parts, line_nb):
     nb_parts = len(parts)
     if nb_parts < 3 or nb_parts > 4:
         raise ValueError(get_line_msg(line_nb, 'Expected 3 or 4 vertex coordinate values. Received ' + str(nb_parts)))
     if nb_parts == 4 and print_unsupported:
         print(get_line_msg(line_nb, '4th vertex coordinate value not supported'))
-    return np.array(map(float, parts[:3]))
-    
-def parse_face(parts, line_nb):
-    nb_parts = len(parts)
-    if nb_parts != 3 and print_unsupported:
-        print(get_line_msg(line_nb, 'Only triangles are supported'))
-    indices = []
-    for part in parts[:3]:
-        if '//' in part:
-            indices.append(int(part.split('//')[0]))
-        elif '/' in part:
-            indices.append(int(part.split('/')[0]))
-        else:
-            indices.append(int(part))
-    return indices
-    
-def create_face(vertices, indices):
-    v1 = vertices[indices[0]-1]
-    v2 = vertices[indices[1]-1]
-    v3 = vertices[indices[2]-1]
-    return Triangle(v1, v2, v3)
-    
+    return parts[:3]
+
+def parse_faces(buf, whitespace, line, face_lines, nb_previous, line_nbs):
+    # Count the tokens (vertices) per face line
+    token_start = ~whitespace & np.concatenate(([True], whitespace[:-1]))
+    counts = np.bincount(line[token_start], minlength=face_lines[-1] + 1 if face_lines.shape[0] != 0 else 0)[face_lines]
+
+    # Keep the vertex indices only (drop the texture and normal indices following a slash)
+    slash = (buf == _SLASH)
+    slashes = np.cumsum(slash, dtype=np.int32)
+    token = np.cumsum(token_start, dtype=np.int32) - 1
+    slashes_before = (slashes - slash)[token_start]
+    keep = whitespace | (slashes <= slashes_before[np.maximum(token, 0)])
+    indices = np.array(buf[keep].tobytes().split(), dtype=np.int64)
+
+    # Convert to zero-based indices: positive indices are one-based, negative indices are relative to the last vertex
+    line_of_index = np.repeat(np.arange(counts.shape[0]), counts)
+    invalid = (indices == 0) | (indices > nb_previous[line_of_index]) | (indices < -nb_previous[line_of_index])
+    if invalid.any():
+        k = line_of_index[np.argmax(invalid)]
+        raise ValueError(get_line_msg(line_nbs[k], 'Invalid vertex index'))
+    indices = np.where(indices > 0, indices - 1, indices + nb_previous[line_of_index])
+
+    # Triangulate polygons as fans around their first vertex
+    if print_unsupported:
+        for k in np.nonzero(counts < 3)[0]:
+            print(get_line_msg(line_nbs[k], 'Faces with less than 3 vertices are not supported'))
+    nb_triangles = np.maximum(counts - 2, 0)
+    polygon = np.repeat(np.arange(counts.shape[0]), nb_triangles)
+    first = (np.cumsum(counts) - counts)[polygon]
+    k = np.arange(polygon.shape[0]) - np.repeat(np.cumsum(nb_triangles) - nb_triangles, nb_triangles) + 1
+    return np.column_stack((indices[first], indices[first + k], indices[first + k + 1])).reshape((-1, 3))
+
 def get_line_msg(line_nb, msg):
     return 'Line ' + str(line_nb) + ': ' + msg
@@ -1,7 +1,6 @@
 import numpy as np
 
-from math_utils import face_forward
-from ray import Ray
+from ray import RayBatch
 
 ###############################################################################
 ## AmbientOcclusionIntegrator
@@ -16,19 +15,40 @@ class AmbientOcclusionIntegrator(SurfaceIntegrator):
         self.max_distance = max_distance
 
     def Li(self, scene, renderer, ray, isect, sample, rng):
-        n = face_forward(isect.n, -ray.d)
-        nb_clear = 0
-        for i in range(self.nb_samples):
-            axis_w = n
-            axis_u = np.cross(np.array([0.0, 1.0, 0.0]) if np.fabs(axis_w[0]) > 0.1 else np.array([1.0, 0.0, 0.0]), axis_w)
-            axis_v = np.cross(axis_w, axis_u)
-            sample_d = rng.cosine_weighted_uniform_sample_hemisphere()
-            d = (sample_d[0] * axis_u + sample_d[1] * axis_v + sample_d[2] * axis_w)
-            
-            r = Ray(origin=isect.p, direction=d, start=0.01, end=self.max_distance)
-            if not scene.intersect(r):
-                nb_clear += 1
-            ray.stats.scount += r.stats.pcount
-            ray.stats.tcount += r.stats.rcount
-        
-        return np.ones(3) * (float(nb_clear) / self.nb_samples)
+        visibility, stats = self._visibility(scene, isect.p[np.newaxis], isect.n[np.newaxis], ray.d[np.newaxis], rng)
+        ray.stats.scount += int(stats[0,0])
+        ray.stats.tcount += int(stats[0,1])
+        return np.ones(3) * visibility[0]
+
+    def Li_batch(self, scene, renderer, rays, intersections, indices, rng):
+        visibility, stats = self._visibility(scene, intersections.p[indices], intersections.n[indices], rays.d[indices], rng)
+        rays.stats.scount[indices] += stats[:,0]
+        rays.stats.tcount[indices] += stats[:,1]
+        return np.repeat(visibility[:, np.newaxis], 3, axis=1)
+
+    def _visibility(self, scene, p, n, d, rng):
+        # Returns the fraction of unoccluded cosine-weighted directions around each of the given hit points
+        # and the shadow ray statistics (scount, tcount) per hit point
+        count = p.shape[0]
+        axis_w = np.where((np.einsum('ij,ij->i', n, d) > 0.0)[:, np.newaxis], -n, n)
+        axis_u = _orthogonal(axis_w)
+        axis_v = np.cross(axis_w, axis_u)
+
+        # Transform all hemisphere directions to the local frames at once
+        sample_d = rng.cosine_weighted_uniform_sample_hemisphere(size=(count, self.nb_samples))
+        ds = sample_d[:,:,0:1] * axis_u[:, np.newaxis] + sample_d[:,:,1:2] * axis_v[:, np.newaxis] + sample_d[:,:,2:3] * axis_w[:, np.newaxis]
+
+        rays = RayBatch(np.repeat(p, self.nb_samples, axis=0), ds.reshape((-1, 3)), start=0.01, end=self.max_distance)
+        occluded = scene.occluded_batch(rays).reshape((count, self.nb_samples))
+        visibility = 1.0 - np.count_nonzero(occluded, axis=1) / float(self.nb_samples)
+        stats = np.column_stack((rays.stats.scount.reshape((count, -1)).sum(axis=1), rays.stats.rcount.reshape((count, -1)).sum(axis=1)))
+        return visibility, stats
+
+def _orthogonal(w):
+    # Unit vectors orthogonal to the given unit vectors
+    a = np.zeros(w.shape)
+    x_major = np.fabs(w[:,0]) > 0.1
+    a[x_major, 1] = 1.0
+    a[~x_major, 0] = 1.0
+    u = np.cross(a, w)
+    return u / np.sqrt(np.einsum('ij,ij->i', u, u))[:, np.newaxis]
@@ -0,0 +1,181 @@
+import json
+import numpy as np
+import platform
+from time import time
+
+import global_configuration
+
+###############################################################################
+## Scenes
+###############################################################################
+# Every scene family generates (about) nt triangles with the given seed
+from modelgenerator import _cube
+import scenegenerator
+
+def _stratified(nt, seed):
+    # Cubes of 12 triangles in half of the voxels
+    nb_voxels = max(1, int(round((nt / 6.0) ** (1.0 / 3.0))))
+    return scenegenerator.stratified(_cube(), density=0.5, nb_voxels=nb_voxels, seed=seed, scaling=0.2)
+
+SCENES = {
+    'small_spherical' : lambda nt, seed: scenegenerator.small_spherical(nt=nt, seed=seed),
+    'large_spherical' : lambda nt, seed: scenegenerator.large_spherical(nt=nt, seed=seed),
+    'small_gaussian'  : lambda nt, seed: scenegenerator.small_gaussian(nt=nt, seed=seed),
+    'large_gaussian'  : lambda nt, seed: scenegenerator.large_gaussian(nt=nt, seed=seed),
+    'random_vertices' : lambda nt, seed: scenegenerator.random_vertices(nt=nt, seed=seed),
+    'stratified'      : _stratified,
+}
+
+###############################################################################
+## Aggregates
+###############################################################################
+from bvh import BVH
+from group import Group
+from regulargrid import RegularGrid
+from trianglemesh import TriangleMesh
+
+AGGREGATE_TYPES = {'Group' : Group, 'RegularGrid' : RegularGrid, 'BVH' : BVH}
+
+def memory_usage(aggregate):
+    # Bytes of the arrays of the mesh and the acceleration structure
+    meshes = [aggregate.mesh] if hasattr(aggregate, 'mesh') else aggregate.shapes
+    arrays = [array for mesh in meshes for array in (mesh.vertices, mesh.indices, mesh.face_ids)]
+    if hasattr(aggregate, 'get_arrays'):
+        arrays += list(aggregate.get_arrays().values())
+    return int(sum(np.asarray(array).nbytes for array in arrays))
+
+###############################################################################
+## Rays
+###############################################################################
+from ray import Intersection, IntersectionBatch, RayBatch
+from sampling import Sampler3D
+import stats
+
+def create_primary_rays(bounds, nb_rays, seed):
+    # Rays from points on a sphere around the scene towards points within the inner half of its bounding sphere
+    sampler = Sampler3D(seed=seed)
+    sphere = bounds.bounding_sphere()
+    origins = sampler.uniform_sample_sphere(center=sphere.c, radius=2.0 * sphere.r, size=nb_rays)
+    targets = sampler.uniform_sample_within_sphere(center=sphere.c, radius=0.5 * sphere.r, size=nb_rays)
+    return RayBatch(origins, targets - origins)
+
+def create_shadow_rays(bounds, nb_rays, seed):
+    # Segments from points within the bounding sphere of the scene towards (light) points on a sphere around the scene
+    sampler = Sampler3D(seed=seed)
+    sphere = bounds.bounding_sphere()
+    origins = sampler.uniform_sample_within_sphere(center=sphere.c, radius=sphere.r, size=nb_rays)
+    targets = sampler.uniform_sample_sphere(center=sphere.c, radius=2.0 * sphere.r, size=nb_rays)
+    rays = RayBatch(origins, targets - origins)
+    rays.tMax = np.sqrt(np.sum((targets - origins) ** 2, axis=1))
+    return rays
+
+###############################################################################
+## Benchmark
+###############################################################################
+def benchmark_rays(aggregate, rays, shadow, nb_scalar_rays, repeat):
+    # Batched and scalar traversal of (copies of) the given rays; returns the statistics as a dict.
+    # The timed runs do not gather traversal statistics, an extra batched run does.
+    def trace(batch):
+        if shadow:
+            return aggregate.occluded_batch(batch)
+        return aggregate.intersect_batch(batch, IntersectionBatch(len(batch)))
+
+    was_enabled = stats.enabled
+    stats.disable()
+    best = np.inf
+    for _ in range(repeat):
+        batch = rays.__deepcopy__()
+        start = time()
+        hits = trace(batch)
+        best = min(best, time() - start)
+
+    stats.enable()
+    stats.reset()
+    batch = rays.__deepcopy__()
+    trace(batch)
+    tests = batch.stats.scount if shadow else batch.stats.pcount
+    result = {'rays' : len(rays), 'hits' : int(np.count_nonzero(hits)),
+              'batch_time' : best, 'batch_rays_per_second' : len(rays) / max(best, 1e-9),
+              'tests_per_ray' : float(np.mean(tests)) if len(rays) != 0 else 0.0,
+              'traversal' : stats.totals()}
+    if not was_enabled:
+        stats.disable()
+
+    nb_scalar_rays = min(nb_scalar_rays, len(rays))
+    if nb_scalar_rays > 0:
+        best = np.inf
+        for _ in range(repeat):
+            scalar = [rays[k] for k in range(nb_scalar_rays)]
+            start = time()
+            for ray in scalar:
+                if shadow:
+                    aggregate.occluded(ray)
+                else:
+                    aggregate.intersect(ray, Intersection())
+            best = min(best, time() - start)
+        result.update({'scalar_rays' : nb_scalar_rays, 'scalar_time' : best, 'scalar_rays_per_second' : nb_scalar_rays / max(best, 1e-9)})
+    return result
+
+def benchmark(scenes=sorted(SCENES), nts=[1024], aggregates=sorted(AGGREGATE_TYPES), nb_rays=4096, nb_scalar_rays=256, seed=0, repeat=1, trace_memory=False):
+    # Builds every aggregate type over every scene family at every triangle count and traces the same primary and shadow rays;
+    # returns the results as a JSON serializable dict
+    results = []
+    for name in scenes:
+        for nt in nts:
+            mesh = TriangleMesh().append(SCENES[name](nt, seed).get_shapes())
+            primary_rays = create_primary_rays(mesh.bounds(), nb_rays, seed)
+            shadow_rays  = create_shadow_rays(mesh.bounds(), nb_rays, seed + 1)
+            for aggregate_name in aggregates:
+                print('Benchmarking %s (%d triangles) with %s' % (name, len(mesh), aggregate_name))
+                start = time()
+                aggregate = AGGREGATE_TYPES[aggregate_name]([mesh])
+                result = {'scene' : name, 'nt' : nt, 'triangles' : len(mesh), 'aggregate' : aggregate_name,
+                          'build_time' : time() - start, 'memory_bytes' : memory_usage(aggregate)}
+                if trace_memory:
+                    result['build_peak_bytes'] = _build_peak_memory(AGGREGATE_TYPES[aggregate_name], mesh)
+                result['primary'] = benchmark_rays(aggregate, primary_rays, False, nb_scalar_rays, repeat)
+                result['shadow']  = benchmark_rays(aggregate, shadow_rays, True, nb_scalar_rays, repeat)
+                results.append(result)
+
+    info = {'python' : platform.python_version(), 'numpy' : np.__version__, 'platform' : platform.platform(),
+            'nb_cpus' : global_configuration.nb_cpus(), 'version' : _version()}
+    parameters = {'nb_rays' : nb_rays, 'nb_scalar_rays' : nb_scalar_rays, 'seed' : seed, 'repeat' : repeat}
+    return {'info' : info, 'parameters' : parameters, 'results' : results}
+
+def _build_peak_memory(aggregate_type, mesh):
+    # Peak of the memory allocated while building (tracing slows down the build, so it is measured in a separate build)
+    import tracemalloc
+    tracemalloc.start()
+    aggregate_type([mesh])
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return peak
+
+def _version():
+    # Commit of the working tree (None outside a git repository)
+    import os
+    import subprocess
+    try:
+        return subprocess.check_output(['git', 'describe', '--always', '--dirty'], cwd=os.path.dirname(os.path.abspath(__file__)), stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='Benchmarks the acceleration structures on the MacDonald & Booth scene families.')
+    parser.add_argument('--scenes', nargs='+', choices=sorted(SCENES), default=sorted(SCENES))
+    parser.add_argument('--nt', nargs='+', type=int, default=[1024], help='numbers of triangles')
+    parser.add_argument('--aggregates', nargs='+', choices=sorted(AGGREGATE_TYPES), default=sorted(AGGREGATE_TYPES))
+    parser.add_argument('--rays', type=int, default=4096, help='number of primary and of shadow rays')
+    parser.add_argument('--scalar-rays', type=int, default=256, help='number of rays also traced one at a time')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--repeat', type=int, default=1, help='number of timed runs (the fastest is reported)')
+    parser.add_argument('--trace-memory', action='store_true', help='also measure the peak memory of the builds')
+    # Progress is printed to stdout, so the report is always written to a file
+    parser.add_argument('-o', '--output', default='benchmark.json', help='JSON file')
+    args = parser.parse_args()
+
+    report = benchmark(scenes=args.scenes, nts=args.nt, aggregates=args.aggregates, nb_rays=args.rays, nb_scalar_rays=args.scalar_rays,
+                       seed=args.seed, repeat=args.repeat, trace_memory=args.trace_memory)
+    with open(args.output, 'w') as outfile:
+        json.dump(report, outfile, indent=2)
@@ -0,0 +1,303 @@
+import numpy as np
+
+NB_BUCKETS = 12
+MAX_PRIMS_IN_NODE = 4
+
+###############################################################################
+## BVH
+###############################################################################
+from aggregate import Aggregate
+from nAABB import NAABB
+from ray import IntersectionBatch
+import stats
+from trianglemesh import split_triangles
+
+class BVH(Aggregate):
+    '''
+    Bounding volume hierarchy built with the binned surface area heuristic.
+    The nodes are stored depth-first in flat arrays: the first child of an
+    interior node directly follows its parent, node_offset holds the index of
+    the second child. Leaves reference node_count primitives starting at
+    node_offset in prims. Triangles are gathered into one TriangleMesh whose
+    faces are the primitives [0, nb_faces); the other shapes follow.
+    '''
+
+    def __init__(self, shapes=[], max_prims_in_node=MAX_PRIMS_IN_NODE, i=None, color='k'):
+        self.max_prims_in_node = max_prims_in_node
+        super(BVH, self).__init__(shapes=shapes, i=i, color=color)
+
+    def _update(self):
+        self._build()
+
+    def _build(self):
+        self.mesh, self.others = split_triangles(self.shapes)
+        self.nb_faces = len(self.mesh)
+
+        # Primitive bounds and centroids
+        prim_min, prim_max = self.mesh.face_bounds()
+        if len(self.others) != 0:
+            bounds = [shape.bounds() for shape in self.others]
+            prim_min = np.concatenate((prim_min, [b.pMin for b in bounds]))
+            prim_max = np.concatenate((prim_max, [b.pMax for b in bounds]))
+        centroids = 0.5 * (prim_min + prim_max)
+
+        self.prims = np.arange(prim_min.shape[0], dtype=np.int64)
+        node_min, node_max, node_offset, node_count, node_axis = [], [], [], [], []
+
+        # Depth-first construction: (start, end, index of the parent whose second child this is)
+        todo = [(0, self.prims.shape[0], -1)] if self.prims.shape[0] != 0 else []
+        while len(todo) != 0:
+            start, end, parent = todo.pop()
+            node = len(node_count)
+            if parent >= 0:
+                node_offset[parent] = node
+            prims = self.prims[start:end]
+            node_min.append(prim_min[prims].min(axis=0))
+            node_max.append(prim_max[prims].max(axis=0))
+
+            mid, axis = self._split(prims, prim_min, prim_max, centroids)
+            if mid is None:
+                node_offset.append(start)
+                node_count.append(end - start)
+                node_axis.append(0)
+            else:
+                node_offset.append(-1)
+                node_count.append(0)
+                node_axis.append(axis)
+                todo.append((start + mid, end, node))
+                todo.append((start, start + mid, -1))
+
+        self.node_min    = np.array(node_min).reshape((-1, 3))
+        self.node_max    = np.array(node_max).reshape((-1, 3))
+        self.node_offset = np.array(node_offset, dtype=np.int64)
+        self.node_count  = np.array(node_count, dtype=np.int64)
+        self.node_axis   = np.array(node_axis, dtype=np.int64)
+        self._update_leaves()
+
+    def _split(self, prims, prim_min, prim_max, centroids):
+        # Returns the number of primitives of the first child (None: create a leaf) and the split axis.
+        # prims (a view into self.prims) is reordered in place.
+        count = prims.shape[0]
+        if count <= 1:
+            return None, 0
+        c = centroids[prims]
+        c_min = c.min(axis=0)
+        c_max = c.max(axis=0)
+        axis = int(np.argmax(c_max - c_min))
+        if c_max[axis] == c_min[axis]:
+            if count <= self.max_prims_in_node:
+                return None, 0
+            return count // 2, axis
+
+        # Bin the primitive centroids
+        b = (NB_BUCKETS * (c[:,axis] - c_min[axis]) / (c_max[axis] - c_min[axis])).astype(np.int64)
+        b = np.minimum(b, NB_BUCKETS - 1)
+        counts = np.bincount(b, minlength=NB_BUCKETS)
+        b_min = np.full((NB_BUCKETS, 3),  np.inf)
+        b_max = np.full((NB_BUCKETS, 3), -np.inf)
+        np.minimum.at(b_min, b, prim_min[prims])
+        np.maximum.at(b_max, b, prim_max[prims])
+
+        # Compute costs for splitting after each bucket
+        def surface_areas(pMin, pMax):
+            d = np.maximum(pMax - pMin, 0.0)
+            return 2.0 * (d[:,0] * d[:,1] + d[:,0] * d[:,2] + d[:,1] * d[:,2])
+        sa_left  = surface_areas(np.minimum.accumulate(b_min)[:-1], np.maximum.accumulate(b_max)[:-1])
+        sa_right = surface_areas(np.minimum.accumulate(b_min[::-1])[::-1][1:], np.maximum.accumulate(b_max[::-1])[::-1][1:])
+        n_left   = np.cumsum(counts)[:-1]
+        n_right  = count - n_left
+        sa_node  = surface_areas(prim_min[prims].min(axis=0)[np.newaxis], prim_max[prims].max(axis=0)[np.newaxis])[0]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            cost = 0.125 + (n_left * sa_left + n_right * sa_right) / sa_node
+        cost[(n_left == 0) | (n_right == 0) | np.isnan(cost)] = np.inf
+        best = int(np.argmin(cost))
+
+        # Either create a leaf or split at the selected SAH bucket
+        if count <= self.max_prims_in_node and not cost[best] < count:
+            return None, 0
+        if not np.isfinite(cost[best]):
+            order = np.argsort(c[:,axis], kind='stable')
+            prims[:] = prims[order]
+            return count // 2, axis
+        left = b <= best
+        prims[:] = np.concatenate((prims[left], prims[~left]))
+        return int(np.count_nonzero(left)), axis
+
+    def _update_leaves(self):
+        # Per leaf: the mesh faces and the other shapes it references
+        self._leaf_faces  = [None] * self.node_count.shape[0]
+        self._leaf_shapes = [None] * self.node_count.shape[0]
+        leaves = np.nonzero(self.node_count)[0]
+        starts = self.node_offset[leaves]
+        for node, start, end in zip(leaves.tolist(), starts.tolist(), (starts + self.node_count[leaves]).tolist()):
+            prims = self.prims[start:end]
+            if len(self.others) == 0:
+                self._leaf_faces[node]  = prims
+                self._leaf_shapes[node] = []
+            else:
+                self._leaf_faces[node]  = prims[prims < self.nb_faces]
+                self._leaf_shapes[node] = [self.others[p - self.nb_faces] for p in prims[prims >= self.nb_faces]]
+        self._nodes = list(zip(self.node_min.tolist(), self.node_max.tolist(), self.node_offset.tolist(), self.node_count.tolist(), self.node_axis.tolist()))
+
+    def get_arrays(self):
+        # The arrays defining the built hierarchy (besides the mesh), e.g. for caching
+        if len(self.others) != 0:
+            raise ValueError('Only hierarchies of triangles can be stored as arrays')
+        return {'node_min' : self.node_min, 'node_max' : self.node_max, 'node_offset' : self.node_offset,
+                'node_count' : self.node_count, 'node_axis' : self.node_axis, 'prims' : self.prims}
+
+    def set_arrays(self, mesh, arrays):
+        # Restores a hierarchy over the given mesh from the arrays returned by get_arrays without rebuilding it
+        self.shapes = [mesh]
+        self.mesh = mesh
+        self.others = []
+        self.nb_faces = len(mesh)
+        self.node_min    = arrays['node_min']
+        self.node_max    = arrays['node_max']
+        self.node_offset = arrays['node_offset']
+        self.node_count  = arrays['node_count']
+        self.node_axis   = arrays['node_axis']
+        self.prims       = arrays['prims']
+        self._update_leaves()
+        return self
+
+    def bounds(self):
+        if self.node_count.shape[0] == 0:
+            return NAABB(N=3)
+        return NAABB(self.node_min[0].copy(), self.node_max[0].copy())
+
+    def intersect(self, ray, isect=None):
+        return self._traverse(ray, isect, None)
+
+    def occluded(self, ray):
+        return self._traverse(ray, None, None)
+
+    def intersect_exclusive(self, excl, ray, isect=None):
+        if self.id in excl:
+            return False
+        return self._traverse(ray, isect, excl)
+
+    def _traverse(self, ray, isect, excl):
+        if len(self._nodes) == 0:
+            return False
+        o = ray.o.tolist()
+        with np.errstate(divide='ignore'):
+            inv_d = (1.0 / ray.d).tolist()
+        dir_is_neg = [v < 0.0 for v in inv_d]
+
+        # Visit the nodes front to back
+        hit = False
+        todo = [0]
+        while len(todo) != 0:
+            node = todo.pop()
+            b_min, b_max, offset, count, axis = self._nodes[node]
+            if __debug__ and stats.enabled:
+                stats.count_tests(ray, stats.NODE_VISITS, closest=isect is not None)
+            if not _intersect_node(b_min, b_max, o, inv_d, ray.tMin, ray.tMax):
+                continue
+            if count > 0:
+                if self._intersect_leaf(node, ray, isect, excl):
+                    hit = True
+                    if isect is None:
+                        # Any hit suffices for shadow rays
+                        return True
+            elif dir_is_neg[axis]:
+                todo.append(node + 1)
+                todo.append(offset)
+            else:
+                todo.append(offset)
+                todo.append(node + 1)
+        return hit
+
+    def _intersect_leaf(self, node, ray, isect, excl):
+        faces = self._leaf_faces[node]
+        if excl is not None and faces.shape[0] != 0:
+            faces = faces[~np.isin(self.mesh.face_ids[faces], list(excl))]
+        hit = faces.shape[0] != 0 and self.mesh.intersect_faces(faces, ray, isect=isect)
+        if hit and isect is None:
+            return True
+        for shape in self._leaf_shapes[node]:
+            if excl is None:
+                hit_shape = shape.intersect(ray, isect) if isect is not None else shape.occluded(ray)
+            else:
+                hit_shape = shape.intersect_exclusive(excl, ray, isect)
+            if hit_shape:
+                hit = True
+                if isect is None:
+                    return True
+        return hit
+
+    def intersect_batch(self, rays, isects=None):
+        hits = np.zeros((len(rays)), dtype=bool)
+        if len(self._nodes) == 0 or len(rays) == 0:
+            return hits
+        with np.errstate(divide='ignore'):
+            inv_d = 1.0 / rays.d
+
+        # Visit the nodes with the subset of rays that reached them
+        todo = [(0, np.arange(len(rays)))]
+        while len(todo) != 0:
+            node, idx = todo.pop()
+            if isects is None:
+                # Occluded rays are done
+                idx = idx[~hits[idx]]
+            if idx.shape[0] == 0:
+                continue
+            if __debug__ and stats.enabled:
+                stats.count_batch_tests(rays, stats.NODE_VISITS, closest=isects is not None, indices=idx)
+            with np.errstate(invalid='ignore'):
+                t0 = (self.node_min[node] - rays.o[idx]) * inv_d[idx]
+                t1 = (self.node_max[node] - rays.o[idx]) * inv_d[idx]
+                t_near = np.fmax(np.fmin(t0, t1).max(axis=1), rays.tMin[idx])
+                t_far  = np.fmin(np.fmax(t0, t1).min(axis=1), rays.tMax[idx])
+            idx = idx[t_near <= t_far]
+            if idx.shape[0] == 0:
+                continue
+
+            if self.node_count[node] > 0:
+                sub = rays.subset(idx)
+                sub_isects = None if isects is None else IntersectionBatch(idx.shape[0])
+                sub_hits = np.zeros((idx.shape[0]), dtype=bool)
+                faces = self._leaf_faces[node]
+                if faces.shape[0] != 0:
+                    sub_hits |= self.mesh.intersect_faces_batch(faces, sub, isects=sub_isects)
+                for shape in self._leaf_shapes[node]:
+                    if isects is None:
+                        sub_hits |= shape.occluded_batch(sub)
+                    else:
+                        sub_hits |= shape.intersect_batch(sub, sub_isects)
+                rays.merge(idx, sub)
+                hits[idx] |= sub_hits
+                if isects is not None:
+                    isects.merge(idx, sub_isects)
+            else:
+                # Visit the child the majority of the rays reach first
+                first, second = node + 1, self.node_offset[node]
+                if np.count_nonzero(rays.d[idx, self.node_axis[node]] < 0.0) * 2 > idx.shape[0]:
+                    first, second = second, first
+                todo.append((second, idx))
+                todo.append((first, idx))
+        return hits
+
+    def occluded_batch(self, rays):
+        return self.intersect_batch(rays)
+
+    def accept(self, visitor, bvh=False, **kwargs):
+        super(BVH, self).accept(visitor)
+        if bvh:
+            for node in range(self.node_count.shape[0]):
+                NAABB(self.node_min[node], self.node_max[node], color=self.color).accept(visitor)
+
+def _intersect_node(b_min, b_max, o, inv_d, t_min, t_max):
+    for axis in range(3):
+        t_near = (b_min[axis] - o[axis]) * inv_d[axis]
+        t_far  = (b_max[axis] - o[axis]) * inv_d[axis]
+        if t_near > t_far:
+            t_near, t_far = t_far, t_near
+        if t_near > t_min:
+            t_min = t_near
+        if t_far < t_max:
+            t_max = t_far
+        if t_min > t_max:
+            return False
+    return True
@@ -1,3 +1,5 @@
+import numpy as np
+from math_utils import normalize_rows
 from transform import look_at, scale, translate
 
 ###############################################################################
@@ -12,6 +14,8 @@ def cam2world(pos, look, up, T=scale(-1.0, 1.0, 1.0)):
 from abc import ABCMeta, abstractmethod
 from entity import Entity
 from logger import logger
+from ray import Ray, RayBatch
+from sampler import CameraSample
 
 class Camera(Entity):
 
@@ -39,11 +43,11 @@ class Camera(Entity):
         return 3
        
     @abstractmethod
-    def generate_ray(self, sample):
+    def generate_ray(self, sample, ray=None):
         return
 
-    def generate_ray_differential(self, sample):
-        w, ray = self.generate_ray(sample)
+    def generate_ray_differential(self, sample, ray=None):
+        w, ray = self.generate_ray(sample, ray)
         
         shift = sample.__copy__()
         
@@ -62,6 +66,22 @@ class Camera(Entity):
             
         ray.set_differentials(ray_x.o, ray_x.d, ray_y.o, ray_y.d)
         return w, ray
+
+    def generate_ray_batch(self, image_xy, lens_uv, time):
+        # Fallback: generate the rays of the batch one at a time
+        count = image_xy.shape[0]
+        weights = np.zeros((count))
+        origins = np.zeros((count, 3))
+        directions = np.zeros((count, 3))
+        sample = CameraSample()
+        for k in range(count):
+            sample.image_x, sample.image_y = image_xy[k]
+            sample.lens_u, sample.lens_v = lens_uv[k]
+            sample.time = time[k]
+            weights[k], ray = self.generate_ray(sample)
+            origins[k] = ray.o
+            directions[k] = ray.d
+        return weights, RayBatch(origins, directions, time=time)
     
 ###############################################################################
 ## ProjectiveCamera
@@ -82,3 +102,97 @@ class ProjectiveCamera(Camera):
         self.screen_to_raster = sc1 * sc2 * tr
         self.raster_to_screen = self.screen_to_raster.inverse()
         self.raster_to_camera = self.camera_to_screen.inverse() * self.raster_to_screen
+
+        # Camera space offsets of a shift of one pixel in the x and y direction
+        self.dx_camera = self.raster_to_camera(np.array([1.0, 0.0, 0.0]), is_point=True) - self.raster_to_camera(np.array([0.0, 0.0, 0.0]), is_point=True)
+        self.dy_camera = self.raster_to_camera(np.array([0.0, 1.0, 0.0]), is_point=True) - self.raster_to_camera(np.array([0.0, 0.0, 0.0]), is_point=True)
+
+    @abstractmethod
+    def camera_rays(self, p_camera):
+        # Camera space origins and (not necessarily normalized) directions of the rays through the given (N,3)
+        # camera space points on the image plane
+        return
+
+    def generate_rays(self, image_xy, lens_uv, time, differentials=True):
+        # Generates the world space rays of N samples at once: returns the weights, origins, directions and
+        # (if differentials) the origins and directions of the rays shifted one pixel in x and y: (x_o, x_d, y_o, y_d)
+        count = image_xy.shape[0]
+        p_ras = np.zeros((count, 3))
+        p_ras[:,:2] = image_xy
+        p_camera = self.raster_to_camera(p_ras, is_point=True)
+        if differentials:
+            # The shifted rays are generated together with the rays themselves
+            p_camera = np.concatenate((p_camera, p_camera + self.dx_camera, p_camera + self.dy_camera))
+        o, d = self.camera_rays(p_camera)
+        d = normalize_rows(d)
+
+        # Modify rays for depth of field
+        if self.lens_radius > 0.0:
+            # Sample points on lens
+            # (imported here: the tests of sampling import the visitors, which import this module)
+            from sampling import concentric_sample_disk_batch
+            p_lens = np.zeros((count, 3))
+            p_lens[:,:2] = self.lens_radius * concentric_sample_disk_batch(lens_uv[:,0], lens_uv[:,1])
+            if differentials:
+                p_lens = np.concatenate((p_lens, p_lens, p_lens))
+
+            # Compute points on plane of focus
+            ft = self.focal_distance / d[:,2]
+            p_focus = o + ft[:, np.newaxis] * d
+
+            # Update rays for effect of lens
+            o = o + p_lens
+            d = normalize_rows(p_focus - o)
+
+        # Transform all origins and directions to world space at once
+        o = self.camera_to_world(o, is_point=True)
+        d = self.camera_to_world(d, is_direction=True)
+        weights = np.ones((count))
+        if not differentials:
+            return weights, o, d, None
+        return weights, o[:count], d[:count], (o[count:2*count], d[count:2*count], o[2*count:], d[2*count:])
+
+    def _generate_sample_rays(self, sample, differentials):
+        # Scalar counterpart of generate_rays: returns the world space origins and directions of the ray of the given sample
+        # and (if differentials) of the rays shifted one pixel in x and y, as a (1,3) or (3,3) batch
+        p = self.raster_to_camera.m.dot(np.array([sample.image_x, sample.image_y, 0.0, 1.0]))
+        p_camera = p[:3] / p[3]
+        if differentials:
+            p_camera = np.array([p_camera, p_camera + self.dx_camera, p_camera + self.dy_camera])
+        else:
+            p_camera = p_camera[np.newaxis]
+        o, d = self.camera_rays(p_camera)
+        d = normalize_rows(d)
+
+        # Modify rays for depth of field
+        if self.lens_radius > 0.0:
+            # (imported here: the tests of sampling import the visitors, which import this module)
+            from sampling import concentric_sample_disk
+            lens_u, lens_v = concentric_sample_disk(sample.lens_u, sample.lens_v)
+            p_lens = np.array([self.lens_radius * lens_u, self.lens_radius * lens_v, 0.0])
+            ft = self.focal_distance / d[:,2]
+            p_focus = o + ft[:, np.newaxis] * d
+            o = o + p_lens
+            d = normalize_rows(p_focus - o)
+
+        return self.camera_to_world(o, is_point=True), self.camera_to_world(d, is_direction=True)
+
+    def generate_ray(self, sample, ray=None):
+        # The ray (if given) is reinitialized instead of allocating a new one
+        o, d = self._generate_sample_rays(sample, differentials=False)
+        if ray is None:
+            return 1.0, Ray(o[0], d[0], time=sample.time)
+        return 1.0, ray.reset(o[0], d[0], time=sample.time)
+
+    def generate_ray_differential(self, sample, ray=None):
+        o, d = self._generate_sample_rays(sample, differentials=True)
+        if ray is None:
+            ray = Ray(o[0], d[0], time=sample.time)
+        else:
+            ray.reset(o[0], d[0], time=sample.time)
+        ray.set_differentials(o[1], d[1], o[2], d[2])
+        return 1.0, ray
+
+    def generate_ray_batch(self, image_xy, lens_uv, time):
+        weights, o, d, _ = self.generate_rays(image_xy, lens_uv, time, differentials=False)
+        return weights, RayBatch(o, d, time=time)
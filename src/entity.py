@@ -6,6 +6,9 @@ from abc import ABCMeta, abstractmethod
 class Entity(object):
     
     __metaclass__ = ABCMeta
+
+    # Subclasses without __slots__ of their own still get a __dict__
+    __slots__ = ('color',)
     
     def __init__(self, color='k'):
         self.color = color
@@ -4,6 +4,7 @@ from abc import ABCMeta, abstractmethod
 ## TriangleVisitor
 ###############################################################################
 from triangle import Triangle
+from trianglemesh import TriangleMesh
 
 class TriangleVisitor(object):
     
@@ -12,6 +13,8 @@ class TriangleVisitor(object):
     def visit(self, entity):
         if isinstance(entity, Triangle):
             return self.visit_triangle(entity)
+        elif isinstance(entity, TriangleMesh):
+            return self.visit_triangle_mesh(entity)
         else: 
              raise NotImplementedError(type(entity))
     
@@ -19,6 +22,10 @@ class TriangleVisitor(object):
     def visit_triangle(self, entity):
         return
 
+    def visit_triangle_mesh(self, entity):
+        for triangle in entity.get_shapes():
+            self.visit_triangle(triangle)
+
 ###############################################################################
 ## ShapeVisitor
 ###############################################################################
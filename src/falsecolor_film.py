@@ -1,55 +1,74 @@
+import cv2
+from math import floor
 import numpy as np
+import os
+
+# Per-ray statistics accumulated by the false color films (in the order of the counter arrays)
+COUNTERS = ('pcount', 'scount', 'rcount', 'tcount')
 
 ###############################################################################
-## ImageFilm
+## FalseColorFilmTile
 ###############################################################################
 from film import Film
 
-class FalseColorFilm(Film):
-    
-    def __init__(self, x_res=640, y_res=480, crop_window=np.array([0.0, 1.0, 0.0, 1.0]), fname='pbrtpy.png'):
-        super(FalseColorFilm, self).__init__(x_res, y_res)
-        self.fname = fname
+class FalseColorFilmTile(Film):
+    '''
+    Counter arrays of a window of a FalseColorFilm. The per-ray statistics
+    of each sample are added to the pixel containing the sample.
+    '''
 
-        # Compute film image extent
-        self.x_pixel_start = int(np.ceil(self.x_resolution * crop_window[0]))
-        self.x_pixel_count = max(1, int(np.ceil(self.x_resolution * crop_window[1]) - self.x_pixel_start))
-        self.y_pixel_start = int(np.ceil(self.y_resolution * crop_window[2]))
-        self.y_pixel_count = max(1, int(np.ceil(self.y_resolution * crop_window[3]) - self.y_pixel_start))
-        if self.x_pixel_count>self.x_resolution:
-            raise ValueError
-        if self.y_pixel_count>self.y_resolution:
-            raise ValueError
+    def __init__(self, x_res, y_res, x_pixel_start, x_pixel_count, y_pixel_start, y_pixel_count):
+        super(FalseColorFilmTile, self).__init__(x_res, y_res)
+        self.x_pixel_start = x_pixel_start
+        self.x_pixel_count = x_pixel_count
+        self.y_pixel_start = y_pixel_start
+        self.y_pixel_count = y_pixel_count
+
+        # Allocate counter storage (indexed by [counter,y,x] relative to the pixel start)
+        self.counts       = np.zeros((len(COUNTERS), self.y_pixel_count, self.x_pixel_count), dtype=np.int64)
+        self.sample_count = np.zeros((self.y_pixel_count, self.x_pixel_count), dtype=np.int64)
 
-        # Allocate film image storage
-        self.pixels  = np.empty((self.x_pixel_count, self.y_pixel_count), dtype=FalseColorPixel)
-        for i in range(self.x_pixel_count):
-            for j in range(self.y_pixel_count):
-                self.pixels[i,j] = FalseColorPixel()
-        
     def add_sample(self, sample, L, ray):
-        d_image_x = sample.image_x - 0.5
-        d_image_y = sample.image_y - 0.5
-        x0 = int(np.ceil(d_image_x - 0.5))
-        x1 = int(d_image_x + 0.5)
-        y0 = int(np.ceil(d_image_y - 0.5))
-        y1 = int(d_image_y + 0.5)
-        x0 = max(x0, self.x_pixel_start)
-        x1 = min(x1, self.x_pixel_start + self.x_pixel_count - 1)
-        y0 = max(y0, self.y_pixel_start)
-        y1 = min(y1, self.y_pixel_start + self.y_pixel_count - 1)
-        if ((x1-x0)<0) or ((y1-y0)<0):
+        if ray is None:
+            return
+        x = int(floor(sample.image_x)) - self.x_pixel_start
+        y = int(floor(sample.image_y)) - self.y_pixel_start
+        if (0 <= x < self.x_pixel_count) and (0 <= y < self.y_pixel_count):
+            for c, name in enumerate(COUNTERS):
+                self.counts[c,y,x] += getattr(ray.stats, name)
+            self.sample_count[y,x] += 1
+
+    def add_samples(self, image_xy, Ls, rays=None):
+        if rays is None:
             return
-            
-        for x in range(x0, x1+1):
-            for y in range(y0, y1+1):
-                self.pixels[x,y].update(ray)
+        counts = np.column_stack([getattr(rays.stats, name) for name in COUNTERS]).astype(np.int64)
+        self._add_counts(image_xy, counts)
+
+    def _add_counts(self, image_xy, counts):
+        x = np.floor(image_xy[:,0]).astype(np.int64) - self.x_pixel_start
+        y = np.floor(image_xy[:,1]).astype(np.int64) - self.y_pixel_start
+        valid = (x >= 0) & (x < self.x_pixel_count) & (y >= 0) & (y < self.y_pixel_count)
+        nb_valid = np.count_nonzero(valid)
+        if nb_valid == 0:
+            return
+        size = self.y_pixel_count * self.x_pixel_count
+        if 4 * nb_valid < size:
+            # Scatter-add the samples (linear in the number of samples)
+            pixels = (y[valid], x[valid])
+            np.add.at(self.counts, (slice(None),) + pixels, counts[valid].T)
+            np.add.at(self.sample_count, pixels, 1)
+        else:
+            # Histograms over the flat pixel indices (linear in the number of pixels, but faster for large batches)
+            pixels = y[valid] * self.x_pixel_count + x[valid]
+            for c in range(len(COUNTERS)):
+                self.counts[c].ravel()[:] += np.bincount(pixels, weights=counts[valid,c], minlength=size).astype(np.int64)
+            self.sample_count.ravel()[:] += np.bincount(pixels, minlength=size)
 
     def get_sample_extent(self):
         x_start = self.x_pixel_start
-        x_end   = self.x_pixel_start + self.x_pixel_count + 1
+        x_end   = self.x_pixel_start + self.x_pixel_count
         y_start = self.y_pixel_start
-        y_end   = self.y_pixel_start + self.y_pixel_count + 1
+        y_end   = self.y_pixel_start + self.y_pixel_count
         return x_start, x_end, y_start, y_end
 
     def get_pixel_extent(self):
@@ -60,34 +79,82 @@ class FalseColorFilm(Film):
         return x_start, x_end, y_start, y_end
 
     def write_image(self, splat_scale=1.0):
-        pD = np.zeros((self.x_pixel_count, self.y_pixel_count), dtype=np.int64)
-        sD = np.zeros((self.x_pixel_count, self.y_pixel_count), dtype=np.int64)
-        rD = np.zeros((self.x_pixel_count, self.y_pixel_count), dtype=np.int64)
-        tD = np.zeros((self.x_pixel_count, self.y_pixel_count), dtype=np.int64)
-        for x in range(self.x_pixel_count):
-            for y in range(self.y_pixel_count):
-                pixel   = self.pixels[x,y]
-                pD[x,y] = pixel.pcount
-                sD[x,y] = pixel.scount
-                rD[x,y] = pixel.rcount
-                tD[x,y] = pixel.tcount
-        np.savetxt(self.fname + '-p.falsecolor', np.transpose(pD), fmt='%i') 
-        np.savetxt(self.fname + '-s.falsecolor', np.transpose(sD), fmt='%i')
-        np.savetxt(self.fname + '-r.falsecolor', np.transpose(rD), fmt='%i')
-        np.savetxt(self.fname + '-t.falsecolor', np.transpose(tD), fmt='%i')   
-        
+        return
+
+###############################################################################
+## FalseColorFilm
 ###############################################################################
-## FalseColorPixel
-###############################################################################      
-class FalseColorPixel(object):
-    def __init__(self):
-        self.pcount = 0
-        self.scount = 0
-        self.rcount = 0
-        self.tcount = 0
-        
-    def update(self, ray):
-        self.pcount += ray.stats.pcount
-        self.scount += ray.stats.scount
-        self.rcount += ray.stats.rcount
-        self.tcount += ray.stats.tcount
+from threading import Lock
+
+class FalseColorFilm(FalseColorFilmTile):
+    '''
+    Accumulates the per-ray traversal statistics of the samples per pixel.
+    The counters are written as a compressed .npz archive and, optionally,
+    as a colour-mapped PNG heatmap of the traversal cost per sample.
+    '''
+
+    def __init__(self, x_res=640, y_res=480, crop_window=np.array([0.0, 1.0, 0.0, 1.0]), fname='pbrtpy.png', heatmap=True, colormap=cv2.COLORMAP_INFERNO):
+        self.fname = fname
+        self.heatmap = heatmap
+        self.colormap = colormap
+
+        # Compute film image extent
+        x_pixel_start = int(np.ceil(x_res * crop_window[0]))
+        x_pixel_count = max(1, int(np.ceil(x_res * crop_window[1]) - x_pixel_start))
+        y_pixel_start = int(np.ceil(y_res * crop_window[2]))
+        y_pixel_count = max(1, int(np.ceil(y_res * crop_window[3]) - y_pixel_start))
+        if x_pixel_count>x_res:
+            raise ValueError
+        if y_pixel_count>y_res:
+            raise ValueError
+
+        # The film is the tile of its whole pixel extent
+        super(FalseColorFilm, self).__init__(x_res, y_res, x_pixel_start, x_pixel_count, y_pixel_start, y_pixel_count)
+        self.lock = Lock()
+
+    def add_samples(self, image_xy, Ls, rays=None):
+        # Samples added directly to the film (rather than to a tile) may come from several threads
+        with self.lock:
+            super(FalseColorFilm, self).add_samples(image_xy, Ls, rays)
+
+    def add_sample(self, sample, L, ray):
+        with self.lock:
+            super(FalseColorFilm, self).add_sample(sample, L, ray)
+
+    def get_film_tile(self, x_start, x_end, y_start, y_end):
+        # Tile of the pixels containing the samples of the given sample window
+        x0 = max(self.x_pixel_start, int(np.floor(x_start)))
+        x1 = min(self.x_pixel_start + self.x_pixel_count, int(np.ceil(x_end)))
+        y0 = max(self.y_pixel_start, int(np.floor(y_start)))
+        y1 = min(self.y_pixel_start + self.y_pixel_count, int(np.ceil(y_end)))
+        return FalseColorFilmTile(self.x_resolution, self.y_resolution, x0, max(0, x1 - x0), y0, max(0, y1 - y0))
+
+    def merge_film_tile(self, tile):
+        if tile is self:
+            return
+        ys = slice(tile.y_pixel_start - self.y_pixel_start, tile.y_pixel_start - self.y_pixel_start + tile.y_pixel_count)
+        xs = slice(tile.x_pixel_start - self.x_pixel_start, tile.x_pixel_start - self.x_pixel_start + tile.x_pixel_count)
+        with self.lock:
+            self.counts[:,ys,xs]     += tile.counts
+            self.sample_count[ys,xs] += tile.sample_count
+
+    def get_cost(self):
+        # Number of primitive tests (closest and any hit) per sample of each pixel (indexed by [y,x])
+        tests = self.counts[COUNTERS.index('pcount')] + self.counts[COUNTERS.index('scount')]
+        return tests / np.maximum(self.sample_count, 1)
+
+    def write_image(self, splat_scale=1.0):
+        base = os.path.splitext(self.fname)[0] + '-falsecolor'
+        # Stored with the smallest unsigned integer type holding the counts
+        arrays = dict(zip(COUNTERS + ('sample_count',), list(self.counts) + [self.sample_count]))
+        for name, counts in arrays.items():
+            arrays[name] = counts.astype(np.min_scalar_type(counts.max()))
+        np.savez_compressed(base + '.npz', **arrays)
+
+        if self.heatmap:
+            # Cost relative to the most expensive pixel
+            cost = self.get_cost()
+            max_cost = cost.max()
+            if max_cost > 0.0:
+                cost = cost / max_cost
+            cv2.imwrite(base + '.png', cv2.applyColorMap(np.uint8(np.round(255.0 * cost)), self.colormap))
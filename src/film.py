@@ -2,6 +2,7 @@
 ## Film
 ###############################################################################
 from abc import ABCMeta, abstractmethod
+from sampler import CameraSample
 
 class Film(object):
 
@@ -15,6 +16,13 @@ class Film(object):
     def add_sample(self, sample, L, ray):
         return
 
+    def add_samples(self, image_xy, Ls, rays=None):
+        # Fallback: add the samples of the batch one at a time
+        sample = CameraSample()
+        for k in range(Ls.shape[0]):
+            sample.image_x, sample.image_y = image_xy[k]
+            self.add_sample(sample, Ls[k], None if rays is None else rays[k])
+
     def splat(self, sample, L):
         return
 
@@ -26,6 +34,19 @@ class Film(object):
     def get_pixel_extent(self):
         return
     
+    def get_film_tile(self, x_start, x_end, y_start, y_end):
+        # Film accumulating the samples of the given sample window of a single render task,
+        # to be merged with merge_film_tile (default: this film itself)
+        return self
+
+    def merge_film_tile(self, tile):
+        return
+
+    def get_pixel_errors(self):
+        # Relative standard error of the luminance of each pixel (indexed by [y,x] over the pixel extent),
+        # None if not estimated by this film
+        return None
+
     def update_display(self, x0, y0, x1, y1, splat_scale=1.0):
         return
 
@@ -2,6 +2,8 @@ import sys
 from multiprocessing import cpu_count
 
 SINGLE_THREADED = True
+# Render with worker processes instead of threads (ignored if SINGLE_THREADED)
+MULTI_PROCESSING = False
 DEBUG = True
 
 def nb_cpus():
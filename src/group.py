@@ -36,16 +36,18 @@ class Group(AbstractGroup):
 
     def intersect(self, ray, isect=None):
         if isect is None:
-            for shape in self.shapes:
-                if (shape.intersect(ray)):
-                    return True
-            return False
-        else:     
-            hit = False
-            for shape in self.shapes:
-                if (shape.intersect(ray, isect)):
-                    hit = True
-            return hit
+            return self.occluded(ray)
+        hit = False
+        for shape in self.shapes:
+            if (shape.intersect(ray, isect)):
+                hit = True
+        return hit
+
+    def occluded(self, ray):
+        for shape in self.shapes:
+            if (shape.occluded(ray)):
+                return True
+        return False
     
     def intersect_exclusive(self, excl, ray, isect=None):
         if isect is None:
@@ -60,39 +62,25 @@ class Group(AbstractGroup):
                     hit = True
             return hit
 
-###############################################################################
-## StatisticsGroup
-###############################################################################
-from threading import Lock
-
-class StatisticsGroup(Group):
-
-    def __init__(self, shapes=[], i=None, color='k'):
-        super(StatisticsGroup, self).__init__(shapes=shapes, i=i, color=color)
-        self.access_count = np.zeros(7)
-        self.lock = Lock()
-
-    def bounds(self):
-        return self.bounds
+    def intersect_batch(self, rays, isects=None):
+        if isects is None:
+            return self.occluded_batch(rays)
+        hits = np.zeros((len(rays)), dtype=bool)
+        for shape in self.shapes:
+            hits |= shape.intersect_batch(rays, isects)
+        return hits
 
-    def _update(self):
-        self.bounds = super(StatisticsGroup, self).bounds()
-         
-    def _update_stats(self, ray):
-        if self.bounds.inside(ray(ray.tMin)):
-            self.lock.aquire()
-            self.access_count[6] += 1
-            self.lock.release()
-        else:
-            _, _, _, plMin, _ = self.bounds.intersect_info(ray)
-            self.lock.aquire()
-            self.access_count[plMin] += 1
-            self.lock.release()
-
-    def intersect(self, ray, isect=None):
-        self._update_stats(ray)
-        return super(StatisticsGroup, self).intersect(ray=ray, isect=isect)
-    
-    def intersect_exclusive(self, excl, ray, isect=None):
-        self._update_stats(ray)
-        return super(StatisticsGroup, self).intersect_exclusive(excl=excl, ray=ray, isect=isect)
+    def occluded_batch(self, rays):
+        hits = np.zeros((len(rays)), dtype=bool)
+        for shape in self.shapes:
+            # Only test the rays which are not occluded yet
+            active = np.nonzero(~hits)[0]
+            if active.shape[0] == 0:
+                break
+            if active.shape[0] == len(rays):
+                hits |= shape.occluded_batch(rays)
+            else:
+                sub = rays.subset(active)
+                hits[active] = shape.occluded_batch(sub)
+                rays.merge(active, sub)
+        return hits
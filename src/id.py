@@ -1,5 +1,6 @@
+from collections import deque
 from global_configuration import python_version_major
-from itertools import count
+from itertools import count, islice
 
 class IDGenerator(object):
 
@@ -11,4 +12,10 @@ class IDGenerator(object):
         if python_version_major() < 3:
             return self.id_gen.next()
         else:
-            return self.id_gen.__next__()
\ No newline at end of file
+            return self.id_gen.__next__()
+
+    def reserve(self, n):
+        # Atomically reserve a contiguous block of n > 0 ids (returns the first id)
+        start = self.__next__()
+        deque(islice(self.id_gen, n-1), maxlen=0)
+        return start
\ No newline at end of file
@@ -1,96 +1,150 @@
 from cv2 import imwrite
+from math import ceil, floor
 import numpy as np
 
 from spectrum_utils import rgb_to_xyz, xyz_to_rgb
 
 FILTER_TABLE_SIZE = 16
+# Luminance below which the standard error of a pixel is taken relative to this value instead
+MIN_RELATIVE_LUMINANCE = 0.01
+
+def film_rgb(L_xyz, weight_sum, splat_xyz, splat_scale=1.0):
+    # RGB colors of the given pixels from their accumulated (filtered) XYZ colors, weight sums and splats
+    rgb = xyz_to_rgb(L_xyz)
+
+    # Normalize pixels with weight sum
+    weighted = weight_sum != 0.0
+    rgb[weighted] = np.maximum(0.0, rgb[weighted] / weight_sum[weighted][:, np.newaxis])
+
+    # Add splat values at pixels
+    rgb += splat_scale * xyz_to_rgb(splat_xyz)
+    return rgb
+
+def pixel_errors(sample_count, Y_sum, Y2_sum):
+    # Standard error of the mean luminance (sample variance / sample count), relative to the mean luminance;
+    # infinite for pixels with less than 2 samples
+    n = np.maximum(sample_count, 2)
+    mean = Y_sum / n
+    variance = np.maximum(0.0, (Y2_sum - n * mean * mean) / (n - 1))
+    errors = np.sqrt(variance / n) / np.maximum(np.abs(mean), MIN_RELATIVE_LUMINANCE)
+    errors[sample_count < 2] = np.inf
+    return errors
 
 ###############################################################################
-## ImageFilm
+## ImageFilmTile
 ###############################################################################
 from film import Film
-from box_filter import BoxFilter
 
-class ImageFilm(Film):
-    
-    def __init__(self, x_res=640, y_res=480, fIlter=BoxFilter(), crop_window=np.array([0.0, 1.0, 0.0, 1.0]), fname='pbrtpy.png'):
-        super(ImageFilm, self).__init__(x_res, y_res)
-        self.filter = fIlter
-        self.fname = fname
+class ImageFilmTile(Film):
+    '''
+    Pixel buffers of a window of an ImageFilm. Each render task accumulates
+    its samples in its own tile without any locking; the tile is merged into
+    the film once the task finishes.
+    '''
 
-        # Compute film image extent
-        self.x_pixel_start = int(np.ceil(self.x_resolution * crop_window[0]))
-        self.x_pixel_count = max(1, int(np.ceil(self.x_resolution * crop_window[1]) - self.x_pixel_start))
-        self.y_pixel_start = int(np.ceil(self.y_resolution * crop_window[2]))
-        self.y_pixel_count = max(1, int(np.ceil(self.y_resolution * crop_window[3]) - self.y_pixel_start))
-        if self.x_pixel_count>self.x_resolution:
-            raise ValueError
-        if self.y_pixel_count>self.y_resolution:
-            raise ValueError
+    def __init__(self, x_res, y_res, fIlter, filter_table, x_pixel_start, x_pixel_count, y_pixel_start, y_pixel_count):
+        super(ImageFilmTile, self).__init__(x_res, y_res)
+        self.filter = fIlter
+        self.filter_table = filter_table
+        self.x_pixel_start = x_pixel_start
+        self.x_pixel_count = x_pixel_count
+        self.y_pixel_start = y_pixel_start
+        self.y_pixel_count = y_pixel_count
+
+        # Allocate pixel storage (indexed by [y,x] relative to the pixel start)
+        self.L_xyz      = self._allocate((self.y_pixel_count, self.x_pixel_count, 3))
+        self.weight_sum = self._allocate((self.y_pixel_count, self.x_pixel_count))
+        self.splat_xyz  = self._allocate((self.y_pixel_count, self.x_pixel_count, 3))
+
+        # Per-pixel luminance statistics of the (unfiltered) samples for estimating the pixel errors
+        self.sample_count = self._allocate((self.y_pixel_count, self.x_pixel_count), dtype=np.int64)
+        self.Y_sum        = self._allocate((self.y_pixel_count, self.x_pixel_count))
+        self.Y2_sum       = self._allocate((self.y_pixel_count, self.x_pixel_count))
+
+    def _allocate(self, shape, dtype=np.float64):
+        # Zero-initialized pixel buffer
+        return np.zeros(shape, dtype=dtype)
 
-        # Allocate film image storage
-        self.pixels = np.empty((self.x_pixel_count, self.y_pixel_count), dtype=ImagePixel)
-        for i in range(self.x_pixel_count):
-            for j in range(self.y_pixel_count):
-                self.pixels[i,j] = ImagePixel()
-        
-        # Precompute filter weight table
-        self.filter_table = [0.0] * (FILTER_TABLE_SIZE * FILTER_TABLE_SIZE)
-        for y in range(FILTER_TABLE_SIZE):
-            fy = (float(y) + 0.5) * self.filter.y_width / float(FILTER_TABLE_SIZE)
-            for x in range(FILTER_TABLE_SIZE):
-                fx = (float(x) + 0.5) * self.filter.x_width / float(FILTER_TABLE_SIZE)
-                self.filter_table[y * FILTER_TABLE_SIZE + x] = self.filter.evaluate(fx, fy)
-        
     def add_sample(self, sample, L, ray):
+        # Scalar counterpart of add_samples indexing the pixel arrays directly (same contributions)
+        L_xyz = rgb_to_xyz(L)
         d_image_x = sample.image_x - 0.5
         d_image_y = sample.image_y - 0.5
-        x0 = int(np.ceil(d_image_x - self.filter.x_width))
-        x1 = int(d_image_x + self.filter.x_width)
-        y0 = int(np.ceil(d_image_y - self.filter.y_width))
-        y1 = int(d_image_y + self.filter.y_width)
-        x0 = max(x0, self.x_pixel_start)
-        x1 = min(x1, self.x_pixel_start + self.x_pixel_count - 1)
-        y0 = max(y0, self.y_pixel_start)
-        y1 = min(y1, self.y_pixel_start + self.y_pixel_count - 1)
-        if ((x1-x0)<0) or ((y1-y0)<0):
-            return
+        x0 = max(int(ceil(d_image_x - self.filter.x_width)), self.x_pixel_start)
+        x1 = min(int(floor(d_image_x + self.filter.x_width)), self.x_pixel_start + self.x_pixel_count - 1)
+        y0 = max(int(ceil(d_image_y - self.filter.y_width)), self.y_pixel_start)
+        y1 = min(int(floor(d_image_y + self.filter.y_width)), self.y_pixel_start + self.y_pixel_count - 1)
 
         # Loop over filter support and add sample to pixel arrays
-        L_xyz = rgb_to_xyz(L)
-
-        # Precompute x and y filter table offsets
-        ifx = []
-        for x in range(x0, x1+1):
-            fx = abs((x - d_image_x) * self.filter.inv_x_width * FILTER_TABLE_SIZE)
-            ifx.append(min(int(fx), FILTER_TABLE_SIZE-1))
-        ify = []
-        for y in range(y0, y1+1):
-            fy = abs((y - d_image_y) * self.filter.inv_y_width * FILTER_TABLE_SIZE)
-            ify.append(min(int(fy), FILTER_TABLE_SIZE-1))
-        sync_needed = (self.filter.x_width > 0.5) or (self.filter.y_width > 0.5)
         for y in range(y0, y1+1):
+            ify = min(int(abs((y - d_image_y) * self.filter.inv_y_width * FILTER_TABLE_SIZE)), FILTER_TABLE_SIZE-1)
             for x in range(x0, x1+1):
-                # Evaluate filter value at (x,y) pixel
-                offset = ify[y-y0]*FILTER_TABLE_SIZE + ifx[x-x0]
-                filter_weight = self.filter_table[offset]
-                # Update pixel values with filtered sample contribution
-                if not sync_needed:
-                    self.pixels[x,y].update_unsafe(L_xyz, filter_weight)
-                else:
-                    self.pixels[x,y].update(L_xyz, filter_weight)
+                ifx = min(int(abs((x - d_image_x) * self.filter.inv_x_width * FILTER_TABLE_SIZE)), FILTER_TABLE_SIZE-1)
+                filter_weight = self.filter_table[ify, ifx]
+                self.L_xyz[y - self.y_pixel_start, x - self.x_pixel_start] += filter_weight * L_xyz
+                self.weight_sum[y - self.y_pixel_start, x - self.x_pixel_start] += filter_weight
+
+        # Accumulate the luminance statistics in the pixel containing the sample
+        x = int(floor(sample.image_x)) - self.x_pixel_start
+        y = int(floor(sample.image_y)) - self.y_pixel_start
+        if (0 <= x < self.x_pixel_count) and (0 <= y < self.y_pixel_count):
+            Y = L_xyz[1]
+            self.sample_count[y,x] += 1
+            self.Y_sum[y,x]        += Y
+            self.Y2_sum[y,x]       += Y * Y
+
+    def add_samples(self, image_xy, Ls, rays=None):
+        Ls_xyz = rgb_to_xyz(Ls)
+        d_image_x = image_xy[:,0] - 0.5
+        d_image_y = image_xy[:,1] - 0.5
+        x0 = np.ceil(d_image_x - self.filter.x_width).astype(np.int64)
+        y0 = np.ceil(d_image_y - self.filter.y_width).astype(np.int64)
+        x1 = np.floor(d_image_x + self.filter.x_width).astype(np.int64)
+        y1 = np.floor(d_image_y + self.filter.y_width).astype(np.int64)
+        x0 = np.maximum(x0, self.x_pixel_start)
+        x1 = np.minimum(x1, self.x_pixel_start + self.x_pixel_count - 1)
+        y0 = np.maximum(y0, self.y_pixel_start)
+        y1 = np.minimum(y1, self.y_pixel_start + self.y_pixel_count - 1)
+
+        # Loop over the offsets within the largest filter support and scatter-add the samples to the pixel arrays
+        nx = int(np.ceil(2.0 * self.filter.x_width)) + 1
+        ny = int(np.ceil(2.0 * self.filter.y_width)) + 1
+        for j in range(ny):
+            y = y0 + j
+            valid_y = (y <= y1)
+            fy = np.abs((y - d_image_y) * self.filter.inv_y_width * FILTER_TABLE_SIZE)
+            ify = np.minimum(fy.astype(np.int64), FILTER_TABLE_SIZE-1)
+            for i in range(nx):
+                x = x0 + i
+                valid = valid_y & (x <= x1)
+                if not valid.any():
+                    continue
+                fx = np.abs((x[valid] - d_image_x[valid]) * self.filter.inv_x_width * FILTER_TABLE_SIZE)
+                ifx = np.minimum(fx.astype(np.int64), FILTER_TABLE_SIZE-1)
+
+                # Evaluate filter value at (x,y) pixels and update pixel values with filtered sample contributions
+                filter_weights = self.filter_table[ify[valid], ifx]
+                pixels = (y[valid] - self.y_pixel_start, x[valid] - self.x_pixel_start)
+                np.add.at(self.L_xyz, pixels, filter_weights[:, np.newaxis] * Ls_xyz[valid])
+                np.add.at(self.weight_sum, pixels, filter_weights)
+
+        # Accumulate the luminance statistics in the pixels containing the samples
+        x = np.floor(image_xy[:,0]).astype(np.int64) - self.x_pixel_start
+        y = np.floor(image_xy[:,1]).astype(np.int64) - self.y_pixel_start
+        valid = (x >= 0) & (x < self.x_pixel_count) & (y >= 0) & (y < self.y_pixel_count)
+        pixels = (y[valid], x[valid])
+        Ys = Ls_xyz[valid,1]
+        np.add.at(self.sample_count, pixels, 1)
+        np.add.at(self.Y_sum, pixels, Ys)
+        np.add.at(self.Y2_sum, pixels, Ys * Ys)
 
     def splat(self, sample, L):
-        x = int(sample.image_x)
-        y = int(sample.image_y)
+        x = int(np.floor(sample.image_x))
+        y = int(np.floor(sample.image_y))
         if (x < self.x_pixel_start) or (x - self.x_pixel_start >= self.x_pixel_count) or (y < self.y_pixel_start) or (y - self.y_pixel_start >= self.y_pixel_count):
             return
-        y = y - self.y_pixel_start
-        x = x - self.x_pixel_start
+        self.splat_xyz[y - self.y_pixel_start, x - self.x_pixel_start] += rgb_to_xyz(L)
 
-        L_xyz = rgb_to_xyz(L)
-        self.pixels[x,y].update_splat(L_xyz)
-        
     def get_sample_extent(self):
         x_start = int(self.x_pixel_start + 0.5 - self.filter.x_width)
         x_end   = int(np.ceil(self.x_pixel_start + 0.5 + self.x_pixel_count + self.filter.x_width))
@@ -106,49 +160,77 @@ class ImageFilm(Film):
         return x_start, x_end, y_start, y_end
 
     def write_image(self, splat_scale=1.0):
-        img = np.zeros((self.x_pixel_count, self.y_pixel_count, 3))
-        for x in range(self.x_pixel_count):
-            for y in range(self.y_pixel_count):
-                pixel = self.pixels[x,y]
-
-                # Convert pixel XYZ color to RGB
-                rgb = xyz_to_rgb(pixel.L_xyz)
-
-                # Normalize pixel with weight sum
-                if pixel.weight_sum != 0.0:
-                    rgb = np.maximum(0.0, rgb / pixel.weight_sum) 
-
-                # Add splat value at pixel
-                rgb += splat_scale * pixel.splat_xyz
-                
-                img[x,y,:] = 255 * rgb
-        
-        imwrite(self.fname, np.transpose(img, axes=(1,0,2)))
-        
+        return
+
+###############################################################################
+## ImageFilm
 ###############################################################################
-## ImagePixel
-###############################################################################      
+from box_filter import BoxFilter
 from threading import Lock
 
-class ImagePixel(object):
-    def __init__(self):
-        self.L_xyz = np.zeros((3))
-        self.weight_sum = 0.0
-        self.splat_xyz = np.zeros((3))
-        self.pad = 0.0
+class ImageFilm(ImageFilmTile):
+
+    def __init__(self, x_res=640, y_res=480, fIlter=BoxFilter(), crop_window=np.array([0.0, 1.0, 0.0, 1.0]), fname='pbrtpy.png'):
+        self.fname = fname
+
+        # Compute film image extent
+        x_pixel_start = int(np.ceil(x_res * crop_window[0]))
+        x_pixel_count = max(1, int(np.ceil(x_res * crop_window[1]) - x_pixel_start))
+        y_pixel_start = int(np.ceil(y_res * crop_window[2]))
+        y_pixel_count = max(1, int(np.ceil(y_res * crop_window[3]) - y_pixel_start))
+        if x_pixel_count>x_res:
+            raise ValueError
+        if y_pixel_count>y_res:
+            raise ValueError
+
+        # Precompute filter weight table (indexed by [y,x])
+        filter_table = np.zeros((FILTER_TABLE_SIZE, FILTER_TABLE_SIZE))
+        for y in range(FILTER_TABLE_SIZE):
+            fy = (float(y) + 0.5) * fIlter.y_width / float(FILTER_TABLE_SIZE)
+            for x in range(FILTER_TABLE_SIZE):
+                fx = (float(x) + 0.5) * fIlter.x_width / float(FILTER_TABLE_SIZE)
+                filter_table[y,x] = fIlter.evaluate(fx, fy)
+
+        # The film is the tile of its whole pixel extent
+        super(ImageFilm, self).__init__(x_res, y_res, fIlter, filter_table, x_pixel_start, x_pixel_count, y_pixel_start, y_pixel_count)
         self.lock = Lock()
-        
-    def update(self, L, filter_weight):
-        self.lock.aquire()
-        self.L_xyz      += filter_weight * L
-        self.weight_sum += filter_weight
-        self.lock.release()
-        
-    def update_unsafe(self, L, filter_weight):
-        self.L_xyz      += filter_weight * L
-        self.weight_sum += filter_weight
-        
-    def update_splat(self, L):
-        self.lock.aquire()
-        self.splat_xyz = L
-        self.lock.release()
+
+    def add_sample(self, sample, L, ray):
+        # Samples added directly to the film (rather than to a tile) may come from several threads
+        with self.lock:
+            super(ImageFilm, self).add_sample(sample, L, ray)
+
+    def add_samples(self, image_xy, Ls, rays=None):
+        with self.lock:
+            super(ImageFilm, self).add_samples(image_xy, Ls, rays)
+
+    def splat(self, sample, L):
+        with self.lock:
+            super(ImageFilm, self).splat(sample, L)
+
+    def get_film_tile(self, x_start, x_end, y_start, y_end):
+        # Tile of the pixels affected by the samples of the given sample window (i.e. including the filter margin)
+        x0 = max(self.x_pixel_start, int(np.ceil(x_start - 0.5 - self.filter.x_width)))
+        x1 = min(self.x_pixel_start + self.x_pixel_count, int(np.floor(x_end - 0.5 + self.filter.x_width)) + 1)
+        y0 = max(self.y_pixel_start, int(np.ceil(y_start - 0.5 - self.filter.y_width)))
+        y1 = min(self.y_pixel_start + self.y_pixel_count, int(np.floor(y_end - 0.5 + self.filter.y_width)) + 1)
+        return ImageFilmTile(self.x_resolution, self.y_resolution, self.filter, self.filter_table, x0, max(0, x1 - x0), y0, max(0, y1 - y0))
+
+    def merge_film_tile(self, tile):
+        if tile is self:
+            return
+        ys = slice(tile.y_pixel_start - self.y_pixel_start, tile.y_pixel_start - self.y_pixel_start + tile.y_pixel_count)
+        xs = slice(tile.x_pixel_start - self.x_pixel_start, tile.x_pixel_start - self.x_pixel_start + tile.x_pixel_count)
+        with self.lock:
+            self.L_xyz[ys,xs]        += tile.L_xyz
+            self.weight_sum[ys,xs]   += tile.weight_sum
+            self.splat_xyz[ys,xs]    += tile.splat_xyz
+            self.sample_count[ys,xs] += tile.sample_count
+            self.Y_sum[ys,xs]        += tile.Y_sum
+            self.Y2_sum[ys,xs]       += tile.Y2_sum
+
+    def get_pixel_errors(self):
+        return pixel_errors(self.sample_count, self.Y_sum, self.Y2_sum)
+
+    def write_image(self, splat_scale=1.0):
+        imwrite(self.fname, 255 * film_rgb(self.L_xyz, self.weight_sum, self.splat_xyz, splat_scale))
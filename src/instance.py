@@ -0,0 +1,92 @@
+import numpy as np
+from math_utils import normalize, normalize_rows
+
+###############################################################################
+## Instance
+###############################################################################
+from shape import Shape
+from transformvisitor import TransformVisitor
+
+class Instance(Shape):
+    '''
+    A (shared) shape, typically a prebuilt aggregate of a model, placed in
+    the world with an object-to-world transform. Rays are transformed into
+    object space at intersection time instead of copying the geometry.
+    Object space directions are not renormalized, so that distances along
+    the rays are the same in both spaces. Intersections report the id of
+    the instance.
+    '''
+
+    def __init__(self, shape, object_to_world, i=None, color='k'):
+        super(Instance, self).__init__(i, color=color)
+        self.shape = shape
+        self.object_to_world = object_to_world
+        self.world_to_object = object_to_world.inverse()
+        self._bounds = object_to_world(shape.bounds())
+
+    def dim(self):
+        return 3
+
+    def surface_area(self):
+        # Exact for transforms without non-uniform scaling
+        scale = np.abs(np.linalg.det(self.object_to_world.m[:3,:3])) ** (1.0 / 3.0)
+        return scale * scale * self.shape.surface_area()
+
+    def bounds(self):
+        return self._bounds
+
+    def centroid(self):
+        return self.object_to_world(self.shape.centroid(), is_point=True)
+
+    def intersect(self, ray, isect=None):
+        if isect is None:
+            return self.occluded(ray)
+        r = self.world_to_object(ray)
+        object_isect = type(isect)()
+        if not self.shape.intersect(r, object_isect):
+            return False
+        ray.tMax = r.tMax
+        isect.update(self.id, ray(r.tMax), r.tMax, normalize(self.object_to_world(object_isect.n, is_normal=True)))
+        return True
+
+    def occluded(self, ray):
+        return self.shape.occluded(self.world_to_object(ray))
+
+    def intersect_batch(self, rays, isects=None):
+        if isects is None:
+            return self.occluded_batch(rays)
+        r = self._to_object(rays)
+        object_isects = type(isects)(len(rays))
+        hits = self.shape.intersect_batch(r, object_isects)
+        rays.merge(slice(None), r)
+        if hits.any():
+            idx = np.nonzero(hits)[0]
+            t = rays.tMax[idx]
+            isects.update(idx, self.id, rays.o[idx] + t[:, np.newaxis] * rays.d[idx], t, normalize_rows(self.object_to_world(object_isects.n[idx], is_normal=True)))
+        return hits
+
+    def occluded_batch(self, rays):
+        r = self._to_object(rays)
+        hits = self.shape.occluded_batch(r)
+        rays.merge(slice(None), r)
+        return hits
+
+    def _to_object(self, rays):
+        # Object space copy of the batch, to be merged back into the batch
+        r = rays.subset(slice(None))
+        r.o = self.world_to_object(r.o, is_point=True)
+        r.d = self.world_to_object(r.d, is_direction=True)
+        return r
+
+    def accept(self, visitor, **kwargs):
+        # Visitors see the (world space) triangles of the instance
+        transformer = TransformVisitor(self.object_to_world)
+        self.shape.accept(transformer)
+        for shape in transformer.triangles:
+            shape.accept(visitor, **kwargs)
+
+    def __copy__(self):
+        return type(self)(self.shape, self.object_to_world, color=self.color)
+
+    def __deepcopy__(self):
+        return type(self)(self.shape.__deepcopy__(), self.object_to_world.__deepcopy__(), color=self.color)
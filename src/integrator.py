@@ -13,6 +13,7 @@ class Integrator(object):
 ## SurfaceIntegrator
 ###############################################################################
 from abc import ABCMeta, abstractmethod
+import numpy as np
 
 class SurfaceIntegrator(Integrator):
 
@@ -24,3 +25,12 @@ class SurfaceIntegrator(Integrator):
     @abstractmethod
     def Li(self, scene, renderer, ray, intersection, sample, rng):
         return
+
+    def Li_batch(self, scene, renderer, rays, intersections, indices, rng):
+        # Fallback: evaluate the rays of the batch with the given indices one at a time
+        Ls = np.zeros((len(indices), 3))
+        for j, k in enumerate(indices):
+            ray = rays[k]
+            Ls[j] = self.Li(scene, renderer, ray, intersections[k], None, rng)
+            rays.store(k, ray)
+        return Ls
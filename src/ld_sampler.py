@@ -0,0 +1,52 @@
+import numpy as np
+
+from sampling import sample02, shuffle, van_der_corput
+
+###############################################################################
+## LDSampler
+###############################################################################
+from sampler import PixelSampler
+
+class LDSampler(PixelSampler):
+    '''
+    Low-discrepancy samples: the image, lens and integrator samples of every
+    pixel are points of the (0,2)-sequence and the time samples points of
+    the van der Corput sequence, randomly scrambled per pixel and shuffled
+    relative to each other. The number of samples per pixel is rounded up
+    to a power of two.
+    '''
+
+    def __init__(self, x_start, x_end, y_start, y_end, spp, shutter_open, shutter_close):
+        spp = self.round_size(spp)
+        super(LDSampler, self).__init__(x_start, x_end, y_start, y_end, spp, shutter_open, shutter_close)
+
+    def get_pixel_samples(self, nb_pixels, rng):
+        scramble = self._scrambles(rng, (nb_pixels, 5))
+        i = np.arange(self.spp)[np.newaxis]
+        image_xy = sample02(i, scramble[:,0:1], scramble[:,1:2])
+        lens_uv  = sample02(i, scramble[:,2:3], scramble[:,3:4])
+        time     = van_der_corput(i, scramble[:,4:5])
+
+        # Decorrelate the image, lens and time samples
+        lens_uv = shuffle(lens_uv, rng.uniform(size=(nb_pixels, self.spp)))
+        time    = shuffle(time[:,:,np.newaxis], rng.uniform(size=(nb_pixels, self.spp)))[:,:,0]
+        return image_xy, lens_uv, time
+
+    def get_integrator_samples(self, n, d, rng):
+        # The n*spp consecutive points of the scrambled sequence, shuffled within and across the samples
+        scramble = self._scrambles(rng, (2))
+        i = np.arange(self.spp * n).reshape((self.spp, n))
+        if d == 1:
+            samples = van_der_corput(i, scramble[0])[:,:,np.newaxis]
+        else:
+            samples = sample02(i, scramble[0], scramble[1])
+        samples = shuffle(samples, rng.uniform(size=(self.spp, n)))
+        return shuffle(samples.reshape((1, self.spp, n*d)), rng.uniform(size=(1, self.spp)))[0].reshape((self.spp, n, d))
+
+    def _scrambles(self, rng, size):
+        # Random 32 bit scrambles
+        return (rng.uniform(size=size) * 4294967296.0).astype(np.uint32)
+
+    def round_size(self, size):
+        # Round up to a power of two
+        return 1 << max(0, int(size - 1).bit_length())
@@ -2,6 +2,7 @@ import numpy as np
 
 from nAABB import union
 from shape import Shape
+import stats
 
 ###############################################################################
 ## n-Sphere
@@ -51,10 +52,8 @@ class Line(Shape):
         
         '''
         
-        if isect:
-            ray.stats.pcount += 1
-        else:
-            ray.stats.scount += 1
+        if __debug__ and stats.enabled:
+            stats.count_tests(ray, stats.PRIMITIVE_TESTS, closest=isect is not None)
         
         A = np.zeros((self.v1.shape[0], 2))
         A[:,0] = self.v2 - self.v1
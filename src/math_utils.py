@@ -19,6 +19,11 @@ def normalize(v):
     if norm==0: 
        return v
     return v/norm
+
+def normalize_rows(v):
+    norm = np.sqrt(np.einsum('ij,ij->i', v, v))
+    norm[norm == 0.0] = 1.0
+    return v / norm[:, np.newaxis]
     
 def length_squared(v):
     return np.dot(v, v)
@@ -32,7 +32,7 @@ def _cube():
     return model
     
 def model(fname):
-    return model.append(parse(fname))
+    return create_Factory(3).get_Group().append(parse(fname))
        
 ###############################################################################
 ## Tests
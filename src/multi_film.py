@@ -16,6 +16,10 @@ class MultiFilm(Film):
         for film in self.films:
             film.add_sample(sample, L, ray)
 
+    def add_samples(self, image_xy, Ls, rays=None):
+        for film in self.films:
+            film.add_samples(image_xy, Ls, rays)
+
     def splat(self, sample, L):
         for film in self.films:
             film.splat(sample, L)
@@ -24,7 +28,24 @@ class MultiFilm(Film):
         return self.films[0].get_sample_extent()
 
     def get_pixel_extent(self):
-        return self.films[0].get_sample_extent()
+        return self.films[0].get_pixel_extent()
+
+    def get_film_tile(self, x_start, x_end, y_start, y_end):
+        tile = MultiFilm(self.x_resolution, self.y_resolution)
+        for film in self.films:
+            tile.add_film(film.get_film_tile(x_start, x_end, y_start, y_end))
+        return tile
+
+    def merge_film_tile(self, tile):
+        for film, film_tile in zip(self.films, tile.films):
+            film.merge_film_tile(film_tile)
+
+    def get_pixel_errors(self):
+        for film in self.films:
+            errors = film.get_pixel_errors()
+            if errors is not None:
+                return errors
+        return None
     
     def update_display(self, x0, y0, x1, y1, splat_scale=1.0):
         for film in self.films:
@@ -6,6 +6,7 @@ from math_utils import distance
 ###############################################################################
 import nsphere
 from shape import Shape
+import stats
 
 class NAABB(Shape):
    
@@ -80,10 +81,8 @@ class NAABB(Shape):
         return nsphere.NSphere(center, radius)
         
     def intersect(self, ray, isect=None):
-        if isect:
-            ray.stats.pcount += 1
-        else:
-            ray.stats.scount += 1
+        if __debug__ and stats.enabled:
+            stats.count_tests(ray, stats.PRIMITIVE_TESTS, closest=isect is not None)
 
         tMin = ray.tMin
         tMax = ray.tMax
@@ -112,9 +111,17 @@ class NAABB(Shape):
         else:
             self._update_intersection(t=tMin, ray=ray, isect=isect)    
         return True
+
+    def occluded(self, ray):
+        hit, _, _, _, _ = self.intersect_info(ray)
+        if __debug__ and stats.enabled:
+            if hit:
+                stats.count(stats.PRIMITIVE_HITS)
+        return hit
     
     def intersect_info(self, ray):
-        ray.stats.scount += 1
+        if __debug__ and stats.enabled:
+            stats.count_tests(ray, stats.PRIMITIVE_TESTS, closest=False)
 
         tMin = ray.tMin
         tMax = ray.tMax
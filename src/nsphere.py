@@ -6,6 +6,7 @@ from math_utils import normalize, quadratic
 ###############################################################################
 import nAABB
 from shape import Shape
+import stats
 
 class NSphere(Shape):
 
@@ -41,10 +42,8 @@ class NSphere(Shape):
         return normalize(p - self.c)
         
     def intersect(self, ray, isect=None):
-        if isect:
-            ray.stats.pcount += 1
-        else:
-            ray.stats.scount += 1
+        if __debug__ and stats.enabled:
+            stats.count_tests(ray, stats.PRIMITIVE_TESTS, closest=isect is not None)
         
         e = ray.o - self.c
         A = np.dot(ray.d, ray.d)
@@ -66,6 +65,21 @@ class NSphere(Shape):
             return True
         
         return False
+
+    def occluded(self, ray):
+        if __debug__ and stats.enabled:
+            stats.count_tests(ray, stats.PRIMITIVE_TESTS, closest=False)
+        
+        e = ray.o - self.c
+        A = np.dot(ray.d, ray.d)
+        B = 2.0 * np.dot(ray.d, e)
+        C = np.dot(e, e) - self.r * self.r
+        b, tMin, tMax = quadratic(A, B, C)
+        hit = b and ((ray.tMin < tMin and tMin < ray.tMax) or (ray.tMin < tMax and tMax < ray.tMax))
+        if __debug__ and stats.enabled:
+            if hit:
+                stats.count(stats.PRIMITIVE_HITS)
+        return hit
         
     def __copy__(self):
         return self.__deepcopy__()
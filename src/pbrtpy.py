@@ -6,16 +6,22 @@ from falsecolor_film import FalseColorFilm
 from image_film import ImageFilm
 from multi_film import MultiFilm
 from perspective_camera import PerspectiveCamera
+from tiled_image_film import TiledImageFilm
 from wireframe_film import WireframeFilm
 from wireframerenderer import Wireframe3DRenderer
+import stats
 
-def create_camera(scene, camera_to_world, fov=60.0, x_res=512, y_res=512, fname='pbrtpy.png', image_film=True, false_color_film=False, wireframe_film=False):
+def create_camera(scene, camera_to_world, fov=60.0, x_res=512, y_res=512, fname='pbrtpy.png', image_film=True, false_color_film=False, wireframe_film=False, tiled_film=False):
     # Film
     film = MultiFilm(x_res=x_res, y_res=y_res)
     if image_film: 
-        film.add_film(ImageFilm(x_res=x_res, y_res=y_res, fname=fname))
+        # The tiled film keeps its pixels on disk and streams the image (for very large resolutions)
+        image_film_type = TiledImageFilm if tiled_film else ImageFilm
+        film.add_film(image_film_type(x_res=x_res, y_res=y_res, fname=fname))
     if false_color_film:
         film.add_film(FalseColorFilm(x_res=x_res, y_res=y_res, fname=fname))
+        # The false colors are the per-ray traversal statistics, which are only gathered while enabled
+        stats.enable()
     
     # Camera
     frame = float(x_res) / y_res
@@ -43,13 +49,13 @@ from occlusion_integrator import OcclusionIntegrator
 from random_sampler import RandomSampler
 from sampler_renderer import SamplerRenderer
 
-def create_renderer(camera, spp=1, first_pass_iter=0):
+def create_renderer(camera, spp=1, first_pass_spp=0, error_threshold=0.05, packet_size=0, seed=0, sampler_type=RandomSampler):
     # Surface_integrator
     surface_integrator = AmbientOcclusionIntegrator(nb_samples=1)
     # Sampler
-    sampler = RandomSampler(*camera.film.get_sample_extent(), spp=spp, shutter_open=camera.shutter_open, shutter_close=camera.shutter_close)
+    sampler = sampler_type(*camera.film.get_sample_extent(), spp=spp, shutter_open=camera.shutter_open, shutter_close=camera.shutter_close)
     # Renderer
-    return SamplerRenderer(sampler=sampler, camera=camera, surface_integrator=surface_integrator, first_pass_iter=first_pass_iter)
+    return SamplerRenderer(sampler=sampler, camera=camera, surface_integrator=surface_integrator, first_pass_spp=first_pass_spp, error_threshold=error_threshold, packet_size=packet_size, seed=seed)
 
 ###############################################################################
 ## Tests
@@ -72,7 +78,7 @@ def test():
     camera_to_world = cam2world(pos, look, up)
     
     camera = create_camera(scene, camera_to_world, false_color_film=True, wireframe_film=False)
-    renderer = create_renderer(camera, spp=2, first_pass_iter=0)
+    renderer = create_renderer(camera, spp=2)
     renderer.render(scene=scene)
   
 if __name__ == '__main__':
@@ -0,0 +1,54 @@
+import numpy as np
+import struct
+import zlib
+
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+
+###############################################################################
+## PNGWriter
+###############################################################################
+class PNGWriter(object):
+    '''
+    Writes an 8-bit RGB PNG image incrementally, a band of rows at a time,
+    so that the whole image never has to be held in memory. The rows are
+    compressed as they arrive and written to the file in IDAT chunks.
+    '''
+
+    def __init__(self, fname, width, height, level=6):
+        self.width = width
+        self.height = height
+        self.row_count = 0
+        self.compressor = zlib.compressobj(level)
+        self.file = open(fname, 'wb')
+        self.file.write(PNG_SIGNATURE)
+        # 8 bits per channel, truecolor, deflate, adaptive filtering, no interlacing
+        self._write_chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, 2, 0, 0, 0))
+
+    def write_rows(self, rows):
+        # Appends the given (n,width,3) rows (RGB, top to bottom)
+        rows = np.asarray(rows, dtype=np.uint8)
+        if rows.shape[1:] != (self.width, 3) or self.row_count + rows.shape[0] > self.height:
+            raise ValueError
+        # Every row is preceded by its filter type (0: none)
+        scanlines = np.zeros((rows.shape[0], 1 + 3 * self.width), dtype=np.uint8)
+        scanlines[:,1:] = rows.reshape((rows.shape[0], -1))
+        data = self.compressor.compress(scanlines.tobytes())
+        if data:
+            self._write_chunk(b'IDAT', data)
+        self.row_count += rows.shape[0]
+
+    def close(self):
+        # Fails (leaving an incomplete file) if not all rows were written
+        try:
+            if self.row_count != self.height:
+                raise ValueError
+            self._write_chunk(b'IDAT', self.compressor.flush())
+            self._write_chunk(b'IEND', b'')
+        finally:
+            self.file.close()
+
+    def _write_chunk(self, chunk_type, data):
+        self.file.write(struct.pack('>I', len(data)))
+        self.file.write(chunk_type)
+        self.file.write(data)
+        self.file.write(struct.pack('>I', zlib.crc32(chunk_type + data) & 0xffffffff))
@@ -5,6 +5,7 @@ import numpy as np
 ###############################################################################
 from nAABB import NAABB
 from shape import Shape
+import stats
 
 class Point(Shape):
 
@@ -44,10 +45,8 @@ class Point(Shape):
         
         '''
         
-        if isect:
-            ray.stats.pcount += 1
-        else:
-            ray.stats.scount += 1
+        if __debug__ and stats.enabled:
+            stats.count_tests(ray, stats.PRIMITIVE_TESTS, closest=isect is not None)
         
         A   = ray.d	
         rhs = self.v1 - ray.o
@@ -1,25 +1,19 @@
+import numpy as np
+
 ###############################################################################
 ## RandomSampler
 ###############################################################################
 from sampler import Sampler
-from sampling import Sampler3D
 
 class RandomSampler(Sampler):
 
     def __init__(self, x_start, x_end, y_start, y_end, spp, shutter_open, shutter_close):
         super(RandomSampler, self).__init__(x_start, x_end, y_start, y_end, spp, shutter_open, shutter_close)
-        self.x_pos = self.x_pixel_start
+        # Start before the first pixel: the samples of every pixel (including the first one) are drawn
+        # from the rng of the caller, so that samplers of the same window can be made independent
+        self.x_pos = self.x_pixel_start - 1
         self.y_pos = self.y_pixel_start
-
-        rng = Sampler3D(seed=x_start + y_start * (x_end-x_start))
-        self.image_samples = rng.uniform(size=5*spp)
-
-        # Shift image samples to pixel coordinates
-        for o in range(0, 2*self.spp, 2):
-            self.image_samples[o]   += self.x_pos
-            self.image_samples[o+1] += self.y_pos
-
-        self.sample_pos = 0
+        self.sample_pos = self.spp
         
     def get_more_samples(self, samples, rng):
         if self.sample_pos == self.spp:
@@ -51,15 +45,50 @@ class RandomSampler(Sampler):
 
         # Generate stratified samples for integrators
         for i in range(len(sample.n1D)):
-            for j in range(sample.n1D[i]):
-                sample.oneD[i][j] = rng.random_float()
+            sample.oneD[i][:] = rng.uniform(size=sample.n1D[i])
         for i in range(len(sample.n2D)):
-            for j in range(2*sample.n2D[i]):
-                sample.twoD[i][j] = rng.random_float()
+            sample.twoD[i][:] = rng.uniform(size=2*sample.n2D[i])
         
         self.sample_pos += 1
         return 1
 
+    def get_more_samples_batch(self, samples, rng, max_count):
+        image_x, image_y, lens_u, lens_v, time = [], [], [], [], []
+
+        # Remaining samples of the current pixel
+        if self.sample_pos < self.spp:
+            o = self.sample_pos
+            image_x.append(self.image_samples[2*o:2*self.spp:2])
+            image_y.append(self.image_samples[2*o+1:2*self.spp:2])
+            lens_u.append(self.image_samples[2*self.spp+2*o:4*self.spp:2])
+            lens_v.append(self.image_samples[2*self.spp+2*o+1:4*self.spp:2])
+            time.append(self.image_samples[4*self.spp+o:5*self.spp])
+            self.sample_pos = self.spp
+        
+        # Whole pixels following the current pixel
+        width  = self.x_pixel_end - self.x_pixel_start
+        height = self.y_pixel_end - self.y_pixel_start
+        pos = (self.y_pos - self.y_pixel_start) * width + (self.x_pos - self.x_pixel_start) + 1
+        nb_pixels = min((max_count - sum(map(len, time))) // self.spp, width * height - pos)
+        if len(time) == 0:
+            nb_pixels = max(1, nb_pixels)
+        if nb_pixels > 0 and pos < width * height:
+            ps = pos + np.arange(nb_pixels)
+            u = rng.uniform(size=(nb_pixels, 5*self.spp))
+            image_x.append((u[:,0:2*self.spp:2] + (self.x_pixel_start + ps % width)[:, np.newaxis]).ravel())
+            image_y.append((u[:,1:2*self.spp:2] + (self.y_pixel_start + ps // width)[:, np.newaxis]).ravel())
+            lens_u.append(u[:,2*self.spp:4*self.spp:2].ravel())
+            lens_v.append(u[:,2*self.spp+1:4*self.spp:2].ravel())
+            time.append(u[:,4*self.spp:].ravel())
+            self.x_pos = self.x_pixel_start + ps[-1] % width
+            self.y_pos = self.y_pixel_start + ps[-1] // width
+
+        if len(time) == 0:
+            return np.zeros((0, 2)), np.zeros((0, 2)), np.zeros((0))
+        image_xy = np.column_stack((np.concatenate(image_x), np.concatenate(image_y)))
+        lens_uv  = np.column_stack((np.concatenate(lens_u), np.concatenate(lens_v)))
+        return image_xy, lens_uv, np.concatenate(time)
+
     def maximum_sample_count(self):
         return 1
 
@@ -1,7 +1,8 @@
 import numpy as np
+from copy import copy
 
 from entity import Entity
-from math_utils import normalize
+from math_utils import normalize, normalize_rows
 
 ###############################################################################
 ## Ray
@@ -9,21 +10,35 @@ from math_utils import normalize
 from id import IDGenerator
 
 class Ray(Entity):
+
+    __slots__ = ('id', 'o', 'd', 'tMin', 'tMax', 'time', 'depth', 'stats', 'has_differentials', 'x_o', 'x_d', 'y_o', 'y_d')
     
     # Atomic increment id generator 
     id_gen = IDGenerator()
+    # Rays only get an id when enabled (nothing relies on them while rendering)
+    generate_ids = False
     
-    def __init__(self, origin, direction, start=0.0, end=np.inf, time=0.0, depth=0, color='k'):
+    def __init__(self, origin, direction, start=0.0, end=np.inf, time=0.0, depth=0, color='k', stats=None):
         super(Ray, self).__init__(color=color)
-        self.id = Ray.id_gen.__next__()
+        self.reset(origin, direction, start=start, end=end, time=time, depth=depth, stats=Stats() if stats is None else stats)
+
+    def reset(self, origin, direction, start=0.0, end=np.inf, time=0.0, depth=0, stats=None):
+        # Reinitializes this ray in place (e.g. a pooled ray reused for the next sample); the statistics
+        # are given, or the own statistics are reset
+        self.id = Ray.id_gen.__next__() if Ray.generate_ids else None
         self.o = origin
         self.d = normalize(direction)
         self.tMin = start  
         self.tMax = end
         self.time = time
         self.depth = depth
-        self.stats = Stats()
+        if stats is None:
+            self.stats.reset()
+        else:
+            self.stats = stats
         self.has_differentials = False
+        self.x_o = self.x_d = self.y_o = self.y_d = None
+        return self
 
     def dim(self):
         return self.o.shape[0]
@@ -35,17 +50,18 @@ class Ray(Entity):
         return self.o + self.d * t
         
     def __copy__(self):
-        clone = type(self)(self.o.copy(), self.d.copy(), start=self.tMin, end=self.tMax, time=self.time, depth=self.depth, color=self.color)
-        clone.stats = self.stats
-        if self.has_differentials:
-            clone.set_differentials(self.x_o, self.x_d, self.y_o, self.y_d)
+        # Copies the slots without reinitializing (the direction is already normalized); shares the statistics
+        clone = object.__new__(type(self))
+        clone.color = self.color
+        for name in Ray.__slots__:
+            setattr(clone, name, getattr(self, name))
+        clone.o = self.o.copy()
+        clone.d = self.d.copy()
         return clone
                         
     def __deepcopy__(self):
-        clone = type(self)(self.o.copy(), self.d.copy(), start=self.start, end=self.end, time=self.time, depth=self.depth, color=self.color)
+        clone = self.__copy__()
         clone.stats = self.stats.__deepcopy__()
-        if self.has_differentials:
-            clone.set_differentials(self.x_o, self.x_d, self.y_o, self.y_d)
         return clone
         
     def set_differentials(self, x_o, x_d, y_o, y_d):
@@ -65,9 +81,15 @@ class Ray(Entity):
 ## Intersection
 ###############################################################################    
 class Intersection(Entity):
+
+    __slots__ = ('id', 'p', 't', 'n')
     
     def __init__(self, color='g'):
         super(Intersection, self).__init__(color=color)
+        self.reset()
+
+    def reset(self):
+        # Clears the hit (e.g. a pooled intersection reused for the next sample)
         self.id = None
         self.p  = None
         self.t  = None
@@ -90,20 +112,150 @@ class Intersection(Entity):
                         
     def __deepcopy__(self):
         clone = type(self)(color=self.color)
-        if self.p:
+        clone.id = self.id
+        if self.p is not None:
             clone.p = self.p.copy()
             clone.t = self.t
-        if self.n:
+        if self.n is not None:
             clone.n = self.n.copy()
         return clone
     
+###############################################################################
+## RayBatch
+###############################################################################
+class RayBatch(Entity):
+    
+    def __init__(self, origins, directions, start=0.0, end=np.inf, time=0.0, depth=0, color='k'):
+        super(RayBatch, self).__init__(color=color)
+        count = origins.shape[0]
+        self.o = origins
+        self.d = normalize_rows(directions)
+        self.tMin = np.full((count), start, dtype=np.float64)
+        self.tMax = np.full((count), end, dtype=np.float64)
+        self.time = np.zeros((count)) + time
+        self.depth = depth
+        self.stats = Stats(count=count)
+        
+    def __len__(self):
+        return self.o.shape[0]
+
+    def dim(self):
+        return self.o.shape[1]
+
+    def __call__(self, t):
+        return self.o + self.d * t[:, np.newaxis]
+
+    def __getitem__(self, k):
+        ray = Ray(self.o[k].copy(), self.d[k].copy(), start=self.tMin[k], end=self.tMax[k], time=self.time[k], depth=self.depth, color=self.color)
+        ray.d = self.d[k].copy()
+        ray.stats.pcount = int(self.stats.pcount[k])
+        ray.stats.scount = int(self.stats.scount[k])
+        ray.stats.rcount = int(self.stats.rcount[k])
+        ray.stats.tcount = int(self.stats.tcount[k])
+        return ray
+
+    def store(self, k, ray):
+        # Write back the state of a ray obtained through __getitem__
+        self.tMax[k] = ray.tMax
+        self.stats.pcount[k] = ray.stats.pcount
+        self.stats.scount[k] = ray.stats.scount
+        self.stats.rcount[k] = ray.stats.rcount
+        self.stats.tcount[k] = ray.stats.tcount
+
+    def subset(self, indices):
+        clone = self.__copy__(indices)
+        clone.stats = Stats(count=len(clone))
+        return clone
+
+    def merge(self, indices, rays):
+        # Write back the state of a batch obtained through subset
+        self.tMax[indices] = rays.tMax
+        self.stats.pcount[indices] += rays.stats.pcount
+        self.stats.scount[indices] += rays.stats.scount
+        self.stats.rcount[indices] += rays.stats.rcount
+        self.stats.tcount[indices] += rays.stats.tcount
+
+    def __copy__(self, indices=slice(None)):
+        clone = type(self)(self.o[indices], self.d[indices], depth=self.depth, color=self.color)
+        clone.d = self.d[indices]
+        clone.tMin = self.tMin[indices]
+        clone.tMax = self.tMax[indices]
+        clone.time = self.time[indices]
+        clone.stats = Stats(count=len(clone))
+        clone.stats.pcount += self.stats.pcount[indices]
+        clone.stats.scount += self.stats.scount[indices]
+        clone.stats.rcount += self.stats.rcount[indices]
+        clone.stats.tcount += self.stats.tcount[indices]
+        return clone
+                        
+    def __deepcopy__(self):
+        clone = self.__copy__()
+        clone.o = clone.o.copy()
+        clone.d = clone.d.copy()
+        clone.tMin = clone.tMin.copy()
+        clone.tMax = clone.tMax.copy()
+        clone.time = clone.time.copy()
+        return clone
+
+###############################################################################
+## IntersectionBatch
+###############################################################################    
+class IntersectionBatch(Entity):
+    
+    def __init__(self, count, N=3, color='g'):
+        super(IntersectionBatch, self).__init__(color=color)
+        self.id = np.full((count), -1, dtype=np.int64)
+        self.p  = np.zeros((count, N))
+        self.t  = np.full((count), np.inf)
+        self.n  = np.zeros((count, N))
+
+    def __len__(self):
+        return self.id.shape[0]
+
+    def dim(self):
+        return self.p.shape[1]
+
+    def hit(self):
+        return self.id >= 0
+    
+    def update(self, k, i, p, t, n):
+        self.id[k] = i
+        self.p[k]  = p
+        self.t[k]  = t
+        self.n[k]  = n
+
+    def __getitem__(self, k):
+        isect = Intersection(color=self.color)
+        if self.id[k] >= 0:
+            isect.update(int(self.id[k]), self.p[k].copy(), self.t[k], self.n[k].copy())
+        return isect
+
+    def store(self, k, isect):
+        self.update(k, isect.id, isect.p, isect.t, isect.n)
+
+    def merge(self, indices, isects):
+        # Write back the hits of a batch of intersections for the rays with the given indices
+        hit = isects.hit()
+        self.update(indices[hit], isects.id[hit], isects.p[hit], isects.t[hit], isects.n[hit])
+    
 ###############################################################################
 ## Stats
 ###############################################################################    
 class Stats(object):
+
+    __slots__ = ('pcount', 'scount', 'rcount', 'tcount')
     
-    def __init__(self):
+    def __init__(self, count=None):
         super(Stats, self).__init__()
+        if count is None:
+            self.reset()
+        else:
+            self.pcount = np.zeros((count), dtype=np.int64)
+            self.scount = np.zeros((count), dtype=np.int64)
+            self.rcount = np.zeros((count), dtype=np.int64)
+            self.tcount = np.zeros((count), dtype=np.int64)
+
+    def reset(self):
         self.pcount = 0
         self.scount = 0
         self.rcount = 0
@@ -114,8 +266,8 @@ class Stats(object):
                         
     def __deepcopy__(self):
         clone = type(self)()
-        clone.pcount = self.pcount
-        clone.scount = self.scount
-        clone.rcount = self.rcount
-        clone.tcount = self.tcount
+        clone.pcount = copy(self.pcount)
+        clone.scount = copy(self.scount)
+        clone.rcount = copy(self.rcount)
+        clone.tcount = copy(self.tcount)
         return clone
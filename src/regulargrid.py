@@ -7,302 +7,325 @@ MAX_NB_CELLS = 64
 ## RegularGrid
 ###############################################################################
 from aggregate import Aggregate
-from group import Group
 from line import Line
-from threading import Lock
+from nAABB import NAABB
+from ray import IntersectionBatch
+import stats
+from trianglemesh import split_triangles
 
 class RegularGrid(Aggregate):
+    '''
+    Uniform grid whose cell contents are stored in CSR form: the primitives
+    of the flat cell c are cell_faces[cell_face_offsets[c]:cell_face_offsets[c+1]]
+    (faces of the TriangleMesh gathering all triangles) followed by
+    cell_shapes[cell_shape_offsets[c]:cell_shape_offsets[c+1]] (indices into
+    the other shapes).
+    '''
 
-    def __init__(self, shapes=[], resolution=None, i=None, color='k', cell_type=Group):
+    def __init__(self, shapes=[], resolution=None, overlap=False, i=None, color='k'):
+        self.resolution = resolution
+        self.overlap = overlap
         super(RegularGrid, self).__init__(shapes=shapes, i=i, color=color)
-        self.access_count = 0
-        self.lock = Lock()
-        self._build(cell_type=cell_type)
 
-    def _build(self, cell_type=Group, resolution=None, **kwargs):
+    def _update(self):
+        self._build(resolution=self.resolution, overlap=self.overlap)
+
+    def _build(self, resolution=None, overlap=False, **kwargs):
+        self.mesh, self.others = split_triangles(self.shapes)
+        self.nb_faces = len(self.mesh)
+
+        # Primitive bounds
+        prim_min, prim_max = self.mesh.face_bounds()
+        if len(self.others) != 0:
+            bounds = [shape.bounds() for shape in self.others]
+            prim_min = np.concatenate((prim_min, [b.pMin for b in bounds]))
+            prim_max = np.concatenate((prim_max, [b.pMax for b in bounds]))
+        self.nb_prims = prim_min.shape[0]
+
         # Grid resolution
-        self.bounds = super(RegularGrid, self).bounds()
-        d = self.bounds.diagonal()
-        if resolution is None:
-            max_axis = self.bounds.maximum_extent()
+        if self.nb_prims == 0:
+            self.pMin = np.zeros((3))
+            self.pMax = np.zeros((3))
+        else:
+            self.pMin = prim_min.min(axis=0)
+            self.pMax = prim_max.max(axis=0)
+        d = self.pMax - self.pMin
+        if resolution is not None:
+            self.shape = np.array(resolution, dtype=int)
+        elif d.max() == 0.0:
+            self.shape = np.ones((3), dtype=int)
+        else:
+            max_axis = np.argmax(d)
             inv_max_width = 1.0 / d[max_axis]
-            cube_root = 3.0 * pow(float(len(self.shapes)), 1.0/3.0)
+            cube_root = 3.0 * pow(float(self.nb_prims), 1.0/3.0)
             cells_per_unit_dist = cube_root * inv_max_width
             self.shape = np.zeros((3), dtype=int)
             for axis in range(3):
-                self.shape[axis] = round2int(d[axis] * cells_per_unit_dist)
-                self.shape[axis] = clamp(self.shape[axis], 1, MAX_NB_CELLS)
-        else:
-            self.shape = resolution.copy()
-        self.width = np.zeros((3))
+                self.shape[axis] = clamp(round2int(d[axis] * cells_per_unit_dist), 1, MAX_NB_CELLS)
+        self._set_resolution()
+
+        # Partition primitives: enumerate the cells of the cell range of every primitive
+        cell_min = self._cells(prim_min)
+        extent = self._cells(prim_max) - cell_min + 1
+        counts = np.prod(extent, axis=1)
+        prims = np.repeat(np.arange(self.nb_prims, dtype=np.int64), counts)
+        local = np.arange(prims.shape[0], dtype=np.int64) - np.repeat(np.cumsum(counts) - counts, counts)
+        extent = extent[prims]
+        pos = cell_min[prims]
+        pos[:,2] += local % extent[:,2]
+        pos[:,1] += (local // extent[:,2]) % extent[:,1]
+        pos[:,0] += local // (extent[:,2] * extent[:,1])
+
+        if overlap:
+            # Drop the cells which faces spanning multiple cells do not overlap
+            test = np.nonzero((prims < self.nb_faces) & (counts[prims] > 1))[0]
+            eps = 1e-7 * d.max()
+            b_min = self.pMin + pos[test] * self.width - eps
+            b_max = b_min + self.width + 2.0 * eps
+            keep = np.ones((prims.shape[0]), dtype=bool)
+            keep[test] = self.mesh.face_box_overlap(prims[test], b_min, b_max)
+            prims, pos = prims[keep], pos[keep]
+
+        self._set_cells(pos.dot(self.strides), prims)
+
+    def _set_resolution(self):
+        # Precompute the constants derived from the bounds and the resolution
+        self.width = (self.pMax - self.pMin) / self.shape
         self.inv_width = np.zeros((3))
-        for axis in range(3):
-            self.width[axis] = d[axis] / self.shape[axis]
-            if self.width[axis] == 0.0:
-                self.inv_width[axis] = 0.0
-            else:
-                self.inv_width[axis] = 1.0 / self.width[axis]
-
-        self.cells = np.empty((self.shape[0], self.shape[1], self.shape[2]), dtype=cell_type)
-        if cell_type is not Group:
-            for x in range(self.shape[0]):
-                for y in range(self.shape[1]):
-                    for z in range(self.shape[2]):
-                        self.cells[x,y,z] = cell_type()
-
-        # Partition shapes
-        for shape in self.shapes:
-            box = shape.bounds()
-            cell_min = np.zeros((3), dtype=int)
-            cell_max = np.zeros((3), dtype=int)
-            for axis in range(3):
-                cell_min[axis] = self._cell(box.pMin, axis)
-                cell_max[axis] = self._cell(box.pMax, axis)
-       
-            for x in range(cell_min[0], cell_max[0]+1):
-                for y in range(cell_min[1], cell_max[1]+1):
-                    for z in range(cell_min[2], cell_max[2]+1):
-                        if self.cells[x,y,z] is None:
-                            self.cells[x,y,z] = cell_type(shape)
-                        else:
-                            self.cells[x,y,z].append(shape)
-
-    def _cell(self, point, axis):
-        return clamp(int((point[axis] - self.bounds.pMin[axis]) * self.inv_width[axis]), 0, self.shape[axis]-1)
-
-    def _pos(self, point,  axis):
-        return self.bounds.pMin[axis] + point * self.width[axis]
+        self.inv_width[self.width != 0.0] = 1.0 / self.width[self.width != 0.0]
+        self.strides = np.array([self.shape[1] * self.shape[2], self.shape[2], 1], dtype=np.int64)
+        self.nb_cells = int(np.prod(self.shape))
+        self._lists = (self.pMin.tolist(), self.pMax.tolist(), self.width.tolist(), self.inv_width.tolist(), self.shape.tolist())
+
+    def _set_cells(self, cell_ids, prims):
+        # Store the (cell, primitive) pairs as CSR arrays, separately for the mesh faces and the other shapes
+        faces = prims < self.nb_faces
+        self.cell_face_offsets, self.cell_faces = _csr(cell_ids[faces], prims[faces], self.nb_cells)
+        self.cell_shape_offsets, self.cell_shapes = _csr(cell_ids[~faces], prims[~faces] - self.nb_faces, self.nb_cells)
+
+    def get_arrays(self):
+        # The arrays defining the built grid (besides the mesh), e.g. for caching
+        if len(self.others) != 0:
+            raise ValueError('Only grids of triangles can be stored as arrays')
+        return {'pMin' : self.pMin, 'pMax' : self.pMax, 'shape' : self.shape,
+                'cell_face_offsets' : self.cell_face_offsets, 'cell_faces' : self.cell_faces}
+
+    def set_arrays(self, mesh, arrays):
+        # Restores a grid over the given mesh from the arrays returned by get_arrays without rebuilding it
+        self.shapes = [mesh]
+        self.mesh = mesh
+        self.others = []
+        self.nb_faces = len(mesh)
+        self.nb_prims = self.nb_faces
+        self.pMin = np.array(arrays['pMin'])
+        self.pMax = np.array(arrays['pMax'])
+        self.shape = np.array(arrays['shape'], dtype=int)
+        self._set_resolution()
+        self.cell_face_offsets = arrays['cell_face_offsets']
+        self.cell_faces = arrays['cell_faces']
+        self.cell_shape_offsets = np.zeros((self.nb_cells + 1), dtype=np.int64)
+        self.cell_shapes = np.zeros((0), dtype=np.int64)
+        return self
+
+    def _cells(self, points):
+        return np.clip(((points - self.pMin) * self.inv_width).astype(np.int64), 0, self.shape - 1)
 
     def bounds(self):
-        return self.bounds
+        if self.nb_prims == 0:
+            return NAABB(N=3)
+        return NAABB(self.pMin.copy(), self.pMax.copy())
 
     def intersect(self, ray, isect=None):
-        self.lock.acquire()
-        self.access_count += 1
-        self.lock.release()
+        return self._traverse(ray, isect, None)
 
-        if isect is None:
-            if self.bounds.inside(ray(ray.tMin)):
-                ray_t = ray.tMin
-            else:
-                hit, ray_t, _, _, _ =  self.bounds.intersect_info(ray)
-                if not hit:
-                    return False
-            grid_isect = ray(ray_t)
-
-            # Set up 3D DDA for ray
-            next_crossing_t = np.zeros((3))
-            delta_t = np.zeros((3))
-            step = np.zeros((3), dtype=int)
-            out = np.zeros((3), dtype=int)
-            pos = np.zeros((3), dtype=int)
-            for axis in range(3):
-                # Compute current cell for axis
-                pos[axis] = self._cell(grid_isect, axis)
-                if ray.d[axis] >= 0.0:
-                    # Handle ray with positive direction for cell stepping
-                    next_crossing_t[axis] = ray_t + (self._pos(pos[axis]+1, axis) - grid_isect[axis]) / ray.d[axis]
-                    delta_t[axis] = self.width[axis] / ray.d[axis]
-                    step[axis] = 1
-                    out[axis] = self.shape[axis]
-                else:
-                    # Handle ray with negative direction for cell stepping
-                    next_crossing_t[axis] = ray_t + (self._pos(pos[axis], axis) - grid_isect[axis]) / ray.d[axis]
-                    delta_t[axis] = -self.width[axis] / ray.d[axis]
-                    step[axis] = -1
-                    out[axis] = -1
-
-            # Walk ray through cell grid
-            hit = False
-            while True:
-                # Check for intersection in current cell and advance to next
-                cell = self.cells[pos[0], pos[1], pos[2]]
-                if (cell is not None) and cell.intersect(ray):
-                    return True
-                ray.stats.scount += 1
-
-                # Advance to next cell
-                bits = ((next_crossing_t[0] < next_crossing_t[1]) << 2) + \
-                       ((next_crossing_t[0] < next_crossing_t[2]) << 1) + \
-                       ((next_crossing_t[1] < next_crossing_t[2]))
-                compare_to_axis = [2, 1, 2, 1, 2, 2, 0, 0]
-                step_axis = compare_to_axis[bits]
-                if (ray.tMax < next_crossing_t[step_axis]):
-                    break
-                pos[step_axis] += step[step_axis]
-                if pos[step_axis] == out[step_axis]:
-                    break
-                next_crossing_t[step_axis] += delta_t[step_axis]
+    def occluded(self, ray):
+        return self._traverse(ray, None, None)
 
+    def intersect_exclusive(self, excl, ray, isect=None):
+        if self.id in excl:
             return False
-        else:
-            if self.bounds.inside(ray(ray.tMin)):
-                ray_t = ray.tMin
-            else:
-                hit, ray_t, _, _, _ =  self.bounds.intersect_info(ray)
-                if not hit:
-                    return False
-            grid_isect = ray(ray_t)
-
-            # Set up 3D DDA for ray
-            next_crossing_t = np.zeros((3))
-            delta_t = np.zeros((3))
-            step = np.zeros((3), dtype=int)
-            out = np.zeros((3), dtype=int)
-            pos = np.zeros((3), dtype=int)
-            for axis in range(3):
-                # Compute current cell for axis
-                pos[axis] = self._cell(grid_isect, axis)
-                if ray.d[axis] >= 0.0:
-                    # Handle ray with positive direction for cell stepping
-                    next_crossing_t[axis] = ray_t + (self._pos(pos[axis]+1, axis) - grid_isect[axis]) / ray.d[axis]
-                    delta_t[axis] = self.width[axis] / ray.d[axis]
-                    step[axis] = 1
-                    out[axis] = self.shape[axis]
-                else:
-                    # Handle ray with negative direction for cell stepping
-                    next_crossing_t[axis] = ray_t + (self._pos(pos[axis], axis) - grid_isect[axis]) / ray.d[axis]
-                    delta_t[axis] = -self.width[axis] / ray.d[axis]
-                    step[axis] = -1
-                    out[axis] = -1
-
-            # Walk ray through cell grid
-            hit = False
-            while True:
-                # Check for intersection in current cell and advance to next
-                cell = self.cells[pos[0], pos[1], pos[2]]
-                if cell is not None:
-                    hit |= cell.intersect(ray, isect)
-                ray.stats.pcount += 1
-
-                # Advance to next cell
-                bits = ((next_crossing_t[0] < next_crossing_t[1]) << 2) + \
-                       ((next_crossing_t[0] < next_crossing_t[2]) << 1) + \
-                       ((next_crossing_t[1] < next_crossing_t[2]))
-                compare_to_axis = [2, 1, 2, 1, 2, 2, 0, 0]
-                step_axis = compare_to_axis[bits]
-                if (ray.tMax < next_crossing_t[step_axis]):
-                    break
-                pos[step_axis] += step[step_axis]
-                if pos[step_axis] == out[step_axis]:
-                    break
-                next_crossing_t[step_axis] += delta_t[step_axis]
-
-            return hit
+        return self._traverse(ray, isect, excl)
 
-    def intersect_exclusive(self, excl, ray, isect=None):
-        self.lock.aquire()
-        self.access_count += 1
-        self.lock.release()
+    def _traverse(self, ray, isect, excl):
+        if self.nb_prims == 0:
+            return False
+        pMin, pMax, width, inv_width, shape = self._lists
+        o = ray.o.tolist()
+        d = ray.d.tolist()
 
-        if isect is None:
-            if self.bounds.inside(ray(ray.tMin)):
-                ray_t = ray.tMin
-            else:
-                hit, ray_t, _, _, _ =  self.bounds.intersect_info(ray)
-                if not hit:
+        # Clip the ray against the grid bounds
+        ray_t = ray.tMin
+        t_max = ray.tMax
+        for axis in range(3):
+            if d[axis] == 0.0:
+                if o[axis] < pMin[axis] or o[axis] > pMax[axis]:
                     return False
-            grid_isect = ray(ray_t)
-
-            # Set up 3D DDA for ray
-            next_crossing_t = np.zeros((3))
-            delta_t = np.zeros((3))
-            step = np.zeros((3), dtype=int)
-            out = np.zeros((3), dtype=int)
-            pos = np.zeros((3), dtype=int)
-            for axis in range(3):
-                # Compute current cell for axis
-                pos[axis] = self._cell(grid_isect, axis)
-                if ray.d[axis] >= 0.0:
-                    # Handle ray with positive direction for cell stepping
-                    next_crossing_t[axis] = ray_t + (self._pos(pos[axis]+1, axis) - grid_isect[axis]) / ray.d[axis]
-                    delta_t[axis] = self.width[axis] / ray.d[axis]
-                    step[axis] = 1
-                    out[axis] = self.shape[axis]
-                else:
-                    # Handle ray with negative direction for cell stepping
-                    next_crossing_t[axis] = ray_t + (self._pos(pos[axis], axis) - grid_isect[axis]) / ray.d[axis]
-                    delta_t[axis] = -self.width[axis] / ray.d[axis]
-                    step[axis] = -1
-                    out[axis] = -1
-
-            # Walk ray through cell grid
-            hit = False
-            while True:
-                # Check for intersection in current cell and advance to next
-                cell = self.cells[pos[0], pos[1], pos[2]]
-                if (cell is not None) and cell.intersect_exclusive(self, excl, ray):
+                continue
+            t_near = (pMin[axis] - o[axis]) / d[axis]
+            t_far  = (pMax[axis] - o[axis]) / d[axis]
+            if t_near > t_far:
+                t_near, t_far = t_far, t_near
+            if t_near > ray_t:
+                ray_t = t_near
+            if t_far < t_max:
+                t_max = t_far
+            if ray_t > t_max:
+                return False
+
+        # Set up 3D DDA for ray
+        next_crossing_t = [np.inf] * 3
+        delta_t = [np.inf] * 3
+        step = [0] * 3
+        out = [0] * 3
+        pos = [0] * 3
+        for axis in range(3):
+            # Compute current cell for axis
+            p = o[axis] + ray_t * d[axis]
+            pos[axis] = min(max(int((p - pMin[axis]) * inv_width[axis]), 0), shape[axis]-1)
+            if d[axis] > 0.0:
+                # Handle ray with positive direction for cell stepping
+                next_crossing_t[axis] = ray_t + (pMin[axis] + (pos[axis]+1) * width[axis] - p) / d[axis]
+                delta_t[axis] = width[axis] / d[axis]
+                step[axis] = 1
+                out[axis] = shape[axis]
+            elif d[axis] < 0.0:
+                # Handle ray with negative direction for cell stepping
+                next_crossing_t[axis] = ray_t + (pMin[axis] + pos[axis] * width[axis] - p) / d[axis]
+                delta_t[axis] = -width[axis] / d[axis]
+                step[axis] = -1
+                out[axis] = -1
+
+        # Walk ray through cell grid
+        hit = False
+        while True:
+            # Check for intersection in current cell and advance to next
+            if self._intersect_cell((pos[0] * shape[1] + pos[1]) * shape[2] + pos[2], ray, isect, excl):
+                hit = True
+                if isect is None:
                     return True
-                ray.stats.scount += 1
-
-                # Advance to next cell
-                bits = ((next_crossing_t[0] < next_crossing_t[1]) << 2) + \
-                       ((next_crossing_t[0] < next_crossing_t[2]) << 1) + \
-                       ((next_crossing_t[1] < next_crossing_t[2]))
-                compare_to_axis = [2, 1, 2, 1, 2, 2, 0, 0]
-                step_axis = compare_to_axis[bits]
-                if (ray.tMax < next_crossing_t[step_axis]):
-                    break
-                pos[step_axis] += step[step_axis]
-                if pos[step_axis] == out[step_axis]:
-                    break
-                next_crossing_t[step_axis] += delta_t[step_axis]
+            if __debug__ and stats.enabled:
+                stats.count_tests(ray, stats.CELLS_TRAVERSED, closest=isect is not None)
 
-            return False
-        else:
-            if self.bounds.inside(ray(ray.tMin)):
-                ray_t = ray.tMin
+            # Advance to next cell
+            if next_crossing_t[0] < next_crossing_t[1]:
+                step_axis = 0 if next_crossing_t[0] < next_crossing_t[2] else 2
             else:
-                hit, ray_t, _, _, _ =  self.bounds.intersect_info(ray)
-                if not hit:
-                    return False
-            grid_isect = ray(ray_t)
-
-            # Set up 3D DDA for ray
-            next_crossing_t = np.zeros((3))
-            delta_t = np.zeros((3))
-            step = np.zeros((3), dtype=int)
-            out = np.zeros((3), dtype=int)
-            pos = np.zeros((3), dtype=int)
-            for axis in range(3):
-                # Compute current cell for axis
-                pos[axis] = self._cell(grid_isect, axis)
-                if ray.d[axis] >= 0.0:
-                    # Handle ray with positive direction for cell stepping
-                    next_crossing_t[axis] = ray_t + (self._pos(pos[axis]+1, axis) - grid_isect[axis]) / ray.d[axis]
-                    delta_t[axis] = self.width[axis] / ray.d[axis]
-                    step[axis] = 1
-                    out[axis] = self.shape[axis]
+                step_axis = 1 if next_crossing_t[1] < next_crossing_t[2] else 2
+            if ray.tMax < next_crossing_t[step_axis]:
+                break
+            pos[step_axis] += step[step_axis]
+            if pos[step_axis] == out[step_axis]:
+                break
+            next_crossing_t[step_axis] += delta_t[step_axis]
+        return hit
+
+    def _intersect_cell(self, cell, ray, isect, excl):
+        hit = False
+        f0, f1 = self.cell_face_offsets[cell], self.cell_face_offsets[cell+1]
+        if f1 > f0:
+            faces = self.cell_faces[f0:f1]
+            if excl is not None:
+                faces = faces[~np.isin(self.mesh.face_ids[faces], list(excl))]
+            hit = self.mesh.intersect_faces(faces, ray, isect=isect)
+            if hit and isect is None:
+                return True
+        for p in self.cell_shapes[self.cell_shape_offsets[cell]:self.cell_shape_offsets[cell+1]]:
+            shape = self.others[p]
+            if excl is None:
+                hit_shape = shape.intersect(ray, isect) if isect is not None else shape.occluded(ray)
+            else:
+                hit_shape = shape.intersect_exclusive(excl, ray, isect)
+            if hit_shape:
+                hit = True
+                if isect is None:
+                    return True
+        return hit
+
+    def intersect_batch(self, rays, isects=None):
+        hits = np.zeros((len(rays)), dtype=bool)
+        if self.nb_prims == 0 or len(rays) == 0:
+            return hits
+
+        # Clip the rays against the grid bounds
+        parallel = (rays.d == 0.0)
+        inside = (rays.o >= self.pMin) & (rays.o <= self.pMax)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            inv_d = 1.0 / rays.d
+            t0 = (self.pMin - rays.o) * inv_d
+            t1 = (self.pMax - rays.o) * inv_d
+        t_near = np.where(parallel, np.where(inside, -np.inf, np.inf), np.minimum(t0, t1))
+        t_far  = np.where(parallel, np.where(inside, np.inf, -np.inf), np.maximum(t0, t1))
+        ray_t = np.maximum(t_near.max(axis=1), rays.tMin)
+        t_far = np.minimum(t_far.min(axis=1), rays.tMax)
+
+        # Set up 3D DDA for all rays entering the grid
+        ids = np.nonzero(ray_t <= t_far)[0]
+        ray_t = ray_t[ids, np.newaxis]
+        d = rays.d[ids]
+        p = rays.o[ids] + ray_t * d
+        pos = self._cells(p)
+        positive = (d >= 0.0)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            next_crossing_t = ray_t + (self.pMin + (pos + positive) * self.width - p) * inv_d[ids]
+            delta_t = self.width * np.abs(inv_d[ids])
+        next_crossing_t[parallel[ids]] = np.inf
+        delta_t[parallel[ids]] = np.inf
+        step = np.where(positive, 1, -1)
+        out = np.where(positive, self.shape, -1)
+
+        # Walk all rays simultaneously through the cell grid
+        while ids.shape[0] != 0:
+            self._intersect_cells(ids, pos.dot(self.strides), rays, isects, hits)
+            if __debug__ and stats.enabled:
+                stats.count_batch_tests(rays, stats.CELLS_TRAVERSED, closest=isects is not None, indices=ids)
+
+            # Advance to next cell
+            rows = np.arange(ids.shape[0])
+            step_axis = np.argmin(next_crossing_t, axis=1)
+            keep = (rays.tMax[ids] >= next_crossing_t[rows, step_axis])
+            pos[rows, step_axis] += step[rows, step_axis]
+            keep &= (pos[rows, step_axis] != out[rows, step_axis])
+            next_crossing_t[rows, step_axis] += delta_t[rows, step_axis]
+            if isects is None:
+                # Occluded rays are done
+                keep &= ~hits[ids]
+            ids, pos, next_crossing_t, delta_t, step, out = ids[keep], pos[keep], next_crossing_t[keep], delta_t[keep], step[keep], out[keep]
+        return hits
+
+    def occluded_batch(self, rays):
+        return self.intersect_batch(rays)
+
+    def _intersect_cells(self, ids, cells, rays, isects, hits):
+        # Test the rays ids against the faces of their current cells at once
+        f0 = self.cell_face_offsets[cells]
+        counts = self.cell_face_offsets[cells+1] - f0
+        nb_pairs = counts.sum()
+        if nb_pairs != 0:
+            ks = np.repeat(ids, counts)
+            faces = self.cell_faces[np.repeat(f0 - np.cumsum(counts) + counts, counts) + np.arange(nb_pairs)]
+            hits |= self.mesh.intersect_pairs_batch(ks, faces, rays, isects=isects)
+
+        # Test the other shapes per cell
+        s0 = self.cell_shape_offsets[cells]
+        s1 = self.cell_shape_offsets[cells+1]
+        for cell in np.unique(cells[s1 > s0]):
+            idx = ids[cells == cell]
+            if isects is None:
+                idx = idx[~hits[idx]]
+                if idx.shape[0] == 0:
+                    continue
+            sub = rays.subset(idx)
+            sub_isects = None if isects is None else IntersectionBatch(idx.shape[0])
+            sub_hits = np.zeros((idx.shape[0]), dtype=bool)
+            for p in self.cell_shapes[self.cell_shape_offsets[cell]:self.cell_shape_offsets[cell+1]]:
+                if isects is None:
+                    sub_hits |= self.others[p].occluded_batch(sub)
                 else:
-                    # Handle ray with negative direction for cell stepping
-                    next_crossing_t[axis] = ray_t + (self._pos(pos[axis], axis) - grid_isect[axis]) / ray.d[axis]
-                    delta_t[axis] = -self.width[axis] / ray.d[axis]
-                    step[axis] = -1
-                    out[axis] = -1
-
-            # Walk ray through cell grid
-            hit = False
-            while True:
-                # Check for intersection in current cell and advance to next
-                cell = self.cells[pos[0], pos[1], pos[2]]
-                if cell is not None:
-                    hit |= cell.intersect_exclusive(self, excl, ray, isect)
-                ray.stats.pcount += 1
-
-                # Advance to next cell
-                bits = ((next_crossing_t[0] < next_crossing_t[1]) << 2) + \
-                       ((next_crossing_t[0] < next_crossing_t[2]) << 1) + \
-                       ((next_crossing_t[1] < next_crossing_t[2]))
-                compare_to_axis = [2, 1, 2, 1, 2, 2, 0, 0]
-                step_axis = compare_to_axis[bits]
-                if (ray.tMax < next_crossing_t[step_axis]):
-                    break
-                pos[step_axis] += step[step_axis]
-                if pos[step_axis] == out[step_axis]:
-                    break
-                next_crossing_t[step_axis] += delta_t[step_axis]
-
-            return hit
+                    sub_hits |= self.others[p].intersect_batch(sub, sub_isects)
+            rays.merge(idx, sub)
+            hits[idx] |= sub_hits
+            if isects is not None:
+                isects.merge(idx, sub_isects)
 
     def accept(self, visitor, grid=False, **kwargs):
         super(RegularGrid, self).accept(visitor)
@@ -311,27 +334,33 @@ class RegularGrid(Aggregate):
             # fixed z lines
             for x in range(self.shape[0]+1):
                 for y in range(self.shape[1]+1):
-                    v1 = self.bounds.pMin.__copy__()
+                    v1 = self.pMin.copy()
                     v1[0] += x * self.width[0]
                     v1[1] += y * self.width[1]
                     v2 = v1.copy()
-                    v2[2] = self.bounds.pMax[2]
+                    v2[2] = self.pMax[2]
                     Line(v1, v2, color=self.color).accept(visitor)
             # fixed x lines
             for y in range(self.shape[1]+1):
                 for z in range(self.shape[2]+1):
-                    v1 = self.bounds.pMin.__copy__()
+                    v1 = self.pMin.copy()
                     v1[1] += y * self.width[1]
                     v1[2] += z * self.width[2]
                     v2 = v1.copy()
-                    v2[0] = self.bounds.pMax[0]
+                    v2[0] = self.pMax[0]
                     Line(v1, v2, color=self.color).accept(visitor)
             # fixed y lines
             for z in range(self.shape[2]+1):
                 for x in range(self.shape[0]+1):
-                    v1 = self.bounds.pMin.__copy__()
+                    v1 = self.pMin.copy()
                     v1[2] += z * self.width[2]
                     v1[0] += x * self.width[0]
                     v2 = v1.copy()
-                    v2[1] = self.bounds.pMax[1]
+                    v2[1] = self.pMax[1]
                     Line(v1, v2, color=self.color).accept(visitor)
+
+def _csr(cell_ids, prims, nb_cells):
+    # Returns the offsets per cell and the primitives sorted by cell
+    offsets = np.zeros((nb_cells + 1), dtype=np.int64)
+    offsets[1:] = np.cumsum(np.bincount(cell_ids, minlength=nb_cells))
+    return offsets, prims[np.argsort(cell_ids, kind='stable')]
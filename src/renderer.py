@@ -1,7 +1,10 @@
+import numpy as np
+
 ###############################################################################
 ## Renderer
 ###############################################################################
 from abc import ABCMeta, abstractmethod
+from ray import IntersectionBatch
 
 class Renderer(object):
 
@@ -14,3 +17,17 @@ class Renderer(object):
     @abstractmethod
     def Li(self, scene, ray, sample, rng, isect=None):
         return
+
+    def Li_batch(self, scene, rays, rng, isects=None):
+        # Fallback: evaluate the rays of the batch one at a time; returns the radiances, intersections and transmittances
+        if isects is None:
+            isects = IntersectionBatch(len(rays))
+        Ls = np.zeros((len(rays), 3))
+        Ts = np.ones((len(rays), 3))
+        for k in range(len(rays)):
+            ray = rays[k]
+            Ls[k], isect, Ts[k] = self.Li(scene, ray, None, rng, isects[k])
+            rays.store(k, ray)
+            if isect.id is not None:
+                isects.store(k, isect)
+        return Ls, isects, Ts
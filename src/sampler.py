@@ -1,3 +1,4 @@
+import numpy as np
 from math_utils import lerp
 
 ###############################################################################
@@ -22,6 +23,19 @@ class Sampler(object):
     def get_more_samples(self, sample, rng):
         return
 
+    def get_more_samples_batch(self, samples, rng, max_count):
+        # Fallback: collect the samples of successive get_more_samples calls
+        image_xy, lens_uv, time = [], [], []
+        while len(time) < max_count:
+            sample_count = self.get_more_samples(samples, rng)
+            if sample_count <= 0:
+                break
+            for sample in samples[:sample_count]:
+                image_xy.append((sample.image_x, sample.image_y))
+                lens_uv.append((sample.lens_u, sample.lens_v))
+                time.append(sample.time)
+        return np.array(image_xy).reshape((-1, 2)), np.array(lens_uv).reshape((-1, 2)), np.array(time)
+
     @abstractmethod
     def maximum_sample_count(self):
         return
@@ -33,6 +47,18 @@ class Sampler(object):
     def get_sub_sampler(self, num, count):
         return
 
+    def get_tile_sampler(self, x_start, x_end, y_start, y_end):
+        # Sampler of the given window (within the window of this sampler)
+        return self._duplicate(x_start, x_end, y_start, y_end, self.spp)
+
+    def with_spp(self, spp):
+        # Sampler of the same window taking the given number of samples per pixel
+        return self._duplicate(self.x_pixel_start, self.x_pixel_end, self.y_pixel_start, self.y_pixel_end, spp)
+
+    def _duplicate(self, x_start, x_end, y_start, y_end, spp):
+        # Sampler of the same type and settings for the given window and number of samples per pixel
+        return type(self)(x_start, x_end, y_start, y_end, spp, self.shutter_open, self.shutter_close)
+
     @abstractmethod
     def round_size(self, size):
         return
@@ -60,6 +86,89 @@ class Sampler(object):
         
         return x_start, x_end, y_start, y_end
 
+    def compute_tile_windows(self, tile_size):
+        # Windows (x_start, x_end, y_start, y_end) of the tiles of (at most) tile_size x tile_size pixels
+        # covering the window of this sampler, in scanline order
+        x0, y0 = np.meshgrid(np.arange(self.x_pixel_start, self.x_pixel_end, tile_size), np.arange(self.y_pixel_start, self.y_pixel_end, tile_size))
+        x1 = np.minimum(x0 + tile_size, self.x_pixel_end)
+        y1 = np.minimum(y0 + tile_size, self.y_pixel_end)
+        return np.column_stack((x0.ravel(), x1.ravel(), y0.ravel(), y1.ravel())).tolist()
+
+###############################################################################
+## PixelSampler
+###############################################################################
+class PixelSampler(Sampler):
+    '''
+    Sampler generating the samples of whole pixels at once, as arrays. The
+    pixels of the window are visited in scanline order, one pixel per
+    get_more_samples call or as many whole pixels as fit in a packet.
+    '''
+
+    __metaclass__ = ABCMeta
+
+    def __init__(self, x_start, x_end, y_start, y_end, spp, shutter_open, shutter_close):
+        super(PixelSampler, self).__init__(x_start, x_end, y_start, y_end, spp, shutter_open, shutter_close)
+        # Index of the next pixel within the window (in scanline order)
+        self.pixel_pos = 0
+
+    @abstractmethod
+    def get_pixel_samples(self, nb_pixels, rng):
+        # Image sample offsets within the pixels (nb_pixels,spp,2), lens samples (nb_pixels,spp,2)
+        # and time samples (nb_pixels,spp), all in [0,1)
+        return
+
+    def get_integrator_samples(self, n, d, rng):
+        # Samples requested by the integrators for the spp samples of a pixel: n values of dimension d per sample (spp,n,d)
+        return rng.uniform(size=(self.spp, n, d))
+
+    def get_more_samples(self, samples, rng):
+        image_xy, lens_uv, time = self._next_pixels(1, rng)
+        sample_count = time.shape[0]
+        for k in range(sample_count):
+            sample = samples[k]
+            sample.image_x, sample.image_y = image_xy[k]
+            sample.lens_u,  sample.lens_v  = lens_uv[k]
+            sample.time = time[k]
+
+        # Generate the samples for the integrators
+        if sample_count > 0:
+            for i in range(len(samples[0].n1D)):
+                oneD = self.get_integrator_samples(samples[0].n1D[i], 1, rng)
+                for k in range(sample_count):
+                    samples[k].oneD[i][:] = oneD[k].ravel()
+            for i in range(len(samples[0].n2D)):
+                twoD = self.get_integrator_samples(samples[0].n2D[i], 2, rng)
+                for k in range(sample_count):
+                    samples[k].twoD[i][:] = twoD[k].ravel()
+        return sample_count
+
+    def get_more_samples_batch(self, samples, rng, max_count):
+        return self._next_pixels(max(1, max_count // self.spp), rng)
+
+    def _next_pixels(self, nb_pixels, rng):
+        # Samples of (at most) the given number of next pixels
+        width  = self.x_pixel_end - self.x_pixel_start
+        height = self.y_pixel_end - self.y_pixel_start
+        nb_pixels = max(0, min(nb_pixels, width * height - self.pixel_pos))
+        if nb_pixels == 0:
+            return np.zeros((0, 2)), np.zeros((0, 2)), np.zeros((0))
+        ps = self.pixel_pos + np.arange(nb_pixels)
+        self.pixel_pos += nb_pixels
+
+        image_xy, lens_uv, time = self.get_pixel_samples(nb_pixels, rng)
+        image_xy = image_xy + np.column_stack((self.x_pixel_start + ps % width, self.y_pixel_start + ps // width))[:, np.newaxis]
+        time = lerp(time, self.shutter_close, self.shutter_open)
+        return image_xy.reshape((-1, 2)), lens_uv.reshape((-1, 2)), time.ravel()
+
+    def maximum_sample_count(self):
+        return self.spp
+
+    def get_sub_sampler(self, num, count):
+        x0, x1, y0, y1 = self.compute_sub_window(num, count)
+        if (x0 == x1) or (y0 == y1):
+            return None
+        return self._duplicate(x0, x1, y0, y1, self.spp)
+
 ###############################################################################
 ## CameraSample
 ###############################################################################
@@ -110,5 +219,8 @@ class Sample(CameraSample):
             sample = Sample()
             sample.n1D = copy(self.n1D)
             sample.n2D = copy(self.n2D)
+            # Storage for the integrator samples (the 2D samples are stored as consecutive pairs)
+            sample.oneD = [np.zeros((n)) for n in self.n1D]
+            sample.twoD = [np.zeros((2*n)) for n in self.n2D]
             ret[i] = sample
         return ret
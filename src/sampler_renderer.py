@@ -1,41 +1,83 @@
 import numpy as np
+from time import time
 
 ###############################################################################
 ## SamplerRendererTask
 ###############################################################################
-from ray import Intersection
+from ray import Intersection, IntersectionBatch, Ray
 from sampling import Sampler3D
 from spectrum_utils import y
 
 class SamplerRendererTask():
     
-    def __init__(self, scene, renderer, camera, sampler, sample, i, task_count, rng=None, max_iter=-1):
+    def __init__(self, scene, renderer, camera, sampler, sample, i, task_count, rng=None, max_iter=-1, packet_size=0, film=None, seed=None, window=None):
         self.scene = scene
         self.renderer = renderer
         self.camera = camera
+        if film is None:
+            self.film = camera.film
+        else:
+            self.film = film
         self.orig_sample = sample
         self.task_num = task_count-1-i
         self.task_count = task_count
-        self.sampler = sampler.get_sub_sampler(self.task_num, self.task_count)
+        if window is None:
+            self.sampler = sampler.get_sub_sampler(self.task_num, self.task_count)
+        else:
+            self.sampler = sampler.get_tile_sampler(*window)
+        self.seed = self.task_num if seed is None else seed
         if rng is None:
-            self.rng = Sampler3D(seed=self.task_num)
+            self.rng = Sampler3D(seed=self.seed)
         else:
             self.rng = rng
         self.max_iter = max_iter
+        self.packet_size = packet_size
+        # Wall-clock time spent in the last call (estimates the cost of the task in later passes)
+        self.render_time = 0.0
+        # Film tile rendered by a worker process (see _with_film_tiles)
+        self.film_tile = None
+
+    def __getstate__(self):
+        # The scene, renderer and camera are shipped to each worker process once (see _init_process)
+        state = self.__dict__.copy()
+        for key in ('scene', 'renderer', 'camera', 'film', 'rng'):
+            state[key] = None
+        return state
 
     def __call__(self):
+        # Accumulate the samples in a tile of the film owned by this task, and merge the tile into the film once done
+        film_tile = self.get_film_tile()
+        self.render(film_tile)
+        if film_tile is not None:
+            self.film.merge_film_tile(film_tile)
+
+    def get_film_tile(self):
+        # Tile of the film covering the sub window of this task and the filter margin (None without samples)
+        if not self.sampler:
+            return None
+        return self.film.get_film_tile(self.sampler.x_pixel_start, self.sampler.x_pixel_end, self.sampler.y_pixel_start, self.sampler.y_pixel_end)
+
+    def render(self, film_tile):
         print('Executing task %d/%d' % (self.task_num, self.task_count))
         
         if not self.sampler:
             return
 
-        # Allocate space for samples and intersections
+        start = time()
+        if self.packet_size > 0:
+            self._render_packets(film_tile)
+        else:
+            self._render_samples(film_tile)
+        self.render_time = time() - start
+
+    def _render_samples(self, film):
+        # Allocate space for samples, rays and intersections (reused for every batch of samples)
         max_samples = self.sampler.maximum_sample_count()
         samples     = self.orig_sample.duplicate(max_samples)
-        rays        = [None] * max_samples
+        rays        = [Ray(np.zeros((3)), np.ones((3))) for _ in range(max_samples)]
         Ls          = [None] * max_samples
         Ts          = [None] * max_samples
-        isects      = np.empty(max_samples, dtype=Intersection)
+        isects      = [Intersection() for _ in range(max_samples)]
         
         # Get samples from Sampler and update image
         while self.max_iter != 0:
@@ -50,8 +92,9 @@ class SamplerRendererTask():
             # Generate camera rays and compute radiance along rays
             for i in range(sample_count):
                 # Find camera ray for samples[i]
-                ray_weight, ray_diff = self.camera.generate_ray_differential(samples[i])
+                ray_weight, ray_diff = self.camera.generate_ray_differential(samples[i], rays[i])
                 rays[i] = ray_diff
+                isects[i].reset()
                 coeff = 1.0 / np.sqrt(self.sampler.spp)
                 ray_diff.scale_differentials(coeff)
                 
@@ -80,13 +123,111 @@ class SamplerRendererTask():
             # Report sample results to Sampler, add contributions to image
             if self.sampler.report_results(samples, rays, Ls, isects, sample_count):
                 for i in range(sample_count):
-                    self.camera.film.add_sample(samples[i], Ls[i], rays[i])
+                    film.add_sample(samples[i], Ls[i], rays[i])
                     
         self.max_iter = -1
 
+    def _render_packets(self, film):
+        samples = self.orig_sample.duplicate(self.sampler.maximum_sample_count())
+        
+        # Get sample packets from Sampler and update image
+        while self.max_iter != 0:
+            self.max_iter -= 1
+
+            image_xy, lens_uv, time = self.sampler.get_more_samples_batch(samples, self.rng, self.packet_size)
+
+            # If no more samples to compute, exit
+            if image_xy.shape[0] == 0:
+                break
+
+            # Generate camera rays and compute radiance along rays
+            ray_weights, rays = self.camera.generate_ray_batch(image_xy, lens_uv, time)
+            Ls = np.zeros((image_xy.shape[0], 3))
+            valid = ray_weights > 0.0
+            if valid.all():
+                Ls, _, _ = self.renderer.Li_batch(self.scene, rays, self.rng)
+            elif valid.any():
+                sub = rays.subset(np.nonzero(valid)[0])
+                Ls[valid], _, _ = self.renderer.Li_batch(self.scene, sub, self.rng)
+                rays.merge(np.nonzero(valid)[0], sub)
+            Ls *= ray_weights[:, np.newaxis]
+
+            # Check for unexpected radiance values
+            Ys = y(Ls)
+            if np.isnan(Ls).any():
+                print('Not-a-number radiance value returned for image sample.  Setting to black.')
+            if (Ys < -1e-5).any():
+                print('Negative luminance value returned for image sample.  Setting to black.')
+            if (Ys == np.inf).any():
+                print('Infinite luminance value returned for image sample.  Setting to black.')
+            Ls[np.isnan(Ls).any(axis=1) | (Ys < -1e-5) | (Ys == np.inf)] = 0.0
+
+            film.add_samples(image_xy, Ls, rays)
+
+        self.max_iter = -1
+
+###############################################################################
+## Worker processes
+###############################################################################
+import stats
+
+_process_scene = None
+_process_renderer = None
+
+def _init_process(scene, renderer, stats_enabled):
+    global _process_scene, _process_renderer
+    _process_scene = scene
+    _process_renderer = renderer
+    if stats_enabled:
+        stats.enable()
+    else:
+        stats.disable()
+
+def _run_thread_task(task):
+    task()
+
+def _run_process_task(task):
+    task.scene = _process_scene
+    task.renderer = _process_renderer
+    task.camera = _process_renderer.camera
+    task.rng = Sampler3D(seed=task.seed)
+    if stats.enabled:
+        stats.reset()
+    # The film tile (created by the main process) is sent back with the task and merged into the film;
+    # the traversal statistics of the task are added to those of the main process
+    task.render(task.film_tile)
+    return task, stats.traversal.total() if stats.enabled else None
+
+def _with_film_tiles(tasks):
+    # Attaches its film tile to every task just before it is sent to a worker process
+    # (only the tiles of the tasks in flight are kept)
+    for task in tasks:
+        task.film_tile = task.get_film_tile()
+        yield task
+        task.film_tile = None
+
+###############################################################################
+## Tile ordering
+###############################################################################
+def spiral_order(windows):
+    # Indices of the given tiles in spiral order around the center of their union (the center is rendered first):
+    # by square ring around the center tile, and by angle within every ring
+    windows = np.array(windows, dtype=np.float64).reshape((-1, 4))
+    if windows.shape[0] == 0:
+        return []
+    cx = 0.5 * (windows[:,0] + windows[:,1])
+    cy = 0.5 * (windows[:,2] + windows[:,3])
+    width  = np.max(windows[:,1] - windows[:,0])
+    height = np.max(windows[:,3] - windows[:,2])
+    dx = (cx - 0.5 * (cx.min() + cx.max())) / width
+    dy = (cy - 0.5 * (cy.min() + cy.max())) / height
+    ring = np.round(np.maximum(np.abs(dx), np.abs(dy)))
+    return np.lexsort((np.arctan2(dy, dx), ring)).tolist()
+
 ###############################################################################
 ## SamplerRenderer
 ###############################################################################
+from multiprocessing import Pool
 from multiprocessing.pool import ThreadPool
 
 import global_configuration
@@ -95,13 +236,22 @@ from sampler import Sample
 
 class SamplerRenderer(Renderer):
 
-    def __init__(self, sampler, camera, surface_integrator, volume_integrator=None, first_pass_iter=0):
+    def __init__(self, sampler, camera, surface_integrator, volume_integrator=None, first_pass_spp=0, error_threshold=0.05, packet_size=0, tile_size=16, seed=0):
         super(SamplerRenderer, self).__init__()
         self.sampler = sampler
         self.camera = camera
         self.surface_integrator = surface_integrator
         self.volume_integrator = volume_integrator
-        self.first_pass_iter = first_pass_iter
+        # Progressive rendering: number of samples per pixel of the first pass (0: a single pass with all samples)
+        # and relative error of the tiles below which they do not receive more samples
+        self.first_pass_spp = first_pass_spp
+        self.error_threshold = error_threshold
+        # Number of camera rays traced together (0: one ray at a time)
+        self.packet_size = packet_size
+        # Width and height of the tiles rendered by the individual tasks (in pixels)
+        self.tile_size = tile_size
+        # Root of the seeds of the tasks: every task of every pass draws from its own independent stream
+        self.seed_sequence = np.random.SeedSequence(seed)
         
     def render(self, scene):
         # Allow integrators to do preprocessing for the scene
@@ -109,54 +259,120 @@ class SamplerRenderer(Renderer):
         if self.volume_integrator:
             self.volume_integrator.preprocess(scene, self.camera, self)
 
+        if stats.enabled:
+            stats.reset()
+
         # Allocate and initialize smaple
         self.sample = Sample(self.sampler, self.surface_integrator, self.volume_integrator, scene)
 
-        # Compute number of SamplerRendererTasks to create for rendering
-        n_cpus   = global_configuration.nb_cpus()
-        n_pixels = self.camera.film.x_resolution * self.camera.film.y_resolution
-        n_tasks  = max(32 * n_cpus, n_pixels // (16*16))
-        n_tasks  = int(np.log2(n_tasks)) + 1
-        tasks    = [None] * n_tasks
+        # Split the sample extent into tiles, each rendered by one SamplerRendererTask
+        n_cpus  = global_configuration.nb_cpus()
+        windows = self.sampler.compute_tile_windows(self.tile_size)
         
-        if self.first_pass_iter == 0:
-            for i in range(n_tasks):
-                tasks[i] = SamplerRendererTask(scene, self, self.camera, self.sampler, self.sample, i, n_tasks).__call__
-
+        pool = self._create_pool(scene, n_cpus)
+        if self.first_pass_spp <= 0 or self.first_pass_spp >= self.sampler.spp:
             print('First and only pass')
-            if n_cpus > 1:
-                pool = ThreadPool(processes=n_cpus)
-                pool.map(lambda t: t(), tasks)
-                pool.close()
-                pool.join()
-            else:
-                map(lambda t: t(), tasks)
+            tasks = self._create_tasks(scene, self.sampler, windows, spiral_order(windows))
+            self._run_tasks(pool, tasks)
         else:
-            for i in range(n_tasks):
-                tasks[i] = SamplerRendererTask(scene, self, self.camera, self.sampler, self.sample, i, n_tasks, max_iter=self.first_pass_iter).__call__
-        
-            print('First pass')
-            if n_cpus > 1:
-                pool = ThreadPool(processes=n_cpus)
-                pool.map(lambda t: t(), tasks)
-                pool.close()
-                pool.join()
-            else:
-                map(lambda t: t(), tasks)
-                
-            #TODO
-                
-            print('Last pass')
-            if n_cpus > 1:
-                pool = ThreadPool(processes=n_cpus)
-                pool.map(lambda t: t(), tasks)
-                pool.close()
-                pool.join()
-            else:
-                map(lambda t: t(), tasks)
+            self._render_progressive(scene, pool, windows)
+        if pool is not None:
+            pool.close()
+            pool.join()
         
         # Store final image
         self.camera.film.write_image()
+        if stats.enabled:
+            print(stats.report())
+
+    def _create_tasks(self, scene, sampler, windows, tiles):
+        # Tasks rendering the given tiles (in the given order), seeded with fresh children of the seed sequence (i.e. independent per tile and pass)
+        n_tiles = len(windows)
+        seeds = self.seed_sequence.spawn(n_tiles)
+        return [SamplerRendererTask(scene, self, self.camera, sampler, self.sample, n_tiles-1-k, n_tiles, packet_size=self.packet_size, seed=seeds[k], window=windows[k]) for k in tiles]
+
+    def _render_progressive(self, scene, pool, windows):
+        # Every pass adds as many samples per pixel as all previous passes together (within the budget of the sampler)
+        # to the tiles whose error still exceeds the threshold, and writes the intermediate image.
+        # The first pass renders the tiles in spiral order, later passes the most expensive tiles of the previous pass first.
+        n_tiles = len(windows)
+        active = np.ones((n_tiles), dtype=bool)
+        costs = None
+        spp = 0
+        pass_nb = 0
+        while True:
+            pass_spp = min(max(spp, self.first_pass_spp), self.sampler.spp - spp)
+            print('Pass %d: %d spp for %d/%d tiles' % (pass_nb, pass_spp, np.count_nonzero(active), n_tiles))
+            if costs is None:
+                tiles = [k for k in spiral_order(windows) if active[k]]
+            else:
+                tiles = np.nonzero(active)[0]
+                tiles = tiles[np.argsort(-costs[tiles], kind='stable')]
+            tasks = self._create_tasks(scene, self.sampler.with_spp(pass_spp), windows, tiles)
+            self._run_tasks(pool, tasks)
+            costs = np.zeros((n_tiles))
+            for task in tasks:
+                costs[task.task_num] = task.render_time
+            spp += pass_spp
+            pass_nb += 1
+            if spp >= self.sampler.spp:
+                break
+            self.camera.film.write_image()
+
+            errors = self.get_tile_errors(windows)
+            if errors is not None:
+                active &= (errors > self.error_threshold)
+            if not active.any():
+                print('Converged after %d passes' % pass_nb)
+                break
+
+    def get_tile_errors(self, windows):
+        # Mean relative pixel error of every tile (None if the film does not estimate errors)
+        pixel_errors = self.camera.film.get_pixel_errors()
+        if pixel_errors is None:
+            return None
+        x_start, _, y_start, _ = self.camera.film.get_pixel_extent()
+        errors = np.zeros((len(windows)))
+        for i, (x0, x1, y0, y1) in enumerate(windows):
+            tile = pixel_errors[max(0, y0 - y_start):max(0, y1 - y_start), max(0, x0 - x_start):max(0, x1 - x_start)]
+            errors[i] = np.mean(tile) if tile.size != 0 else 0.0
+        return errors
+
+    def _create_pool(self, scene, n_cpus):
+        if n_cpus <= 1:
+            return None
+        if not global_configuration.MULTI_PROCESSING:
+            return ThreadPool(processes=n_cpus)
+        
+        # Each worker process receives the scene and renderer once, without the film
+        film = self.camera.film
+        self.camera.film = None
+        try:
+            return Pool(processes=n_cpus, initializer=_init_process, initargs=(scene, self, stats.enabled))
+        finally:
+            self.camera.film = film
+
+    def _run_tasks(self, pool, tasks):
+        # Idle workers take the next task in order, one at a time (chunksize=1), until all tasks are taken
+        if pool is None:
+            for task in tasks:
+                task()
+        elif isinstance(pool, ThreadPool):
+            for _ in pool.imap_unordered(_run_thread_task, tasks, chunksize=1):
+                pass
+        else:
+            # Merge the film tile of each task into the film as soon as the task finishes
+            index = dict((task.task_num, k) for k, task in enumerate(tasks))
+            for task, traversal_counts in pool.imap_unordered(_run_process_task, _with_film_tiles(tasks), chunksize=1):
+                if task.film_tile is not None:
+                    self.camera.film.merge_film_tile(task.film_tile)
+                if traversal_counts is not None:
+                    stats.traversal.add(traversal_counts)
+                k = index[task.task_num]
+                tasks[k].sampler = task.sampler
+                tasks[k].max_iter = task.max_iter
+                tasks[k].render_time = task.render_time
+        return tasks
 
     def Li(self, scene, ray, sample, rng, intersection=None, T=None):
         # allocate local variables for isect and T if needed
@@ -175,6 +391,29 @@ class SamplerRenderer(Renderer):
         else:
             Lvi, T = np.zeros((3)), np.ones((3))
         return (np.multiply(T, Li) + Lvi), intersection, T
+
+    def Li_batch(self, scene, rays, rng, intersections=None):
+        # allocate local variables for isects if needed
+        if intersections is None:
+            intersections = IntersectionBatch(len(rays))
+        hits = scene.intersect_batch(rays, intersections)
+        Li = np.zeros((len(rays), 3))
+        if hits.any():
+            Li[hits] = self.surface_integrator.Li_batch(scene, self, rays, intersections, np.nonzero(hits)[0], rng)
+        if len(scene.lights) != 0:
+            # Handle rays that don't intersect any geometry
+            for k in np.nonzero(~hits)[0]:
+                for light in scene.lights:
+                    Li[k] += light.Le(rays[k])
+
+        if self.volume_integrator:
+            Lvi = np.zeros((len(rays), 3))
+            T = np.ones((len(rays), 3))
+            for k in range(len(rays)):
+                Lvi[k], T[k] = self.volume_integrator.Li(scene, self, rays[k], None, rng, None)
+        else:
+            Lvi, T = np.zeros((len(rays), 3)), np.ones((len(rays), 3))
+        return (np.multiply(T, Li) + Lvi), intersections, T
                                         
     def transmittance(self, scene, ray, sample, rng):
         if self.volume_integrator:
@@ -2,63 +2,89 @@ import numpy as np
 
 from ray import Ray
 
+ONE_MINUS_EPSILON = 1.0 - np.finfo(np.float64).epsneg
+
 ###############################################################################
 ## Sampler
 ###############################################################################
 from abc import ABCMeta, abstractmethod
 
 class Sampler(object):
+    '''
+    Draws random samples from a numpy.random.Generator of its own (or from
+    the given rng). All sample methods return a single sample for size=None,
+    or an array of samples of the given size (with the coordinates along
+    the last axis).
+    '''
 
     __metaclass__ = ABCMeta
 
     def __init__(self, rng=None, seed=None):
+        # seed: None, an int or a numpy.random.SeedSequence
         if rng is None:
-            self.rng = np.random
-        else:
-            self.rng = rng
-        self.seed(seed)
+            rng = np.random.default_rng(seed)
+        elif not isinstance(rng, np.random.Generator):
+            # Legacy RandomState (or the global np.random module)
+            rng.seed(seed)
+        self.rng = rng
+
+    def spawn(self, n):
+        # n samplers with independent streams, derived from the seed sequence of this sampler
+        seed_sequence = self.rng.bit_generator.seed_seq
+        return [type(self)(seed=child) for child in seed_sequence.spawn(n)]
      
     def uniform(self, low=0.0, high=1.0, size=None):
         return self.rng.uniform(low=low, high=high, size=size)
+
+    def random_float(self, size=None):
+        return self.rng.random(size=size)
      
     def seed(self, seed=None):
-        self.rng.seed(seed)
+        if isinstance(self.rng, np.random.Generator):
+            self.rng = np.random.default_rng(seed)
+        else:
+            self.rng.seed(seed)
      
-    def uniform_sample_hemisphere(self, center=0.0, radius=1.0):
-        return center + radius * self.uniform_sample_unit_hemisphere()
+    def uniform_sample_hemisphere(self, center=0.0, radius=1.0, size=None):
+        return center + radius * self.uniform_sample_unit_hemisphere(size=size)
         
     @abstractmethod 
-    def uniform_sample_unit_hemisphere(self):
+    def uniform_sample_unit_hemisphere(self, size=None):
         return
         
-    def uniform_sample_within_hemisphere(self, center=0.0, radius=1.0):
-        return center + radius * self.uniform_sample_within_unit_hemisphere()
+    def uniform_sample_within_hemisphere(self, center=0.0, radius=1.0, size=None):
+        return center + radius * self.uniform_sample_within_unit_hemisphere(size=size)
     
     @abstractmethod
-    def uniform_sample_within_unit_hemisphere(self):
+    def uniform_sample_within_unit_hemisphere(self, size=None):
         return
    
     @abstractmethod  
     def uniform_hemisphere_pdf(self):
         return
 
-    def uniform_sample_sphere(self, center=0.0, radius=1.0):
-        return center + radius * self.uniform_sample_unit_sphere()
+    def uniform_sample_sphere(self, center=0.0, radius=1.0, size=None):
+        return center + radius * self.uniform_sample_unit_sphere(size=size)
     
     @abstractmethod 
-    def uniform_sample_unit_sphere(self):
+    def uniform_sample_unit_sphere(self, size=None):
         return
     
-    def uniform_sample_within_sphere(self, center=0.0, radius=1.0):
-        return center + radius * self.uniform_sample_within_unit_sphere()
+    def uniform_sample_within_sphere(self, center=0.0, radius=1.0, size=None):
+        return center + radius * self.uniform_sample_within_unit_sphere(size=size)
     
     @abstractmethod
-    def uniform_sample_within_unit_sphere(self):
+    def uniform_sample_within_unit_sphere(self, size=None):
         return
     
     @abstractmethod 
     def uniform_sphere_pdf(self):
         return
+
+    def concentric_sample_unit_disk(self, size=None):
+        u = self.rng.uniform(size=(1 if size is None else np.prod(size), 2))
+        d = concentric_sample_disk_batch(u[:,0], u[:,1])
+        return d[0] if size is None else d.reshape(np.append(size, 2))
         
     def uniform_shape(self, logicalshape):
         sphere = logicalshape.bounding_sphere()
@@ -70,7 +96,7 @@ class Sampler(object):
             targ = self.uniform_sample_sphere(center=center, radius=radius)
             r = Ray(org, targ-org)
             
-            if not logicalshape.intersect(r):
+            if not logicalshape.occluded(r):
                 continue
             return r
             
@@ -83,7 +109,7 @@ class Sampler(object):
         targ = self.uniform_sample_sphere(center=center, radius=radius)
         r = Ray(org, targ-org)
             
-        if not logicalshape.intersect(r):
+        if not logicalshape.occluded(r):
             r.color = 'r'
         else:
             r.color = 'g'
@@ -97,34 +123,30 @@ class Sampler2D(Sampler):
     def __init__(self, rng=None, seed=None): 
         super(Sampler2D, self).__init__(rng, seed) 
 
-    def uniform_sample_unit_hemisphere(self):  
-        u1 = self.rng.uniform()
+    def uniform_sample_unit_hemisphere(self, size=None):  
+        u1 = self.rng.uniform(size=size)
         
         phi = np.pi * u1
-        x = np.cos(phi)
-        y = np.sin(phi)
-        return np.array([x, y])
+        return np.stack((np.cos(phi), np.sin(phi)), axis=-1)
         
-    def uniform_sample_within_unit_hemisphere(self):
-        u = self.rng.uniform()
-        return np.sqrt(u) * self.uniform_sample_unit_hemisphere()
+    def uniform_sample_within_unit_hemisphere(self, size=None):
+        u = self.rng.uniform(size=size)
+        return np.sqrt(u)[..., np.newaxis] * self.uniform_sample_unit_hemisphere(size=size)
 
     def uniform_hemisphere_pdf(self):
         return 1.0 / np.pi
 
-    def uniform_sample_unit_sphere(self):
-        u1 = self.rng.uniform()
+    def uniform_sample_unit_sphere(self, size=None):
+        u1 = self.rng.uniform(size=size)
  
         phi = 2.0 * np.pi * u1
-        x = np.cos(phi)
-        y = np.sin(phi)
-        return np.array([x, y])
+        return np.stack((np.cos(phi), np.sin(phi)), axis=-1)
         
-    def uniform_sample_within_unit_sphere(self):
-        u = self.rng.uniform()
-        return np.sqrt(u) * self.uniform_sample_unit_sphere()
+    def uniform_sample_within_unit_sphere(self, size=None):
+        u = self.rng.uniform(size=size)
+        return np.sqrt(u)[..., np.newaxis] * self.uniform_sample_unit_sphere(size=size)
 
-    def uniform_sphere_pdf():
+    def uniform_sphere_pdf(self):
         return 1.0 / (2.0 * np.pi)
 
 ###############################################################################
@@ -135,50 +157,46 @@ class Sampler3D(Sampler):
     def __init__(self, rng=None, seed=None): 
         super(Sampler3D, self).__init__(rng, seed)  
     
-    def uniform_sample_unit_hemisphere(self):  
-        u1 = self.rng.uniform()
-        u2 = self.rng.uniform()
+    def uniform_sample_unit_hemisphere(self, size=None):  
+        u1 = self.rng.uniform(size=size)
+        u2 = self.rng.uniform(size=size)
 
         z = u1
-        r = np.sqrt(max(0.0, 1.0 - z*z))
+        r = np.sqrt(np.maximum(0.0, 1.0 - z*z))
         phi = 2.0 * np.pi * u2
-        x = r * np.cos(phi)
-        y = r * np.sin(phi)
-        return np.array([x, y, z])
+        return np.stack((r * np.cos(phi), r * np.sin(phi), z), axis=-1)
         
-    def uniform_sample_within_unit_hemisphere(self):
-        u = self.rng.uniform()
-        return pow(u, 1.0/3.0) * self.uniform_sample_unit_hemisphere()
+    def uniform_sample_within_unit_hemisphere(self, size=None):
+        u = self.rng.uniform(size=size)
+        return np.cbrt(u)[..., np.newaxis] * self.uniform_sample_unit_hemisphere(size=size)
 
     def uniform_hemisphere_pdf(self):
         return 1.0 / (2.0 * np.pi)
 
-    def uniform_sample_unit_sphere(self):
-        u1 = self.rng.uniform()
-        u2 = self.rng.uniform()
+    def uniform_sample_unit_sphere(self, size=None):
+        u1 = self.rng.uniform(size=size)
+        u2 = self.rng.uniform(size=size)
         
         z = 1.0 - 2.0 * u1
-        r = np.sqrt(max(0.0, 1.0 - z*z))
+        r = np.sqrt(np.maximum(0.0, 1.0 - z*z))
         phi = 2.0 * np.pi * u2
-        x = r * np.cos(phi)
-        y = r * np.sin(phi)
-        return np.array([x, y, z])
+        return np.stack((r * np.cos(phi), r * np.sin(phi), z), axis=-1)
         
-    def uniform_sample_within_unit_sphere(self):
-        u = self.rng.uniform()
-        return pow(u, 1.0/3.0) * self.uniform_sample_unit_sphere()
+    def uniform_sample_within_unit_sphere(self, size=None):
+        u = self.rng.uniform(size=size)
+        return np.cbrt(u)[..., np.newaxis] * self.uniform_sample_unit_sphere(size=size)
 
-    def uniform_sphere_pdf():
+    def uniform_sphere_pdf(self):
         return 1.0 / (4.0 * np.pi)
         
-    def cosine_weighted_uniform_sample_hemisphere(self):
-        u1 = self.rng.uniform()
-        u2 = self.rng.uniform()
+    def cosine_weighted_uniform_sample_hemisphere(self, size=None):
+        u1 = self.rng.uniform(size=size)
+        u2 = self.rng.uniform(size=size)
         
         cos_theta = np.sqrt(1.0 - u1)
         sin_theta = np.sqrt(u1)
         phi = 2.0 * np.pi * u2
-        return np.array([np.cos(phi) * sin_theta, np.sin(phi) * sin_theta, cos_theta])
+        return np.stack((np.cos(phi) * sin_theta, np.sin(phi) * sin_theta, cos_theta), axis=-1)
     
 ###############################################################################
 ## Sampling
@@ -220,6 +238,71 @@ def concentric_sample_disk(u1, u2):
     dy = r * np.sin(theta)
     return dx, dy
 
+def concentric_sample_disk_batch(u1, u2):
+    # Vectorized concentric_sample_disk for arrays of uniform random numbers; returns an (N,2) array
+    sx = 2.0 * u1 - 1.0
+    sy = 2.0 * u2 - 1.0
+    region12 = (sx >= -sy)
+    region1 = region12 & (sx > sy)
+    region3 = ~region12 & (sx <= sy)
+    r = np.select([region1, region12, region3], [sx, sy, -sx], -sy)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        theta = np.select([region1 & (sy > 0.0), region1, region12, region3], [sy/r, 8.0 + sy/r, 2.0 - sx/r, 4.0 - sy/r], 6.0 + sx/r)
+    # Handle degeneracy at the origin
+    theta[r == 0.0] = 0.0
+    theta *= np.pi / 4.0
+    return np.column_stack((r * np.cos(theta), r * np.sin(theta)))
+
+def stratified_sample_1D(u, jitter=True):
+    # One sample in each of the n strata of [0,1), for the uniform random numbers u of shape (...,n)
+    n = u.shape[-1]
+    if not jitter:
+        u = 0.5
+    return (np.arange(n) + u) / float(n)
+
+def stratified_sample_2D(u, nx, ny, jitter=True):
+    # One sample in each of the nx x ny strata of [0,1)^2 (in scanline order), for the uniform random numbers u of shape (...,nx*ny,2)
+    x, y = np.meshgrid(np.arange(nx), np.arange(ny))
+    strata = np.column_stack((x.ravel(), y.ravel()))
+    if not jitter:
+        u = 0.5
+    return (strata + u) / np.array([nx, ny], dtype=np.float64)
+
+def latin_hypercube(u, keys):
+    # Latin hypercube samples for the uniform random numbers u of shape (...,n,d):
+    # the strata of every dimension are permuted independently by sorting the random keys of shape (...,n,d)
+    samples = stratified_sample_1D(np.swapaxes(u, -1, -2))
+    return np.swapaxes(np.take_along_axis(samples, np.argsort(np.swapaxes(keys, -1, -2), axis=-1), axis=-1), -1, -2)
+
+def shuffle(samples, keys):
+    # Permutes the samples of shape (...,n,d) along axis -2 by sorting the random keys of shape (...,n)
+    return np.take_along_axis(samples, np.argsort(keys, axis=-1)[..., np.newaxis], axis=-2)
+
+def van_der_corput(n, scramble=0):
+    # Radical inverse in base 2 of the (unsigned 32 bit) indices n, scrambled by xor-ing with the given bits
+    n = np.asarray(n, dtype=np.uint32)
+    n = (n << np.uint32(16)) | (n >> np.uint32(16))
+    n = ((n & np.uint32(0x00ff00ff)) << np.uint32(8)) | ((n & np.uint32(0xff00ff00)) >> np.uint32(8))
+    n = ((n & np.uint32(0x0f0f0f0f)) << np.uint32(4)) | ((n & np.uint32(0xf0f0f0f0)) >> np.uint32(4))
+    n = ((n & np.uint32(0x33333333)) << np.uint32(2)) | ((n & np.uint32(0xcccccccc)) >> np.uint32(2))
+    n = ((n & np.uint32(0x55555555)) << np.uint32(1)) | ((n & np.uint32(0xaaaaaaaa)) >> np.uint32(1))
+    n = n ^ np.asarray(scramble, dtype=np.uint32)
+    return np.minimum(n * 2.3283064365386963e-10, ONE_MINUS_EPSILON)
+
+def sobol2(n, scramble=0):
+    # Second dimension of the Sobol' sequence for the (unsigned 32 bit) indices n, scrambled by xor-ing with the given bits
+    n = np.asarray(n, dtype=np.uint32)
+    result = np.broadcast_to(np.asarray(scramble, dtype=np.uint32), np.broadcast(n, scramble).shape).copy()
+    v = 1 << 31
+    for bit in range(32):
+        result ^= np.where((n >> np.uint32(bit)) & np.uint32(1), np.uint32(v), np.uint32(0))
+        v ^= v >> 1
+    return np.minimum(result * 2.3283064365386963e-10, ONE_MINUS_EPSILON)
+
+def sample02(n, scramble0=0, scramble1=0):
+    # Points of the (0,2)-sequence for the indices n; returns an array of shape n.shape + (2,)
+    return np.stack((van_der_corput(n, scramble0), sobol2(n, scramble1)), axis=-1)
+
 ###############################################################################
 ## Tests
 ###############################################################################
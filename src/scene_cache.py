@@ -0,0 +1,96 @@
+import hashlib
+import json
+import numpy as np
+import os
+import struct
+
+###############################################################################
+## Binary Scene Cache
+###############################################################################
+# Layout: magic, header size (uint64), JSON header, arrays aligned to ALIGNMENT bytes.
+# The header stores the content hash of the inputs, the aggregate type and the
+# dtype, shape and offset of every array, so that the arrays can be memory-mapped.
+from bvh import BVH
+from OBJ import parse
+from regulargrid import RegularGrid
+from trianglemesh import TriangleMesh
+
+MAGIC = b'PBRTPYC1'
+ALIGNMENT = 64
+AGGREGATE_TYPES = {'RegularGrid' : RegularGrid, 'BVH' : BVH}
+
+def content_hash(fnames=[], **params):
+    # Hash of the contents of the given input files and the given (JSON serializable) parameters
+    h = hashlib.sha1(MAGIC)
+    for fname in fnames:
+        with open(fname, 'rb') as infile:
+            for block in iter(lambda: infile.read(1 << 24), b''):
+                h.update(block)
+    h.update(json.dumps(params, sort_keys=True).encode())
+    return h.hexdigest()
+
+def save(fname, aggregate, content_hash=''):
+    arrays = {'vertices' : aggregate.mesh.vertices, 'indices' : aggregate.mesh.indices}
+    arrays.update(aggregate.get_arrays())
+
+    # Compute the header (the offsets depend on the header size)
+    header = {'hash' : content_hash, 'type' : type(aggregate).__name__, 'arrays' : {}}
+    offset = 0
+    for name, array in arrays.items():
+        array = np.ascontiguousarray(array)
+        header['arrays'][name] = [array.dtype.str, list(array.shape), offset]
+        offset = _align(offset + array.nbytes)
+    header_bytes = json.dumps(header).encode()
+    data_start = _align(len(MAGIC) + 8 + len(header_bytes))
+
+    with open(fname, 'wb') as outfile:
+        outfile.write(MAGIC)
+        outfile.write(struct.pack('<Q', len(header_bytes)))
+        outfile.write(header_bytes)
+        for name, array in arrays.items():
+            outfile.seek(data_start + header['arrays'][name][2])
+            outfile.write(np.ascontiguousarray(array).tobytes())
+
+def read_header(fname):
+    with open(fname, 'rb') as infile:
+        if infile.read(len(MAGIC)) != MAGIC:
+            return None, 0
+        size, = struct.unpack('<Q', infile.read(8))
+        header = json.loads(infile.read(size).decode())
+    return header, _align(len(MAGIC) + 8 + size)
+
+def load(fname, content_hash=None):
+    # Returns the cached aggregate (None if missing or stale), with all arrays memory-mapped read-only
+    if not os.path.isfile(fname):
+        return None
+    header, data_start = read_header(fname)
+    if header is None or (content_hash is not None and header['hash'] != content_hash):
+        return None
+
+    arrays = {}
+    for name, (dtype, shape, offset) in header['arrays'].items():
+        if np.prod(shape) == 0:
+            arrays[name] = np.zeros(shape, dtype=dtype)
+        else:
+            arrays[name] = np.memmap(fname, dtype=dtype, mode='r', offset=data_start + offset, shape=tuple(shape)).view(np.ndarray)
+    mesh = TriangleMesh(arrays.pop('vertices'), arrays.pop('indices'))
+    return AGGREGATE_TYPES[header['type']]().set_arrays(mesh, arrays)
+
+def load_or_build(fname, content_hash, build):
+    # Returns the cached aggregate if up to date, otherwise builds it with build() and caches it
+    aggregate = load(fname, content_hash=content_hash)
+    if aggregate is None:
+        aggregate = build()
+        save(fname, aggregate, content_hash=content_hash)
+    return aggregate
+
+def load_obj(obj_fname, cache_fname=None, aggregate_type=RegularGrid, **kwargs):
+    # Loads an OBJ file into an aggregate of the given type (constructed with the given keyword arguments)
+    # through a cache file next to it
+    if cache_fname is None:
+        cache_fname = os.path.splitext(obj_fname)[0] + '.pbrtpyc'
+    h = content_hash([obj_fname], type=aggregate_type.__name__, **kwargs)
+    return load_or_build(cache_fname, h, lambda: aggregate_type([parse(obj_fname)], **kwargs))
+
+def _align(offset):
+    return (offset + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT
@@ -1,17 +1,21 @@
 import numpy as np
 
 from factory import create_Factory
+from instance import Instance
 from math_utils import round2int
 from nAABB import NAABB
+from regulargrid import RegularGrid
 from transform import scale, rotate, translate
 from transformvisitor import TransformVisitor
 from triangle import Triangle
+from trianglemesh import TriangleMesh
 
 def create_box(model, nb_voxels, scaling=1.0, spread=2.0):
     d = spread * (nb_voxels * scaling) * model.bounds().diagonal()
     return NAABB(pMin=np.zeros((3)), pMax=d)
 
-def stratified(model, density, nb_voxels, box=None, rng=None, seed=None, scaling=1.0, rotation=True, translation=True):
+def stratified(model, density, nb_voxels, box=None, rng=None, seed=None, scaling=1.0, rotation=True, translation=True, instanced=False):
+    # instanced: places Instances of a single aggregate of the model instead of transformed copies of its triangles
     if rng is None:
         rng = np.random
     rng.seed(seed)
@@ -36,6 +40,12 @@ def stratified(model, density, nb_voxels, box=None, rng=None, seed=None, scaling
     pmask      = rng.permutation(mask).reshape((nb_voxels_x, nb_voxels_y, nb_voxels_z))
 
     print('Generated scene: ' + str(nb_objects)+ '\t objects / ' + str(nb_voxels) + ' voxels')
+
+    # Gather the triangles of the model in a single mesh, so that every instance is transformed with a single matmul
+    mesh = TriangleMesh().append(model if isinstance(model, TriangleMesh) else model.get_shapes())
+    if instanced:
+        model_aggregate = RegularGrid([mesh])
+    S = scale(scaling, scaling, scaling)
     
     x = box.pMin[0]
     for i in range(nb_voxels_x):
@@ -44,7 +54,6 @@ def stratified(model, density, nb_voxels, box=None, rng=None, seed=None, scaling
             z = box.pMin[2]
             for k in range(nb_voxels_z):
                 if pmask[i,j,k]:
-                    S = scale(scaling, scaling, scaling)
                     if translation and rotation:
                         px  = x + rng.uniform() * dist_per_unit_voxel_x
                         py  = y + rng.uniform() * dist_per_unit_voxel_y
@@ -61,9 +70,14 @@ def stratified(model, density, nb_voxels, box=None, rng=None, seed=None, scaling
                     elif rotation:
                         R   = rotate(360 * rng.uniform(), rng.uniform(size=3))
                         TRS = R * S
-                    vs = TransformVisitor(TRS)
-                    model.accept(vs)
-                    scene.append(vs.triangles)                    
+                    else:
+                        TRS = S
+                    if instanced:
+                        scene.append(Instance(model_aggregate, TRS))
+                    else:
+                        vs = TransformVisitor(TRS)
+                        mesh.accept(vs)
+                        scene.append(vs.triangles)
                 z += dist_per_unit_voxel_z
             y += dist_per_unit_voxel_y
         x += dist_per_unit_voxel_x
@@ -82,13 +96,10 @@ def small_spherical(center=0.0, radius=1.0, nt=1024, rng=None, seed=None, sample
     f = create_Factory(3)
     if sampler is None:
         sampler = f.get_Sampler(rng=rng, seed=seed)
-    scene = f.get_Group()
-    for i in range(nt):
-        v1 = sampler.uniform_sample_within_sphere(center=center, radius=radius)
-        v2 = 0.010 * sampler.uniform_sample_sphere(center=v1, radius=radius)
-        v3 = 0.010 * sampler.uniform_sample_sphere(center=v1, radius=radius)
-        scene.append(Triangle(v1, v2, v3))
-    return scene
+    v1 = sampler.uniform_sample_within_sphere(center=center, radius=radius, size=nt)
+    v2 = v1 + 0.010 * radius * sampler.uniform_sample_unit_sphere(size=nt)
+    v3 = v1 + 0.010 * radius * sampler.uniform_sample_unit_sphere(size=nt)
+    return _triangles(f, v1, v2, v3)
 
 def large_spherical(center=0.0, radius=1.0, nt=1024, rng=None, seed=None, sampler=None):
     '''
@@ -99,13 +110,10 @@ def large_spherical(center=0.0, radius=1.0, nt=1024, rng=None, seed=None, sample
     f = create_Factory(3)
     if sampler is None:
         sampler = f.get_Sampler(rng=rng, seed=seed)
-    scene = f.get_Group()
-    for i in range(nt):
-        v1 = sampler.uniform_sample_within_sphere(center=center, radius=radius)
-        v2 = 0.333 * sampler.uniform_sample_sphere(center=v1, radius=radius)
-        v3 = 0.333 * sampler.uniform_sample_sphere(center=v1, radius=radius)
-        scene.append(Triangle(v1, v2, v3))
-    return scene
+    v1 = sampler.uniform_sample_within_sphere(center=center, radius=radius, size=nt)
+    v2 = v1 + 0.333 * radius * sampler.uniform_sample_unit_sphere(size=nt)
+    v3 = v1 + 0.333 * radius * sampler.uniform_sample_unit_sphere(size=nt)
+    return _triangles(f, v1, v2, v3)
     
 def small_gaussian(center=0.0, radius=1.0, nt=1024, rng=None, seed=None, sampler=None):
     '''
@@ -116,13 +124,10 @@ def small_gaussian(center=0.0, radius=1.0, nt=1024, rng=None, seed=None, sampler
     f = create_Factory(3)
     if sampler is None:
         sampler = f.get_Sampler(rng=rng, seed=seed)
-    scene = f.get_Group()
-    for i in range(nt):
-        v1 = 0.333 * sampler.rng.normal() * sampler.uniform_sample_sphere(center=center, radius=radius)
-        v2 = 0.010 * sampler.uniform_sample_sphere(center=v1, radius=radius)
-        v3 = 0.010 * sampler.uniform_sample_sphere(center=v1, radius=radius)
-        scene.append(Triangle(v1, v2, v3))
-    return scene
+    v1 = center + 0.333 * radius * sampler.rng.normal(size=(nt, 1)) * sampler.uniform_sample_unit_sphere(size=nt)
+    v2 = v1 + 0.010 * radius * sampler.uniform_sample_unit_sphere(size=nt)
+    v3 = v1 + 0.010 * radius * sampler.uniform_sample_unit_sphere(size=nt)
+    return _triangles(f, v1, v2, v3)
     
 def large_gaussian(center=0.0, radius=1.0, nt=1024, rng=None, seed=None, sampler=None):
     '''
@@ -133,13 +138,10 @@ def large_gaussian(center=0.0, radius=1.0, nt=1024, rng=None, seed=None, sampler
     f = create_Factory(3)
     if sampler is None:
         sampler = f.get_Sampler(rng=rng, seed=seed)
-    scene = f.get_Group()
-    for i in range(nt):
-        v1 = 0.333 * sampler.rng.normal() * sampler.uniform_sample_sphere(center=center, radius=radius)
-        v2 = 0.333 * sampler.uniform_sample_sphere(center=v1, radius=radius)
-        v3 = 0.333 * sampler.uniform_sample_sphere(center=v1, radius=radius)
-        scene.append(Triangle(v1, v2, v3))
-    return scene
+    v1 = center + 0.333 * radius * sampler.rng.normal(size=(nt, 1)) * sampler.uniform_sample_unit_sphere(size=nt)
+    v2 = v1 + 0.333 * radius * sampler.uniform_sample_unit_sphere(size=nt)
+    v3 = v1 + 0.333 * radius * sampler.uniform_sample_unit_sphere(size=nt)
+    return _triangles(f, v1, v2, v3)
      
 def random_vertices(center=0.0, radius=1.0, nt=1024, rng=None, seed=None, sampler=None): 
     '''
@@ -149,12 +151,16 @@ def random_vertices(center=0.0, radius=1.0, nt=1024, rng=None, seed=None, sample
     f = create_Factory(3)
     if sampler is None:
         sampler = f.get_Sampler(rng=rng, seed=seed)
+    v1 = sampler.uniform_sample_within_sphere(center=center, radius=radius, size=nt)
+    v2 = sampler.uniform_sample_within_sphere(center=center, radius=radius, size=nt)
+    v3 = sampler.uniform_sample_within_sphere(center=center, radius=radius, size=nt)
+    return _triangles(f, v1, v2, v3)
+
+def _triangles(f, v1, v2, v3):
+    # Group of the triangles with the given (N,3) vertex arrays
     scene = f.get_Group()
-    for i in range(nt):
-        v1 = sampler.uniform_sample_within_sphere(center=center, radius=radius)
-        v2 = sampler.uniform_sample_within_sphere(center=center, radius=radius)
-        v3 = sampler.uniform_sample_within_sphere(center=center, radius=radius)
-        scene.append(Triangle(v1, v2, v3))
+    for k in range(v1.shape[0]):
+        scene.append(Triangle(v1[k], v2[k], v3[k]))
     return scene
     
 ###############################################################################
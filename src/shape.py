@@ -1,10 +1,13 @@
 from abc import ABCMeta, abstractmethod
+import numpy as np
 
 ###############################################################################
 ## Shape
 ###############################################################################
 from entity import Entity
 from id import IDGenerator
+from ray import Intersection
+import stats
 
 class Shape(Entity):
     __metaclass__ = ABCMeta
@@ -42,12 +45,43 @@ class Shape(Entity):
         return
    
     def intersect_exclusive(self, excl, ray, isect=None):
-        if self.id not in excl:
-            return self.intersect(ray=ray, isect=isect)
-        else:
+        if self.id in excl:
             return False
+        if isect is None:
+            return self.occluded(ray)
+        return self.intersect(ray=ray, isect=isect)
+   
+    def intersect_batch(self, rays, isects=None):
+        # Fallback: intersect the rays of the batch one at a time
+        if isects is None:
+            return self.occluded_batch(rays)
+        hits = np.zeros((len(rays)), dtype=bool)
+        for k in range(len(rays)):
+            ray = rays[k]
+            isect = None if isects is None else Intersection()
+            hits[k] = self.intersect(ray, isect)
+            rays.store(k, ray)
+            if hits[k] and isect is not None:
+                isects.store(k, isect)
+        return hits
+
+    def occluded(self, ray):
+        # Any-hit query: returns whether the ray hits this shape within [tMin, tMax]
+        # without computing (nor updating the ray with) the closest intersection
+        return self.intersect(ray)
+
+    def occluded_batch(self, rays):
+        # Fallback: test the rays of the batch one at a time
+        hits = np.zeros((len(rays)), dtype=bool)
+        for k in range(len(rays)):
+            ray = rays[k]
+            hits[k] = self.occluded(ray)
+            rays.store(k, ray)
+        return hits
    
     def _update_intersection(self, t, ray, isect):
+        if __debug__ and stats.enabled:
+            stats.count(stats.PRIMITIVE_HITS)
         if (isect is not None):
             ray.tMax = t
             p = ray.o + t * ray.d
@@ -82,6 +116,15 @@ class ShapeWrapper(Shape):
     
     def intersect(self, ray, isect=None):
         return self.shape.intersect(ray=ray, isect=isect)
+
+    def intersect_batch(self, rays, isects=None):
+        return self.shape.intersect_batch(rays=rays, isects=isects)
+
+    def occluded(self, ray):
+        return self.shape.occluded(ray)
+
+    def occluded_batch(self, rays):
+        return self.shape.occluded_batch(rays)
    
     def intersect_exclusive(self, excl, ray, isect=None):
         self.shape.intersect_exclusive(self, excl=excl, ray=ray, isect=isect)
@@ -8,11 +8,12 @@ XYZ_TO_RGB = np.array([[ 3.240479, -1.537150, -0.498535],
                        [-0.969256,  1.875991,  0.041556],
                        [ 0.055648, -0.204043,  1.057311]])
 
+# All conversions accept a single color of shape (3,) or an array of colors of shape (N,3)
 def rgb_to_xyz(rgb):
-    return RGB_TO_XYZ.dot(rgb) 
+    return rgb.dot(RGB_TO_XYZ.T) 
 
 def xyz_to_rgb(xyz):
-    return XYZ_TO_RGB.dot(xyz) 
+    return xyz.dot(XYZ_TO_RGB.T) 
     
 def y(rgb):
-    return RGB_TO_XYZ[1].dot(rgb)
\ No newline at end of file
+    return rgb.dot(RGB_TO_XYZ[1])
\ No newline at end of file
@@ -0,0 +1,106 @@
+import numpy as np
+from threading import Lock, local
+
+###############################################################################
+## Statistics
+###############################################################################
+# Traversal statistics are only gathered while enabled. Every call site is
+# guarded by "if __debug__ and stats.enabled:", so that disabled statistics
+# cost a single attribute check, and are compiled out with python -O.
+enabled = False
+
+def enable():
+    global enabled
+    enabled = True
+
+def disable():
+    global enabled
+    enabled = False
+
+###############################################################################
+## ThreadLocalCounters
+###############################################################################
+class ThreadLocalCounters(object):
+    '''
+    Integer counters with a separate array per thread, so that threads
+    increment them without locking. The arrays are only reduced on demand.
+    '''
+
+    def __init__(self, size):
+        self.size = size
+        self._local = local()
+        self._arrays = []
+        # Only taken when a thread allocates its array and when reducing
+        self._lock = Lock()
+
+    def get(self):
+        # The array of the calling thread
+        array = getattr(self._local, 'array', None)
+        if array is None:
+            array = np.zeros((self.size), dtype=np.int64)
+            with self._lock:
+                self._arrays.append(array)
+            self._local.array = array
+        return array
+
+    def add(self, values):
+        # Adds counts gathered elsewhere (e.g. in a worker process)
+        self.get()[:] += values
+
+    def total(self):
+        with self._lock:
+            return sum(self._arrays, np.zeros((self.size), dtype=np.int64))
+
+    def reset(self):
+        with self._lock:
+            for array in self._arrays:
+                array[:] = 0
+
+    def __getstate__(self):
+        # Thread-local arrays and locks cannot be pickled: only the totals are kept
+        return {'size' : self.size, 'total' : self.total()}
+
+    def __setstate__(self, state):
+        self.__init__(state['size'])
+        self.add(state['total'])
+
+###############################################################################
+## Traversal counters
+###############################################################################
+# Indices of the traversal counters
+NODE_VISITS, CELLS_TRAVERSED, PRIMITIVE_TESTS, PRIMITIVE_HITS = range(4)
+NAMES = ('node_visits', 'cells_traversed', 'primitive_tests', 'primitive_hits')
+
+traversal = ThreadLocalCounters(len(NAMES))
+
+def count(counter, n=1):
+    traversal.get()[counter] += n
+
+def count_tests(ray, counter, n=1, closest=True):
+    # Adds n tests of the given kind to the traversal counters and to the per-ray statistics of the given ray
+    # (closest: tests of a closest-hit query, else tests of an any-hit (shadow) query)
+    traversal.get()[counter] += n
+    if closest:
+        ray.stats.pcount += n
+    else:
+        ray.stats.scount += n
+
+def count_batch_tests(rays, counter, n=1, closest=True, indices=slice(None)):
+    # Batch variant of count_tests: adds n tests (a number or an array) to each of the rays with the given indices
+    per_ray = rays.stats.pcount if closest else rays.stats.scount
+    per_ray[indices] += n
+    if np.ndim(n) == 0:
+        n = n * np.size(per_ray[indices])
+    traversal.get()[counter] += int(np.sum(n))
+
+def totals():
+    return dict(zip(NAMES, traversal.total().tolist()))
+
+def reset():
+    traversal.reset()
+
+def report():
+    lines = ['Traversal statistics']
+    for name, value in zip(NAMES, traversal.total().tolist()):
+        lines.append('    %-20s %15d' % (name.replace('_', ' '), value))
+    return '\n'.join(lines)
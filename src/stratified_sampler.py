@@ -0,0 +1,44 @@
+import numpy as np
+
+from sampling import latin_hypercube, shuffle, stratified_sample_1D, stratified_sample_2D
+
+###############################################################################
+## StratifiedSampler
+###############################################################################
+from sampler import PixelSampler
+
+class StratifiedSampler(PixelSampler):
+    '''
+    Jittered stratified samples: the spp samples of every pixel are split in
+    x_pixel_samples x y_pixel_samples strata of the image plane, the lens
+    samples and time samples are stratified as well (and shuffled relative
+    to the image samples). The integrator samples are Latin hypercube
+    samples.
+    '''
+
+    def __init__(self, x_start, x_end, y_start, y_end, spp, shutter_open, shutter_close, jitter=True):
+        super(StratifiedSampler, self).__init__(x_start, x_end, y_start, y_end, spp, shutter_open, shutter_close)
+        self.jitter = jitter
+        # Split the samples per pixel in the most square grid of strata
+        self.y_pixel_samples = max(d for d in range(1, int(np.sqrt(spp)) + 1) if spp % d == 0)
+        self.x_pixel_samples = spp // self.y_pixel_samples
+
+    def get_pixel_samples(self, nb_pixels, rng):
+        u = rng.uniform(size=(nb_pixels, self.spp, 7))
+        image_xy = stratified_sample_2D(u[:,:,0:2], self.x_pixel_samples, self.y_pixel_samples, self.jitter)
+        lens_uv  = stratified_sample_2D(u[:,:,2:4], self.x_pixel_samples, self.y_pixel_samples, self.jitter)
+        time     = stratified_sample_1D(u[:,:,4], self.jitter)
+
+        # Decorrelate the strata of the image, lens and time samples
+        lens_uv = shuffle(lens_uv, u[:,:,5])
+        time    = shuffle(time[:,:,np.newaxis], u[:,:,6])[:,:,0]
+        return image_xy, lens_uv, time
+
+    def get_integrator_samples(self, n, d, rng):
+        return latin_hypercube(rng.uniform(size=(self.spp, n, d)), rng.uniform(size=(self.spp, n, d)))
+
+    def _duplicate(self, x_start, x_end, y_start, y_end, spp):
+        return type(self)(x_start, x_end, y_start, y_end, spp, self.shutter_open, self.shutter_close, jitter=self.jitter)
+
+    def round_size(self, size):
+        return size
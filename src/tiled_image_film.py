@@ -0,0 +1,93 @@
+import mmap
+import numpy as np
+import os
+from tempfile import TemporaryFile
+
+###############################################################################
+## TiledImageFilm
+###############################################################################
+from box_filter import BoxFilter
+from image_film import ImageFilm, film_rgb, pixel_errors
+from png_writer import PNGWriter
+
+class TiledImageFilm(ImageFilm):
+    '''
+    ImageFilm for very large resolutions. The pixel buffers are memory
+    mapped scratch files (deleted once closed), whose pages are released
+    after every merged tile, so that merged tiles are flushed to disk
+    instead of staying resident. The image is converted and written in
+    bands of rows, as an 8-bit PNG or as a float32 RGB .npy file. The memory
+    in use is bounded by the tiles in flight and a single band rather than
+    by the whole frame.
+    '''
+
+    FORMATS = ('.png', '.npy')
+
+    def __init__(self, x_res=640, y_res=480, fIlter=BoxFilter(), crop_window=np.array([0.0, 1.0, 0.0, 1.0]), fname='pbrtpy.png', band_size=64, directory=None):
+        if os.path.splitext(fname)[1].lower() not in TiledImageFilm.FORMATS:
+            raise ValueError
+        # Number of rows converted and written at a time
+        self.band_size = band_size
+        # Directory of the scratch files (None: the default temporary directory)
+        self.directory = directory
+        super(TiledImageFilm, self).__init__(x_res, y_res, fIlter, crop_window, fname)
+
+    def _allocate(self, shape, dtype=np.float64):
+        # Shared mapping of a fresh scratch file (whose pages read as zeros)
+        size = max(1, int(np.prod(shape)) * np.dtype(dtype).itemsize)
+        with TemporaryFile(dir=self.directory) as scratch:
+            scratch.truncate(size)
+            buffer = mmap.mmap(scratch.fileno(), size)
+        return np.ndarray(shape, dtype=dtype, buffer=buffer)
+
+    def release(self, *arrays):
+        # Drops the resident pages of the pixel buffers and of the given arrays (of _allocate);
+        # modified pages are kept in the scratch files
+        if hasattr(mmap, 'MADV_DONTNEED'):
+            for array in (self.L_xyz, self.weight_sum, self.splat_xyz, self.sample_count, self.Y_sum, self.Y2_sum) + arrays:
+                array.base.madvise(mmap.MADV_DONTNEED)
+
+    def add_samples(self, image_xy, Ls, rays=None):
+        super(TiledImageFilm, self).add_samples(image_xy, Ls, rays)
+        with self.lock:
+            self.release()
+
+    def merge_film_tile(self, tile):
+        super(TiledImageFilm, self).merge_film_tile(tile)
+        with self.lock:
+            self.release()
+
+    def get_bands(self):
+        # Row slices of the bands (relative to the pixel start)
+        return [slice(y, min(y + self.band_size, self.y_pixel_count)) for y in range(0, self.y_pixel_count, self.band_size)]
+
+    def get_pixel_errors(self):
+        errors = self._allocate((self.y_pixel_count, self.x_pixel_count))
+        for band in self.get_bands():
+            errors[band] = pixel_errors(self.sample_count[band], self.Y_sum[band], self.Y2_sum[band])
+            self.release(errors)
+        return errors
+
+    def write_image(self, splat_scale=1.0):
+        with self.lock:
+            if os.path.splitext(self.fname)[1].lower() == '.npy':
+                self._write_npy(splat_scale)
+            else:
+                self._write_png(splat_scale)
+
+    def _write_npy(self, splat_scale):
+        image = np.lib.format.open_memmap(self.fname, mode='w+', dtype=np.float32, shape=(self.y_pixel_count, self.x_pixel_count, 3))
+        for band in self.get_bands():
+            image[band] = film_rgb(self.L_xyz[band], self.weight_sum[band], self.splat_xyz[band], splat_scale)
+            image.flush()
+            self.release()
+        del image
+
+    def _write_png(self, splat_scale):
+        # Same pixel values as ImageFilm (whose images are written by OpenCV, i.e. as BGR)
+        writer = PNGWriter(self.fname, self.x_pixel_count, self.y_pixel_count)
+        for band in self.get_bands():
+            rgb = film_rgb(self.L_xyz[band], self.weight_sum[band], self.splat_xyz[band], splat_scale)
+            writer.write_rows(np.clip(np.round(255 * rgb[...,::-1]), 0, 255))
+            self.release()
+        writer.close()
@@ -4,8 +4,8 @@ from math_utils import length_squared, normalize
 ###############################################################################
 ## Transform
 ###############################################################################
-from nAABB import NAABB, union
-from ray import Ray
+from nAABB import NAABB
+from ray import Ray, RayBatch
 
 class Transform(object):
 
@@ -19,6 +19,17 @@ class Transform(object):
                 self.m_inv = np.linalg.inv(self.m)
             else:
                 self.m_inv = matrix_inverse
+        # The matrices are never modified: the inverse and the applied parts are cached once needed
+        # (the intermediate products of composites such as T * R * S are never applied)
+        self._inverse = None
+        self.linear = None
+
+    def _update(self):
+        # Cache the parts of the matrices applied to (arrays of) points, directions and normals
+        self.linear = np.ascontiguousarray(self.m[:3,:3].transpose())
+        self.translation = self.m[:3,3].copy()
+        self.normal_linear = np.ascontiguousarray(self.m_inv[:3,:3])
+        self.is_affine = np.array_equal(self.m[3], [0.0, 0.0, 0.0, 1.0])
     
     def __copy__(self):
         return self.__deepcopy__()
@@ -27,10 +38,13 @@ class Transform(object):
         return Transform(self.m.copy(), self.m_inv.copy())
     
     def inverse(self):
-        return Transform(self.m_inv.copy(), self.m.copy())
+        if self._inverse is None:
+            self._inverse = Transform(self.m_inv, self.m)
+            self._inverse._inverse = self
+        return self._inverse
         
     def is_identity(self):
-        return self.m == np.identity(4)
+        return np.array_equal(self.m, np.identity(4))
 
     def has_scale(self):
         la2 = length_squared(self(np.array([1.0, 0.0, 0.0]), is_direction=True))
@@ -43,16 +57,22 @@ class Transform(object):
         return np.linalg.det(self.m) < 0.0
 
     def __eq__(self, t):
-        return self.m == t.m and self.m_inv == t.m_inv
+        return np.array_equal(self.m, t.m) and np.array_equal(self.m_inv, t.m_inv)
     
     def __ne__(self, t):
-        return self.m != t.m or self.m_inv != t.m_inv
+        return not self == t
         
     def __mul__(self, t):
         return Transform(self.m.dot(t.m), t.m_inv.dot(self.m_inv))
 
     def __call__(self, elt, is_normal=False, is_point=False, is_direction=False):
-        if isinstance(elt, Ray):
+        # Points, directions and normals are either of shape (3,) or (N,3), and are transformed with a single matmul
+        if isinstance(elt, RayBatch):
+            rays = elt.__copy__()
+            rays.o = self(rays.o, is_point=True)
+            rays.d = self(rays.d, is_direction=True)
+            return rays
+        elif isinstance(elt, Ray):
             ray = elt.__copy__()
             ray.o = self(ray.o, is_point=True)
             ray.d = self(ray.d, is_direction=True)
@@ -63,28 +83,43 @@ class Transform(object):
                 ray.y_d = self(ray.y_d, is_direction=True)
             return ray
         elif isinstance(elt, NAABB):
-            ret = NAABB(     self(np.array([elt.pMin[0], elt.pMin[1], elt.pMin[2]]), is_point=True))
-            ret = union(ret, self(np.array([elt.pMax[0], elt.pMin[1], elt.pMin[2]]), is_point=True))
-            ret = union(ret, self(np.array([elt.pMin[0], elt.pMax[1], elt.pMin[2]]), is_point=True))
-            ret = union(ret, self(np.array([elt.pMin[0], elt.pMin[1], elt.pMax[2]]), is_point=True))
-            ret = union(ret, self(np.array([elt.pMin[0], elt.pMax[1], elt.pMax[2]]), is_point=True))
-            ret = union(ret, self(np.array([elt.pMax[0], elt.pMax[1], elt.pMin[2]]), is_point=True))
-            ret = union(ret, self(np.array([elt.pMax[0], elt.pMin[1], elt.pMax[2]]), is_point=True))
-            ret = union(ret, self(np.array([elt.pMax[0], elt.pMax[1], elt.pMax[2]]), is_point=True))
-            return ret
-        elif is_normal:
-            return self.m_inv[:3,:3].transpose().dot(elt) 
+            pMin, pMax = self.transform_bounds(elt.pMin, elt.pMax)
+            return NAABB(pMin, pMax)
+        if self.linear is None:
+            self._update()
+        if is_normal:
+            return elt.dot(self.normal_linear)
         elif is_direction:
-            return self.m[:3,:3].dot(elt) 
+            return elt.dot(self.linear)
         elif is_point:
-            v = self.m.dot(np.append(elt, 1.0))
-            if v[3] == 1.0:
-                return v[:3]
+            v = elt.dot(self.linear) + self.translation
+            if self.is_affine:
+                return v
+            w = elt.dot(self.m[3,:3]) + self.m[3,3]
+            if np.all(w == 1.0):
+                return v
             else:
-                return v[:3]/v[3]
+                return v / np.asarray(w)[..., np.newaxis]
         else:
             raise ValueError
 
+    def transform_bounds(self, pMin, pMax):
+        # Bounds of the transformed boxes [pMin, pMax] of shape (3,) or (N,3)
+        if self.linear is None:
+            self._update()
+        if self.is_affine:
+            # Transform the centers and the (absolute) half extents [Arvo 1990]
+            center = self(0.5 * (pMin + pMax), is_point=True)
+            half = (0.5 * (pMax - pMin)).dot(np.abs(self.linear))
+            return center - half, center + half
+        # Transform all eight corners
+        corners = np.where(_CORNERS, pMax[..., np.newaxis, :], pMin[..., np.newaxis, :])
+        corners = self(corners.reshape((-1, 3)), is_point=True).reshape(corners.shape)
+        return corners.min(axis=-2), corners.max(axis=-2)
+
+# Corner selection mask (pMin: False, pMax: True) of the eight corners of a box
+_CORNERS = np.array([[(i >> 0) & 1, (i >> 1) & 1, (i >> 2) & 1] for i in range(8)], dtype=bool)
+
 ###############################################################################
 ## Transform operations
 ###############################################################################
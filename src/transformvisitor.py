@@ -1,7 +1,10 @@
+import numpy as np
+
 ###############################################################################
 ## TransformVisitor
 ###############################################################################
 from entityvisitor import TriangleVisitor
+from trianglemesh import TriangleMesh
 
 class TransformVisitor(TriangleVisitor):
     
@@ -11,8 +14,10 @@ class TransformVisitor(TriangleVisitor):
         self.triangles = []
      
     def visit_triangle(self, entity):
-        triangle = entity.__deepcopy__()
-        triangle.v1 = self.T(triangle.v1, is_point=True)
-        triangle.v2 = self.T(triangle.v2, is_point=True)
-        triangle.v3 = self.T(triangle.v3, is_point=True)
-        self.triangles.append(triangle)
+        # The new triangle computes its cached intersection data from the transformed vertices
+        v1, v2, v3 = self.T(np.array([entity.v1, entity.v2, entity.v3]), is_point=True)
+        self.triangles.append(type(entity)(v1, v2, v3, color=entity.color))
+
+    def visit_triangle_mesh(self, entity):
+        # All vertices are transformed at once; the index array is shared
+        self.triangles.append(TriangleMesh(self.T(entity.vertices, is_point=True), entity.indices, color=entity.color))
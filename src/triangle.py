@@ -5,9 +5,10 @@ SINGLE_SIDED = False #only works for 3D vectors (np.cross)
 
 ###############################################################################
 ## Triangle
-###############################################################################  
+###############################################################################
 from nAABB import union
 from shape import Shape
+import stats
 
 class Triangle(Shape):
     def __init__(self, v1, v2, v3, i=None, color='k'):
@@ -15,43 +16,80 @@ class Triangle(Shape):
         self.v1 = v1
         self.v2 = v2
         self.v3 = v3
-    
+        self._update()
+
+    def _update(self):
+        # Precompute the edges, the geometric normal, the surface area and (3D) the projection coefficients
+        # of Wald's intersection test. Must be called whenever the vertices change.
+        self.e1 = self.v2 - self.v1
+        self.e2 = self.v3 - self.v1
+        if self.v1.shape[0] != 3:
+            self.n = None
+            self._wald = None
+            return
+        c = np.cross(self.e1, self.e2)
+        self.area = 0.5 * length(c)
+        self.n = normalize(c)
+
+        # Project onto the plane perpendicular to the dominant axis k of the normal
+        a, b, c = self.v1.tolist(), self.e2.tolist(), self.e1.tolist()
+        N = (-self.n).tolist()
+        k = int(np.argmax(np.fabs(self.n)))
+        u, v = (k + 1) % 3, (k + 2) % 3
+        denom = b[u] * c[v] - b[v] * c[u]
+        if N[k] == 0.0 or denom == 0.0:
+            # Degenerate triangle
+            self._wald = None
+            return
+        self._wald = (k, u, v,
+                      N[u] / N[k], N[v] / N[k], (N[0] * a[0] + N[1] * a[1] + N[2] * a[2]) / N[k],
+                      -b[v] / denom, b[u] / denom, (b[v] * a[u] - b[u] * a[v]) / denom,
+                      c[v] / denom, -c[u] / denom, (c[u] * a[v] - c[v] * a[u]) / denom)
+
     def dim(self):
         return self.v1.shape[0]
-         
+
     def normal(self, p=None):
-        return normalize(np.cross(self.v2-self.v1, self.v3-self.v1))
-                     
+        if self.n is None:
+            return normalize(np.cross(self.e1, self.e2))
+        return self.n
+
     def surface_area(self):
-        return 0.5 * length(np.cross(self.v2-self.v1, self.v3-self.v1))
-    
+        if self.n is None:
+            return 0.5 * length(np.cross(self.e1, self.e2))
+        return self.area
+
     def bounds(self):
         return union(union(self.v1, self.v2), self.v3)
 
     def centroid(self):
         return (self.v1 + self.v2 + self.v3) / 3.0
-    
+
     def intersect(self, ray, isect=None):
-        
-        if isect:
-            ray.stats.pcount += 1
-        else:
-            ray.stats.scount += 1
-            
+        if __debug__ and stats.enabled:
+            stats.count_tests(ray, stats.PRIMITIVE_TESTS, closest=isect is not None)
+
+        if self.v1.shape[0] == 3:
+            t = self._intersect_wald(ray)
+            if t is None:
+                return False
+            self._update_intersection(t=t, ray=ray, isect=isect)
+            return True
+
         if SINGLE_SIDED and ray.d.dot(self.normal()) <= 0.0:
             return False
-            
+
         A = np.zeros((self.v1.shape[0], 3))
-        A[:,0] = self.v1 - self.v2
-        A[:,1] = self.v1 - self.v3
-        A[:,2] = ray.d														
+        A[:,0] = -self.e1
+        A[:,1] = -self.e2
+        A[:,2] = ray.d
         rhs = self.v1 - ray.o
 
         try:
-            x = np.linalg.lstsq(A, rhs)[0] 
+            x = np.linalg.lstsq(A, rhs)[0]
         except np.linalg.LinAlgError:
             return False
-        
+
         if (x[2]<ray.tMin or x[2]>ray.tMax):
             return False
         if (x[1]<0.0 or x[1]>1.0):
@@ -59,12 +97,52 @@ class Triangle(Shape):
         if (x[0]<0.0 or x[0]>1.0-x[1]):
             return False
 
-        self._update_intersection(t=x[2], ray=ray, isect=isect)	
-        
+        self._update_intersection(t=x[2], ray=ray, isect=isect)
+
         return True
-        
+
+    def occluded(self, ray):
+        if self.v1.shape[0] != 3:
+            return super(Triangle, self).occluded(ray)
+        if __debug__ and stats.enabled:
+            stats.count_tests(ray, stats.PRIMITIVE_TESTS, closest=False)
+        hit = self._intersect_wald(ray) is not None
+        if __debug__ and stats.enabled:
+            if hit:
+                stats.count(stats.PRIMITIVE_HITS)
+        return hit
+
+    def _intersect_wald(self, ray):
+        # Returns the distance to the intersection (None: no intersection)
+        if self._wald is None:
+            return None
+        k, u, v, n_u, n_v, n_d, b_nu, b_nv, b_d, c_nu, c_nv, c_d = self._wald
+        o = ray.o.tolist()
+        d = ray.d.tolist()
+        if SINGLE_SIDED and (self.n[0] * d[0] + self.n[1] * d[1] + self.n[2] * d[2]) <= 0.0:
+            return None
+
+        # Distance to the plane
+        den = d[k] + n_u * d[u] + n_v * d[v]
+        if den == 0.0:
+            return None
+        t = (n_d - o[k] - n_u * o[u] - n_v * o[v]) / den
+        if not (ray.tMin <= t <= ray.tMax):
+            return None
+
+        # Barycentric coordinates of the projected hit point
+        hu = o[u] + t * d[u]
+        hv = o[v] + t * d[v]
+        beta = hu * b_nu + hv * b_nv + b_d
+        if beta < 0.0:
+            return None
+        gamma = hu * c_nu + hv * c_nv + c_d
+        if gamma < 0.0 or beta + gamma > 1.0:
+            return None
+        return t
+
     def __copy__(self):
         return self.__deepcopy__()
-                        
+
     def __deepcopy__(self):
         return type(self)(self.v1.copy(), self.v2.copy(), self.v3.copy(), color=self.color)
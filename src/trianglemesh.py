@@ -0,0 +1,322 @@
+import numpy as np
+
+# Maximum number of ray-triangle pairs tested at once by the batched intersection
+MAX_BATCH_PAIRS = 1 << 18
+
+###############################################################################
+## TriangleMesh
+###############################################################################
+from nAABB import NAABB
+from shape import Shape
+import stats
+from triangle import SINGLE_SIDED, Triangle
+
+class TriangleMesh(Shape):
+    '''
+    A structure-of-arrays triangle mesh: one contiguous (N,3) vertex array
+    and one (M,3) index array. Every face carries its own shape id so that
+    intersections report the same ids as individual Triangles would.
+    '''
+
+    def __init__(self, vertices=None, indices=None, face_ids=None, i=None, color='k'):
+        super(TriangleMesh, self).__init__(i, color=color)
+        if vertices is None:
+            vertices = np.zeros((0, 3))
+        if indices is None:
+            indices = np.zeros((0, 3), dtype=np.int64)
+        self.vertices = np.ascontiguousarray(vertices, dtype=np.float64)
+        self.indices  = np.ascontiguousarray(indices, dtype=np.int64).reshape((-1, 3))
+        if face_ids is None:
+            face_ids = _reserve_ids(self.indices.shape[0])
+        self.face_ids = np.ascontiguousarray(face_ids, dtype=np.int64)
+        self._update()
+
+    def __len__(self):
+        return self.indices.shape[0]
+
+    def __getitem__(self, index):
+        v1, v2, v3 = self.vertices[self.indices[index]]
+        return Triangle(v1, v2, v3, i=int(self.face_ids[index]), color=self.color)
+
+    def get_shapes(self):
+        return [self[f] for f in range(len(self))]
+
+    def append(self, shapes):
+        if type(shapes) is not list:
+            shapes = [shapes]
+        vertices = [self.vertices]
+        indices  = [self.indices]
+        face_ids = [self.face_ids]
+        offset = self.vertices.shape[0]
+
+        triangles = [shape for shape in shapes if isinstance(shape, Triangle)]
+        if len(triangles) != 0:
+            vertices.append(np.array([(t.v1, t.v2, t.v3) for t in triangles], dtype=np.float64).reshape((-1, 3)))
+            indices.append(offset + np.arange(3 * len(triangles), dtype=np.int64).reshape((-1, 3)))
+            face_ids.append(np.array([t.id for t in triangles], dtype=np.int64))
+            offset += 3 * len(triangles)
+
+        for shape in shapes:
+            if isinstance(shape, TriangleMesh):
+                vertices.append(shape.vertices)
+                indices.append(offset + shape.indices)
+                face_ids.append(shape.face_ids)
+                offset += shape.vertices.shape[0]
+            elif not isinstance(shape, Triangle):
+                raise ValueError(type(shape))
+
+        self.vertices = np.concatenate(vertices)
+        self.indices  = np.concatenate(indices)
+        self.face_ids = np.concatenate(face_ids)
+        self._update()
+        return self
+
+    def _update(self):
+        # Invalidates the per-face data (first vertex, edges and unit normal), which is computed on first use.
+        # Must be called whenever the vertices or indices change.
+        self._face_data = None
+
+    def _get_face_data(self):
+        if self._face_data is None:
+            v1 = self.vertices[self.indices[:,0]]
+            e1 = self.vertices[self.indices[:,1]] - v1
+            e2 = self.vertices[self.indices[:,2]] - v1
+            n = _cross(e1, e2)
+            area = np.sqrt(np.einsum('ij,ij->i', n, n))
+            with np.errstate(divide='ignore', invalid='ignore'):
+                n /= area[:, np.newaxis]
+            self._face_data = (v1, e1, e2, n, area)
+        return self._face_data
+
+    def submesh(self, faces):
+        # The submesh shares the vertex array of this mesh
+        return type(self)(self.vertices, self.indices[faces], self.face_ids[faces], color=self.color)
+
+    def dim(self):
+        return 3
+
+    def face_normals(self, faces=None):
+        n = self._get_face_data()[3]
+        return n if faces is None else n[faces]
+
+    def surface_area(self):
+        return 0.5 * np.sum(self._get_face_data()[4])
+
+    def bounds(self):
+        if len(self) == 0:
+            return NAABB(N=3)
+        vs = self.vertices[self.indices.ravel()]
+        return NAABB(vs.min(axis=0), vs.max(axis=0))
+
+    def face_bounds(self, faces=None):
+        I = self.indices if faces is None else self.indices[faces]
+        vs = self.vertices[I]
+        return vs.min(axis=1), vs.max(axis=1)
+
+    def centroid(self):
+        vs = self.vertices[self.indices.ravel()]
+        return np.mean(vs, axis=0)
+
+    def face_box_overlap(self, faces, b_min, b_max):
+        # Separating axis test of the faces against the boxes [b_min[j], b_max[j]] (Akenine-Moeller),
+        # assuming the face bounds already overlap the boxes
+        center = 0.5 * (b_min + b_max)
+        half = 0.5 * (b_max - b_min)
+        v = self.vertices[self.indices[faces]] - center[:, np.newaxis, :]
+        e = v[:, [1, 2, 0]] - v
+
+        # Cross products of the face edges and the box axes
+        overlap = np.ones((v.shape[0]), dtype=bool)
+        for axis in np.eye(3):
+            for i in range(3):
+                a = _cross(axis, e[:,i])
+                p = np.einsum('kvi,ki->kv', v, a)
+                r = np.einsum('ki,ki->k', half, np.abs(a))
+                overlap &= (p.min(axis=1) <= r) & (p.max(axis=1) >= -r)
+
+        # Face plane
+        n = _cross(e[:,0], e[:,1])
+        overlap &= np.abs(np.einsum('ki,ki->k', n, v[:,0])) <= np.einsum('ki,ki->k', half, np.abs(n))
+        return overlap
+
+    def _edges(self, faces=None):
+        v1, e1, e2 = self._get_face_data()[:3]
+        if faces is None:
+            return v1, e1, e2
+        return v1[faces], e1[faces], e2[faces]
+
+    def intersect(self, ray, isect=None):
+        return self.intersect_faces(None, ray, isect=isect)
+
+    def intersect_exclusive(self, excl, ray, isect=None):
+        if self.id in excl:
+            return False
+        faces = np.nonzero(~np.isin(self.face_ids, list(excl)))[0]
+        return self.intersect_faces(faces, ray, isect=isect)
+
+    def intersect_faces(self, faces, ray, isect=None):
+        # Vectorized Moeller-Trumbore test of one ray against the given faces (None: all faces)
+        nb_faces = len(self) if faces is None else len(faces)
+        if __debug__ and stats.enabled:
+            stats.count_tests(ray, stats.PRIMITIVE_TESTS, nb_faces, closest=isect is not None)
+        if nb_faces == 0:
+            return False
+
+        v1, e1, e2 = self._edges(faces)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            p = _cross(ray.d, e2)
+            det = np.einsum('ij,ij->i', e1, p)
+            inv_det = 1.0 / det
+            s = ray.o - v1
+            b1 = np.einsum('ij,ij->i', s, p) * inv_det
+            q = _cross(s, e1)
+            b2 = q.dot(ray.d) * inv_det
+            t = np.einsum('ij,ij->i', e2, q) * inv_det
+            valid = (det != 0.0) & (b1 >= 0.0) & (b2 >= 0.0) & (b1 + b2 <= 1.0) & (t >= ray.tMin) & (t <= ray.tMax)
+        if SINGLE_SIDED:
+            valid &= (det < 0.0)
+        if __debug__ and stats.enabled:
+            stats.count(stats.PRIMITIVE_HITS, int(np.count_nonzero(valid)))
+
+        if not valid.any():
+            return False
+        if isect is None:
+            return True
+
+        k = np.argmin(np.where(valid, t, np.inf))
+        face = k if faces is None else faces[k]
+        self._update_face_intersection(face, t[k], ray, isect)
+        return True
+
+    def intersect_batch(self, rays, isects=None):
+        return self.intersect_faces_batch(None, rays, isects=isects)
+
+    def occluded(self, ray):
+        return self.intersect_faces(None, ray)
+
+    def occluded_batch(self, rays):
+        return self.intersect_faces_batch(None, rays)
+
+    def intersect_faces_batch(self, faces, rays, isects=None):
+        # Vectorized Moeller-Trumbore test of all rays of the batch against the given faces (None: all faces)
+        nb_faces = len(self) if faces is None else len(faces)
+        nb_rays  = len(rays)
+        hits = np.zeros((nb_rays), dtype=bool)
+        if __debug__ and stats.enabled:
+            stats.count_batch_tests(rays, stats.PRIMITIVE_TESTS, nb_faces, closest=isects is not None)
+        if nb_faces == 0 or nb_rays == 0:
+            return hits
+
+        v1, e1, e2 = self._edges(faces)
+        chunk = max(1, MAX_BATCH_PAIRS // nb_faces)
+        for k0 in range(0, nb_rays, chunk):
+            ks = slice(k0, min(k0 + chunk, nb_rays))
+            d = rays.d[ks][:, np.newaxis, :]
+            with np.errstate(divide='ignore', invalid='ignore'):
+                p = _cross(d, e2)
+                det = np.einsum('kfi,fi->kf', p, e1)
+                inv_det = 1.0 / det
+                s = rays.o[ks][:, np.newaxis, :] - v1
+                b1 = np.einsum('kfi,kfi->kf', s, p) * inv_det
+                q = _cross(s, e1)
+                b2 = np.einsum('kfi,ki->kf', q, rays.d[ks]) * inv_det
+                t = np.einsum('kfi,fi->kf', q, e2) * inv_det
+                valid = (det != 0.0) & (b1 >= 0.0) & (b2 >= 0.0) & (b1 + b2 <= 1.0) \
+                      & (t >= rays.tMin[ks, np.newaxis]) & (t <= rays.tMax[ks, np.newaxis])
+            if SINGLE_SIDED:
+                valid &= (det < 0.0)
+            if __debug__ and stats.enabled:
+                stats.count(stats.PRIMITIVE_HITS, int(np.count_nonzero(valid)))
+
+            t = np.where(valid, t, np.inf)
+            k = np.argmin(t, axis=1)
+            t = t[np.arange(k.shape[0]), k]
+            hit = np.isfinite(t)
+            hits[ks] = hit
+            if isects is None or not hit.any():
+                continue
+
+            idx = k0 + np.nonzero(hit)[0]
+            face = k[hit] if faces is None else faces[k[hit]]
+            t = t[hit]
+            rays.tMax[idx] = t
+            isects.update(idx, self.face_ids[face], rays.o[idx] + t[:, np.newaxis] * rays.d[idx], t, self.face_normals(face))
+        return hits
+
+    def intersect_pairs_batch(self, ks, faces, rays, isects=None):
+        # Vectorized Moeller-Trumbore test of the ray-face pairs (rays[ks[j]], faces[j]), keeping the closest hit per ray
+        nb_rays = len(rays)
+        hits = np.zeros((nb_rays), dtype=bool)
+        if __debug__ and stats.enabled:
+            stats.count_batch_tests(rays, stats.PRIMITIVE_TESTS, np.bincount(ks, minlength=nb_rays), closest=isects is not None)
+        if ks.shape[0] == 0:
+            return hits
+
+        t = np.empty((ks.shape[0]))
+        for j0 in range(0, ks.shape[0], MAX_BATCH_PAIRS):
+            js = slice(j0, j0 + MAX_BATCH_PAIRS)
+            k = ks[js]
+            v1, e1, e2 = self._edges(faces[js])
+            d = rays.d[k]
+            with np.errstate(divide='ignore', invalid='ignore'):
+                p = _cross(d, e2)
+                det = np.einsum('ij,ij->i', e1, p)
+                inv_det = 1.0 / det
+                s = rays.o[k] - v1
+                b1 = np.einsum('ij,ij->i', s, p) * inv_det
+                q = _cross(s, e1)
+                b2 = np.einsum('ij,ij->i', q, d) * inv_det
+                tk = np.einsum('ij,ij->i', e2, q) * inv_det
+                valid = (det != 0.0) & (b1 >= 0.0) & (b2 >= 0.0) & (b1 + b2 <= 1.0) & (tk >= rays.tMin[k]) & (tk <= rays.tMax[k])
+            if SINGLE_SIDED:
+                valid &= (det < 0.0)
+            t[js] = np.where(valid, tk, np.inf)
+
+        valid = np.isfinite(t)
+        hits[ks[valid]] = True
+        if __debug__ and stats.enabled:
+            stats.count(stats.PRIMITIVE_HITS, int(np.count_nonzero(valid)))
+        if isects is None or not valid.any():
+            return hits
+
+        # Select the closest face per ray
+        t_min = np.full((nb_rays), np.inf)
+        np.minimum.at(t_min, ks[valid], t[valid])
+        closest = valid & (t == t_min[ks])
+        idx, first = np.unique(ks[closest], return_index=True)
+        face = faces[closest][first]
+        t = t_min[idx]
+        rays.tMax[idx] = t
+        isects.update(idx, self.face_ids[face], rays.o[idx] + t[:, np.newaxis] * rays.d[idx], t, self.face_normals(face))
+        return hits
+
+    def _update_face_intersection(self, face, t, ray, isect):
+        ray.tMax = t
+        p = ray.o + t * ray.d
+        isect.update(int(self.face_ids[face]), p, t, self.face_normals(face).copy())
+
+    def __copy__(self):
+        return type(self)(self.vertices, self.indices, self.face_ids, color=self.color)
+
+    def __deepcopy__(self):
+        return type(self)(self.vertices.copy(), self.indices.copy(), color=self.color)
+
+def _reserve_ids(n):
+    if n == 0:
+        return np.zeros((0), dtype=np.int64)
+    start = Shape.id_gen.reserve(n)
+    return np.arange(start, start + n, dtype=np.int64)
+
+def _cross(a, b):
+    # Cross product along the last axis (broadcasting), without the overhead of np.cross
+    c = np.empty(np.broadcast(a, b).shape)
+    c[...,0] = a[...,1] * b[...,2] - a[...,2] * b[...,1]
+    c[...,1] = a[...,2] * b[...,0] - a[...,0] * b[...,2]
+    c[...,2] = a[...,0] * b[...,1] - a[...,1] * b[...,0]
+    return c
+
+def split_triangles(shapes):
+    # Gathers all Triangles and TriangleMeshes into a single mesh; returns the mesh and the remaining shapes
+    triangles = [shape for shape in shapes if isinstance(shape, (Triangle, TriangleMesh))]
+    others    = [shape for shape in shapes if not isinstance(shape, (Triangle, TriangleMesh))]
+    return TriangleMesh().append(triangles), others
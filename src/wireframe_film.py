@@ -28,7 +28,8 @@ class WireframeFilm(Film):
             raise ValueError
 
     def add_sample(self, sample, L, ray):
-        ray.accept(self.wireframe_renderer)
+        if ray is not None:
+            ray.accept(self.wireframe_renderer)
 
     def splat(self, sample, L):
         return
@@ -47,5 +48,40 @@ class WireframeFilm(Film):
         y_end   = self.y_pixel_start + self.y_pixel_count
         return x_start, x_end, y_start, y_end
     
+    def get_film_tile(self, x_start, x_end, y_start, y_end):
+        return WireframeFilmTile(self.x_resolution, self.y_resolution)
+
+    def merge_film_tile(self, tile):
+        if tile is self:
+            return
+        for ray in tile.rays:
+            ray.accept(self.wireframe_renderer)
+
     def write_image(self, splat_scale=1.0):
         self.wireframe_renderer.save(self.fname + '-wfr.png')
+
+###############################################################################
+## WireframeFilmTile
+###############################################################################
+class WireframeFilmTile(Film):
+    '''
+    Records (copies of) the rays of the samples of a render task, to be
+    drawn by the WireframeFilm once the tile is merged.
+    '''
+
+    def __init__(self, x_res, y_res):
+        super(WireframeFilmTile, self).__init__(x_res=x_res, y_res=y_res)
+        self.rays = []
+
+    def add_sample(self, sample, L, ray):
+        if ray is not None:
+            self.rays.append(ray.__copy__())
+
+    def get_sample_extent(self):
+        return
+
+    def get_pixel_extent(self):
+        return
+
+    def write_image(self, splat_scale=1.0):
+        return